@@ -7,3 +7,81 @@ database_name = getenv("DATABASE_NAME")
 
 database_url = f"sqlite:///database/{database_name}"
 test_db_url = "sqlite:///database/testing_db"
+# Тот же файл БД через асинхронный драйвер aiosqlite - для async-обработчиков
+async_database_url = f"sqlite+aiosqlite:///database/{database_name}"
+test_async_db_url = "sqlite+aiosqlite:///database/testing_db"
+
+# Профиль SQLite для продакшена. Все значения можно переопределить в .env
+sqlite_journal_mode = getenv("SQLITE_JOURNAL_MODE", "WAL")  # WAL: читатели не ждут писателя
+sqlite_synchronous = getenv("SQLITE_SYNCHRONOUS", "NORMAL")  # в режиме WAL безопасно и без fsync на каждый коммит
+sqlite_busy_timeout_ms = int(getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+sqlite_cache_size_kib = int(getenv("SQLITE_CACHE_SIZE_KIB", "65536"))
+sqlite_mmap_size = int(getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+# Пул соединений считается на один процесс uvicorn: при --workers N всего будет до N * (size + overflow) соединений
+db_pool_size = int(getenv("DB_POOL_SIZE", "5"))
+db_max_overflow = int(getenv("DB_MAX_OVERFLOW", "10"))
+db_pool_timeout = float(getenv("DB_POOL_TIMEOUT", "30"))
+# Повтор транзакции, если БД все равно осталась заблокирована другим процессом дольше busy_timeout
+db_busy_retries = int(getenv("DB_BUSY_RETRIES", "5"))
+db_busy_backoff_ms = int(getenv("DB_BUSY_BACKOFF_MS", "20"))
+
+# Индекс для transfer_waste в памяти процесса: загрузить его целиком при старте или подгружать по мере обращений
+allocation_index_preload = getenv("ALLOCATION_INDEX_PRELOAD", "True") == "True"
+
+# Типы отходов, которые принимает API. Лимиты хранятся построчно (таблица warehousecapacity), поэтому новый тип
+# добавляется без изменения схемы, например WASTE_TYPES=glass,plastic,bio,metal,paper,e-waste
+waste_types = tuple(waste_type.strip() for waste_type in getenv("WASTE_TYPES", "glass,plastic,bio").split(",")
+                    if waste_type.strip())
+
+# Потоковый импорт (post /import/..., python -m database.bulk_import): строк в одной транзакции
+# и сколько ошибок по строкам возвращать в отчете (остальные только считаются)
+import_chunk_size = int(getenv("IMPORT_CHUNK_SIZE", "1000"))
+import_max_errors = int(getenv("IMPORT_MAX_ERRORS", "1000"))
+
+# Автоматическая отмена броней без подтверждения доставки: срок жизни брони (0 - не отменять),
+# как часто проверять и сколько броней отменять одной транзакцией. По умолчанию выключена: включайте, только если
+# клиенты подтверждают доставку (patch /order/{order_id} с accepted: true), иначе отменятся и доставленные брони
+reservation_ttl_s = int(getenv("RESERVATION_TTL_S", "0"))
+reservation_sweep_interval_s = float(getenv("RESERVATION_SWEEP_INTERVAL_S", "60"))
+reservation_sweep_batch = int(getenv("RESERVATION_SWEEP_BATCH", "1000"))
+
+# Сколько заказов можно изменить одним запросом patch /orders/ (все id уходят в один IN (...))
+orders_batch_limit = int(getenv("ORDERS_BATCH_LIMIT", "5000"))
+
+# Выгрузка броней (get /reservations/export/): сколько строк читать одним запросом (страница по курсору id)
+# и сколько строк забирать с курсора БД и отправлять клиенту за раз
+export_page_size = int(getenv("EXPORT_PAGE_SIZE", "100000"))
+export_chunk_size = int(getenv("EXPORT_CHUNK_SIZE", "1000"))
+
+# Кэш ответов get /orgs/, /orgs/{org_id}/, /warehouses/ и /warehouses/{warehouse_id}/: сколько ответов хранить
+# (0 - не кэшировать)
+response_cache_size = int(getenv("RESPONSE_CACHE_SIZE", "1024"))
+# Тела этих ответов собираются из строк БД прямо в JSON через orjson, без моделей pydantic. false - прежний путь:
+# каждый ответ проверяется по модели и сериализуется pydantic (медленнее, но ошибка в данных будет видна сразу)
+fast_json = getenv("FAST_JSON", "true").lower() == "true"
+
+# Метрики get /metrics: сбор можно выключить; SQL-команды дольше slow_query_ms пишутся в журнал (0 - не писать)
+metrics_enabled = getenv("METRICS_ENABLED", "true").lower() == "true"
+slow_query_ms = float(getenv("SLOW_QUERY_MS", "200"))
+
+# Расстояния по координатам: в каком радиусе (км) связывать организации и хранилища автоматически
+# и сколько ближайших хранилищ получает новая организация
+geo_radius_km = float(getenv("GEO_RADIUS_KM", "100"))
+geo_max_links = int(getenv("GEO_MAX_LINKS", "20"))
+
+# Заголовок Idempotency-Key у post /transfer_waste/, /transfer_waste/batch/ и /transfer_waste/streams/: сколько секунд
+# повтор с тем же ключом получает сохраненный ответ и сколько ключей хранить не больше (самые старые удаляются)
+idempotency_ttl_s = int(getenv("IDEMPOTENCY_TTL_S", str(24 * 3600)))
+idempotency_max_keys = int(getenv("IDEMPOTENCY_MAX_KEYS", "100000"))
+
+# Режим одного писателя для post /transfer_waste/: заявки процесса записываются группами - до write_batch_size
+# заявок в одной транзакции, группа ждет новые заявки не дольше write_batch_wait_ms после первой
+write_batching = getenv("WRITE_BATCHING", "false").lower() == "true"
+write_batch_size = int(getenv("WRITE_BATCH_SIZE", "64"))
+write_batch_wait_ms = float(getenv("WRITE_BATCH_WAIT_MS", "2"))
+
+# Кэш планов get /transfer_waste/quote/ по паре (организация, тип отходов): сколько секунд план действителен, если
+# остатки его хранилищ не менялись в этом процессе (изменения других воркеров видны только по истечении срока),
+# и сколько планов хранить
+quote_cache_ttl_s = float(getenv("QUOTE_CACHE_TTL_S", "5"))
+quote_cache_size = int(getenv("QUOTE_CACHE_SIZE", "10000"))
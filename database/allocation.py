@@ -0,0 +1,193 @@
+from collections import defaultdict
+from typing import Callable, Dict, List, Tuple
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import and_
+from sqlmodel import insert, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+import config
+import database.sql_models as sql
+import database.analytics as analytics
+
+
+WASTE_TYPES = config.waste_types
+RESERVE_ATTEMPTS = 3  # сколько раз перечитываем остаток, если другой запрос успел забрать место раньше
+
+
+def waste_type_message() -> str:
+    quoted = [f"'{waste_type}'" for waste_type in WASTE_TYPES]
+    listed = quoted[0] if len(quoted) == 1 else f"{', '.join(quoted[:-1])} или {quoted[-1]}"
+    return f"Неверный тип отходов. Укажите {listed}"
+
+
+async def try_reserve(session: AsyncSession, warehouse_id: int, waste_type: str, quantity: int) -> bool:
+    # Условное списание: строка обновится, только если лимита все еще хватает.
+    # Проверка и вычитание выполняются одной командой в БД, поэтому два запроса не могут занять одно и то же место
+    result = await session.exec(
+        update(sql.WarehouseCapacity)
+        .where(sql.WarehouseCapacity.warehouse_id == warehouse_id,
+               sql.WarehouseCapacity.waste_type == waste_type,
+               sql.WarehouseCapacity.remaining >= quantity)
+        .values(remaining=sql.WarehouseCapacity.remaining - quantity)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
+
+async def release(session: AsyncSession, warehouse_id: int, waste_type: str, quantity: int) -> bool:
+    # Возврат места в хранилище тоже делаем одной командой, без чтения строки в Python
+    result = await session.exec(
+        update(sql.WarehouseCapacity)
+        .where(sql.WarehouseCapacity.warehouse_id == warehouse_id, sql.WarehouseCapacity.waste_type == waste_type)
+        .values(remaining=sql.WarehouseCapacity.remaining + quantity)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
+
+def capacity_join(waste_types):
+    # LEFT JOIN остатков хранилища по нужным типам отходов: строк столько, сколько типов принимает хранилище
+    return sql.WarehouseCapacity, and_(sql.WarehouseCapacity.warehouse_id == sql.Warehouse.id,
+                                       sql.WarehouseCapacity.waste_type.in_(waste_types))
+
+
+async def load_candidates(session: AsyncSession, org_ids,
+                          waste_types=WASTE_TYPES) -> Tuple[Dict[int, list], Dict[Tuple[int, str], int]]:
+    # Один запрос на все организации пакета: хранилища каждой организации по возрастанию расстояния
+    # и текущие остатки по каждому из запрошенных типов отходов
+    candidates = defaultdict(list)
+    capacity = {}
+    rows = (await session.exec(
+        select(sql.WarehouseAvailability.org_id, sql.WarehouseAvailability.dist, sql.Warehouse.id,
+               sql.Warehouse.name, sql.WarehouseCapacity.waste_type, sql.WarehouseCapacity.remaining)
+        .join(sql.Warehouse, sql.Warehouse.id == sql.WarehouseAvailability.warehouse_id)
+        .outerjoin(*capacity_join(set(waste_types)))
+        .where(sql.WarehouseAvailability.org_id.in_(set(org_ids)))
+        .order_by(sql.WarehouseAvailability.org_id, sql.WarehouseAvailability.dist, sql.Warehouse.id)
+    )).all()
+    for org_id, dist, warehouse_id, warehouse_name, waste_type, remaining in rows:
+        org_candidates = candidates[org_id]
+        if not org_candidates or org_candidates[-1][0] != warehouse_id:  # строки одного хранилища идут подряд
+            org_candidates.append((warehouse_id, warehouse_name, dist))
+        if waste_type is not None:
+            capacity[(warehouse_id, waste_type)] = remaining
+    return candidates, capacity
+
+
+def plan_greedy(candidates: list, capacity: Dict[Tuple[int, str], int], waste_type: str,
+                quantity: int) -> Tuple[List[dict], int]:
+    # Ближайшие хранилища заполняются первыми. capacity уменьшается, только если заявку удалось распределить целиком
+    remaining_quantity = quantity
+    transfer_data = []
+    for warehouse_id, warehouse_name, distance in candidates:
+        if remaining_quantity <= 0:
+            break
+        current_limit = capacity.get((warehouse_id, waste_type), 0)
+        if current_limit > 0:
+            deliver_quantity = min(current_limit, remaining_quantity)
+            remaining_quantity -= deliver_quantity
+            transfer_data.append({
+                "warehouse_id": warehouse_id,
+                "warehouse_name": warehouse_name,
+                "delivered_quantity": deliver_quantity,
+                "distance": distance
+            })
+    if remaining_quantity == 0:
+        for transfer in transfer_data:
+            capacity[(transfer["warehouse_id"], waste_type)] -= transfer["delivered_quantity"]
+    return transfer_data, remaining_quantity
+
+
+def shortage_message(remaining_quantity: int, quantity: int) -> str:
+    return (f"Невозможно переработать {remaining_quantity} из {quantity} единиц отходов: "
+            f"места в хранилищах недостаточно. Запрос на отправку отходов отменен")
+
+
+def plan_sequential(requests: List[Tuple[int, str, int]], candidates: Dict[int, list],
+                    capacity: Dict[Tuple[int, str], int]) -> List[Tuple[List[dict], int]]:
+    # Жадная стратегия: заявки распределяются по очереди, каждая - в ближайшие хранилища
+    return [plan_greedy(candidates[org_id], capacity, waste_type, quantity)
+            for org_id, waste_type, quantity in requests]
+
+
+async def allocate_batch(session: AsyncSession, requests: List[sql.TransferRequest], atomic: bool,
+                   planner: Callable = plan_sequential) -> Tuple[List[dict], bool]:
+    # Распределяет все заявки пакета в памяти по одному снимку остатков, затем списывает лимиты
+    # одним условным UPDATE на пару (хранилище, тип отходов). Если за это время остатки изменились
+    # другим запросом, откатываемся и пересчитываем план по свежим данным.
+    # planner - стратегия распределения (plan_sequential или optimizer.plan_optimal).
+    # Возвращает результаты по каждой заявке и признак того, что все заявки распределены
+    for _ in range(RESERVE_ATTEMPTS):
+        candidates, capacity = await load_candidates(session, (request.org_id for request in requests),
+                                                     {request.waste_type for request in requests})
+        results = []
+        valid_indexes = []
+        for index, request in enumerate(requests):
+            result = {
+                "organization_id": request.org_id,
+                "waste_type": request.waste_type,
+                "initial_quantity": request.quantity,
+                "transfer_data": [],
+            }
+            if request.waste_type not in WASTE_TYPES:
+                result["detail"] = waste_type_message()
+            elif not candidates.get(request.org_id):
+                result["detail"] = f"Нет доступных хранилищ для организации с id {request.org_id}"
+            else:
+                valid_indexes.append(index)
+            results.append(result)
+
+        # Планирование - чистые вычисления (для оптимальной стратегии заметные), поэтому не в event loop
+        plans = await run_in_threadpool(
+            planner, [(requests[index].org_id, requests[index].waste_type, requests[index].quantity)
+                      for index in valid_indexes], candidates, capacity
+        )
+        for index, (transfer_data, remaining_quantity) in zip(valid_indexes, plans):
+            if remaining_quantity > 0:
+                results[index]["detail"] = shortage_message(remaining_quantity, requests[index].quantity)
+            else:
+                results[index]["transfer_data"] = transfer_data
+        for result in results:
+            result["allocated"] = "detail" not in result
+
+        all_accepted = all(result["allocated"] for result in results)
+        if atomic and not all_accepted:
+            return results, False
+
+        totals = defaultdict(int)
+        reservations = []
+        for result in results:
+            for transfer in result["transfer_data"]:
+                totals[(transfer["warehouse_id"], result["waste_type"])] += transfer["delivered_quantity"]
+                reservations.append({
+                    "from_org": result["organization_id"],
+                    "to_warehouse": transfer["warehouse_id"],
+                    "waste_type": result["waste_type"],
+                    "quantity": transfer["delivered_quantity"],
+                    "accepted": True,
+                    "distance": transfer["distance"],
+                })
+        # Сортируем ключи, чтобы параллельные пакеты брали блокировки строк в одном порядке
+        for (warehouse_id, waste_type), total in sorted(totals.items()):
+            if not await try_reserve(session, warehouse_id, waste_type, total):
+                await session.rollback()
+                break
+        else:
+            await insert_reservations(session, reservations)
+            return results, all_accepted
+    raise HTTPException(
+        status_code=409,
+        detail="Не удалось забронировать место: остатки в хранилищах изменились, повторите запрос"
+    )
+
+
+async def insert_reservations(session: AsyncSession, reservations: List[dict]):
+    # Все строки Reservation одним executemany, дневные итоги для аналитики - одним upsert.
+    # distance (расстояние до хранилища) в Reservation не хранится, оно нужно только итогам
+    if reservations:
+        created_at = sql.utcnow()  # одно время на весь пакет, чтобы день брони и день в итогах совпадали
+        await session.exec(insert(sql.Reservation), params=[
+            {**{key: value for key, value in reservation.items() if key != "distance"}, "created_at": created_at}
+            for reservation in reservations
+        ])
+        await analytics.record_reserved(session, reservations, created_at.date())
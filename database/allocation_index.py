@@ -0,0 +1,319 @@
+import bisect
+import time
+from collections import OrderedDict, defaultdict
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from fastapi import HTTPException
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+import config
+import database.sql_models as sql
+from database import allocation
+
+
+# Индекс для распределения отходов в памяти процесса. Граф "организация -> хранилища" почти не меняется,
+# а остатки меняются только через этот сервис, поэтому transfer_waste не ходит в БД за списком хранилищ:
+# решение принимается в памяти, а в БД записывается результат (условные UPDATE + Reservation, одна транзакция).
+# БД остается источником истины: если условный UPDATE не прошел или в памяти не хватило места (остатки мог
+# изменить другой воркер uvicorn), данные организации перечитываются из БД и распределение повторяется.
+class AllocationIndex:
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._orgs: Dict[int, List[Tuple[int, int]]] = {}  # org_id -> [(расстояние, warehouse_id)] по возрастанию
+        self._warehouse_orgs: Dict[int, Dict[int, int]] = defaultdict(dict)  # warehouse_id -> {org_id: расстояние}
+        self._names: Dict[int, str] = {}
+        self._capacity: Dict[Tuple[int, str], int] = {}  # (warehouse_id, тип отходов) -> остаток
+        # (org_id, тип отходов) -> хранилища с ненулевым остатком по возрастанию расстояния.
+        # Заполнившиеся хранилища удаляются при просмотре, освободившиеся возвращаются в _set_capacity
+        self._open: Dict[Tuple[int, str], List[Tuple[int, int]]] = {}
+        # Списано в памяти, но еще не записано в БД параллельными запросами этого процесса.
+        # При перечитывании остатков из БД вычитается, иначе индекс вернул бы уже занятое место
+        self._pending: Dict[Tuple[int, str], int] = defaultdict(int)
+        # Кэш планов для quote: (org_id, тип отходов) -> (время расчета, [(warehouse_id, расстояние, остаток)] хранилищ
+        # с местом по возрастанию расстояния, id всех хранилищ организации). _quote_watchers: (warehouse_id, тип) ->
+        # организации, чьи планы зависят от остатка этого хранилища; изменение остатка удаляет только их.
+        # Записи _quote_watchers живут не дольше планов: _drop_quote убирает план отовсюду
+        self._quotes: OrderedDict = OrderedDict()
+        self._quote_watchers: Dict[Tuple[int, str], set] = {}
+        self.quote_hits = 0
+        self.quote_misses = 0
+
+    def _drop_quote(self, org_id: int, waste_type: str):
+        cached = self._quotes.pop((org_id, waste_type), None)
+        if cached is None:
+            return
+        for warehouse_id in cached[2]:
+            watchers = self._quote_watchers.get((warehouse_id, waste_type))
+            if watchers is not None:
+                watchers.discard(org_id)
+                if not watchers:
+                    del self._quote_watchers[(warehouse_id, waste_type)]
+
+    def _capacity_changed(self, warehouse_id: int, waste_type: str):
+        for org_id in list(self._quote_watchers.get((warehouse_id, waste_type), ())):
+            self._drop_quote(org_id, waste_type)
+
+    def _set_capacity(self, warehouse_id: int, waste_type: str, value: int):
+        key = (warehouse_id, waste_type)
+        previous = self._capacity.get(key, 0)
+        self._capacity[key] = value
+        if previous != value:
+            self._capacity_changed(warehouse_id, waste_type)
+        if previous <= 0 < value:
+            for org_id, distance in self._warehouse_orgs[warehouse_id].items():
+                open_list = self._open.get((org_id, waste_type))
+                if open_list is None:
+                    continue
+                entry = (distance, warehouse_id)
+                position = bisect.bisect_left(open_list, entry)
+                if position == len(open_list) or open_list[position] != entry:
+                    open_list.insert(position, entry)
+
+    def _load_rows(self, rows: Iterable, replace_orgs: Iterable[int] = ()):
+        # rows: (org_id, dist, warehouse_id, name, тип отходов, остаток) - по строке на каждый тип,
+        # который принимает хранилище; у хранилища без лимитов тип и остаток - None
+        for org_id in replace_orgs:
+            self._forget_org(org_id)
+        links = defaultdict(dict)
+        for org_id, dist, warehouse_id, warehouse_name, waste_type, remaining in rows:
+            links[org_id][warehouse_id] = dist
+            self._warehouse_orgs[warehouse_id][org_id] = dist
+            self._names[warehouse_id] = warehouse_name
+            if waste_type is not None:
+                pending = self._pending.get((warehouse_id, waste_type), 0)
+                self._set_capacity(warehouse_id, waste_type, remaining - pending)
+        for org_id, org_links in links.items():
+            self._orgs[org_id] = sorted((dist, warehouse_id) for warehouse_id, dist in org_links.items())
+
+    def _forget_org(self, org_id: int):
+        for _, warehouse_id in self._orgs.pop(org_id, []):
+            self._warehouse_orgs[warehouse_id].pop(org_id, None)
+        for waste_type in allocation.WASTE_TYPES:
+            self._open.pop((org_id, waste_type), None)
+            self._drop_quote(org_id, waste_type)
+
+    @staticmethod
+    def _query():
+        return (
+            select(sql.WarehouseAvailability.org_id, sql.WarehouseAvailability.dist, sql.Warehouse.id,
+                   sql.Warehouse.name, sql.WarehouseCapacity.waste_type, sql.WarehouseCapacity.remaining)
+            .join(sql.Warehouse, sql.Warehouse.id == sql.WarehouseAvailability.warehouse_id)
+            .outerjoin(*allocation.capacity_join(allocation.WASTE_TYPES))
+        )
+
+    async def rebuild(self, session: AsyncSession):
+        # Полная загрузка из таблиц (при старте приложения)
+        self.clear()
+        warehouses = (await session.exec(
+            select(sql.Warehouse.id, sql.Warehouse.name, sql.WarehouseCapacity.waste_type,
+                   sql.WarehouseCapacity.remaining)
+            .outerjoin(*allocation.capacity_join(allocation.WASTE_TYPES))
+        )).all()
+        for warehouse_id, warehouse_name, waste_type, remaining in warehouses:
+            self.add_warehouse(warehouse_id, warehouse_name, {} if waste_type is None else {waste_type: remaining})
+        links = (await session.exec(
+            select(sql.WarehouseAvailability.org_id, sql.WarehouseAvailability.warehouse_id,
+                   sql.WarehouseAvailability.dist)
+        )).all()
+        by_org = defaultdict(dict)
+        for org_id, warehouse_id, dist in links:
+            by_org[org_id][warehouse_id] = dist
+        for org_id, warehouses_dist in by_org.items():
+            self.add_org(org_id, warehouses_dist)
+
+    async def refresh_org(self, session: AsyncSession, org_id: int):
+        # Перечитывает хранилища организации и их остатки из БД
+        rows = (await session.exec(self._query().where(sql.WarehouseAvailability.org_id == org_id))).all()
+        self._load_rows(rows, replace_orgs=[org_id])
+
+    def add_warehouse(self, warehouse_id: int, warehouse_name: str, limits: Dict[str, int]):
+        self._names[warehouse_id] = warehouse_name
+        for waste_type, limit in limits.items():
+            self._set_capacity(warehouse_id, waste_type, limit)
+
+    def add_org(self, org_id: int, warehouses: Dict[int, int]):
+        # Новая организация и расстояния до хранилищ. Если каких-то хранилищ в индексе еще нет,
+        # организация будет загружена из БД при первом распределении
+        if all(warehouse_id in self._names for warehouse_id in warehouses):
+            self._forget_org(org_id)
+            for warehouse_id, distance in warehouses.items():
+                self._warehouse_orgs[warehouse_id][org_id] = distance
+            self._orgs[org_id] = sorted((distance, warehouse_id) for warehouse_id, distance in warehouses.items())
+
+    def forget_org(self, org_id: int):
+        # Связи организации изменились в БД (например, при импорте расстояний): она будет перечитана
+        # из БД при следующем распределении
+        self._forget_org(org_id)
+
+    def adjust(self, warehouse_id: int, waste_type: str, delta: int):
+        # Учитывает уже записанное в БД изменение остатка (отмена заказа, пакетное распределение)
+        key = (warehouse_id, waste_type)
+        if key in self._capacity:
+            self._set_capacity(warehouse_id, waste_type, self._capacity[key] + delta)
+
+    def _hold(self, waste_type: str, transfer_data: List[dict], sign: int):
+        for transfer in transfer_data:
+            key = (transfer["warehouse_id"], waste_type)
+            self._pending[key] += sign * transfer["delivered_quantity"]
+            if self._pending[key] == 0:
+                del self._pending[key]
+
+    def plan(self, org_id: int, waste_type: str, quantity: int) -> Tuple[List[dict], int]:
+        # Ближайшие хранилища заполняются первыми. Если заявку удалось распределить целиком,
+        # остатки в индексе сразу уменьшаются - до коммита, чтобы параллельные запросы их не заняли
+        open_list = self._open.get((org_id, waste_type))
+        if open_list is None:
+            open_list = [entry for entry in self._orgs.get(org_id, [])
+                         if self._capacity.get((entry[1], waste_type), 0) > 0]
+            self._open[(org_id, waste_type)] = open_list
+
+        remaining_quantity = quantity
+        transfer_data = []
+        position = 0
+        while position < len(open_list) and remaining_quantity > 0:
+            distance, warehouse_id = open_list[position]
+            current_limit = self._capacity.get((warehouse_id, waste_type), 0)
+            if current_limit <= 0:
+                del open_list[position]
+                continue
+            deliver_quantity = min(current_limit, remaining_quantity)
+            remaining_quantity -= deliver_quantity
+            transfer_data.append({
+                "warehouse_id": warehouse_id,
+                "warehouse_name": self._names[warehouse_id],
+                "delivered_quantity": deliver_quantity,
+                "distance": distance
+            })
+            position += 1
+        if remaining_quantity == 0:
+            for transfer in transfer_data:
+                self._capacity[(transfer["warehouse_id"], waste_type)] -= transfer["delivered_quantity"]
+                self._capacity_changed(transfer["warehouse_id"], waste_type)
+        return transfer_data, remaining_quantity
+
+    async def quote(self, session: AsyncSession, org_id: int, waste_type: str,
+                    quantity: int) -> Tuple[List[dict], int]:
+        # План, который сейчас построил бы allocate, но без списания и записи в БД: (план, сколько не поместилось).
+        # Без кэша остатки организации перечитываются из БД (их могли изменить другие воркеры uvicorn),
+        # повторный запрос в пределах config.quote_cache_ttl_s обходится без БД. Перечитывание обновляет общий
+        # индекс так же, как refresh_org в allocate: организация и остатки ее хранилищ заменяются данными из БД
+        # (за вычетом незаписанных отметок _pending), поэтому следующее распределение видит свежие остатки
+        key = (org_id, waste_type)
+        cached = self._quotes.get(key)
+        if cached is not None and time.monotonic() - cached[0] < config.quote_cache_ttl_s:
+            self._quotes.move_to_end(key)
+            self.quote_hits += 1
+        else:
+            self.quote_misses += 1
+            self._drop_quote(org_id, waste_type)  # устаревший план и его подписки
+            await self.refresh_org(session, org_id)
+            if not self._orgs.get(org_id):
+                raise HTTPException(
+                    status_code=404,
+                    detail=f"Нет доступных хранилищ для организации с id {org_id}"
+                )
+            snapshot, watched = [], []
+            for distance, warehouse_id in self._orgs[org_id]:
+                # Следим и за заполненными хранилищами: если в них освободится место, план изменится
+                self._quote_watchers.setdefault((warehouse_id, waste_type), set()).add(org_id)
+                watched.append(warehouse_id)
+                remaining = self._capacity.get((warehouse_id, waste_type), 0)
+                if remaining > 0:
+                    snapshot.append((warehouse_id, distance, remaining))
+            cached = self._quotes[key] = (time.monotonic(), snapshot, watched)
+            while len(self._quotes) > config.quote_cache_size:
+                self._drop_quote(*next(iter(self._quotes)))
+
+        remaining_quantity = quantity
+        transfer_data = []
+        for warehouse_id, distance, remaining in cached[1]:
+            if remaining_quantity <= 0:
+                break
+            deliver_quantity = min(remaining, remaining_quantity)
+            remaining_quantity -= deliver_quantity
+            transfer_data.append({
+                "warehouse_id": warehouse_id,
+                "warehouse_name": self._names[warehouse_id],
+                "delivered_quantity": deliver_quantity,
+                "distance": distance
+            })
+        return transfer_data, remaining_quantity
+
+    async def allocate(self, session: AsyncSession, org_id: int, waste_type: str, quantity: int,
+                       before_commit: Optional[Callable[[AsyncSession, List[dict]], Awaitable]] = None,
+                       savepoint: bool = False) -> List[dict]:
+        # Распределяет заявку, записывает ее в БД и фиксирует транзакцию. Возвращает план доставки.
+        # before_commit(сессия, план) дописывает в ту же транзакцию свои строки (например, ответ для Idempotency-Key).
+        # savepoint=True - заявка записывается в SAVEPOINT внутри уже открытой транзакции, а коммит делает
+        # вызывающий (database/write_batcher.py): отказ откатывает только эту заявку, а не всю транзакцию
+        refreshed = False
+        if org_id not in self._orgs:
+            await self.refresh_org(session, org_id)
+            refreshed = True
+        for _ in range(allocation.RESERVE_ATTEMPTS):
+            if not self._orgs.get(org_id):
+                raise HTTPException(
+                    status_code=404,
+                    detail=f"Нет доступных хранилищ для организации с id {org_id}"
+                )
+            transfer_data, remaining_quantity = self.plan(org_id, waste_type, quantity)
+            if remaining_quantity > 0:
+                if refreshed:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=allocation.shortage_message(remaining_quantity, quantity)
+                    )
+                # Место могли освободить в обход этого процесса - проверяем по БД, прежде чем отказать
+                await self.refresh_org(session, org_id)
+                refreshed = True
+                continue
+            self._hold(waste_type, transfer_data, 1)
+            held = True
+            nested = await session.begin_nested() if savepoint else None
+            try:
+                try:
+                    reserved = True
+                    for transfer in transfer_data:
+                        if not await allocation.try_reserve(session, transfer["warehouse_id"], waste_type,
+                                                            transfer["delivered_quantity"]):
+                            reserved = False
+                            break
+                    if reserved:
+                        await allocation.insert_reservations(session, [{
+                            "from_org": org_id,
+                            "to_warehouse": transfer["warehouse_id"],
+                            "waste_type": waste_type,
+                            "quantity": transfer["delivered_quantity"],
+                            "accepted": True,
+                            "distance": transfer["distance"],
+                        } for transfer in transfer_data])
+                        if before_commit is not None:
+                            await before_commit(session, transfer_data)
+                        # Отметку снимаем до коммита: если кто-то перечитает БД, пока коммит еще не виден, он лишь
+                        # переоценит остаток, и его условный UPDATE не пройдет. Обратный порядок занижал бы остаток
+                        self._hold(waste_type, transfer_data, -1)
+                        held = False
+                        await (nested.commit() if savepoint else session.commit())
+                        return transfer_data
+                finally:
+                    # И при отмене запроса (CancelledError - не Exception): иначе отметка навсегда занизит остаток.
+                    # Снимается до перечитывания организации ниже, чтобы та не вычла ее из остатков
+                    if held:
+                        self._hold(waste_type, transfer_data, -1)
+                        held = False
+            except BaseException:
+                await (nested.rollback() if savepoint else session.rollback())
+                await self.refresh_org(session, org_id)
+                raise
+            # Остаток в БД меньше, чем в памяти: откатываем списание и берем актуальные данные
+            await (nested.rollback() if savepoint else session.rollback())
+            await self.refresh_org(session, org_id)
+            refreshed = True
+        raise HTTPException(
+            status_code=409,
+            detail="Не удалось забронировать место: остатки в хранилищах изменились, повторите запрос"
+        )
+
+
+index = AllocationIndex()
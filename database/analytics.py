@@ -0,0 +1,104 @@
+from collections import defaultdict
+from datetime import date
+from typing import Dict, List, Optional, Sequence
+from sqlalchemy import bindparam, func, text
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+import database.sql_models as sql
+
+
+# Дневные итоги броней (ReservationDaily) обновляются вместе с бронями, а запросы аналитики читают только их
+KEY_COLUMNS = ("day", "org_id", "warehouse_id", "waste_type")
+COUNTERS = ("reserved_count", "reserved_quantity", "cancelled_count", "cancelled_quantity", "distance_sum")
+GROUP_COLUMNS = {
+    "day": sql.ReservationDaily.day,
+    "org_id": sql.ReservationDaily.org_id,
+    "warehouse_id": sql.ReservationDaily.warehouse_id,
+    "waste_type": sql.ReservationDaily.waste_type,
+}
+
+
+# INSERT ... ON CONFLICT DO UPDATE текстом, а не через sqlite.insert().on_conflict_do_update(): у последнего нет
+# ключа кэша SQLAlchemy, и он компилировался бы заново при каждой брони (~1 мс)
+UPSERT_ROLLUP = text(
+    f"INSERT INTO reservationdaily ({', '.join(KEY_COLUMNS + COUNTERS)}) "
+    f"VALUES ({', '.join(':' + column for column in KEY_COLUMNS + COUNTERS)}) "
+    f"ON CONFLICT ({', '.join(KEY_COLUMNS)}) DO UPDATE SET "
+    + ", ".join(f"{counter} = {counter} + excluded.{counter}" for counter in COUNTERS)
+).bindparams(bindparam("day", type_=sql.ReservationDaily.__table__.c.day.type))
+
+
+async def add_to_rollup(session: AsyncSession, totals: Dict[tuple, Dict[str, int]]):
+    # totals: {(день, организация, хранилище, тип): {счетчик: прибавка}}. Все строки - одним executemany
+    # INSERT ... ON CONFLICT DO UPDATE: новая строка создается, существующая увеличивается на прибавку
+    if not totals:
+        return
+    # Ключи сортируются, чтобы параллельные транзакции обновляли строки в одном порядке
+    await session.exec(UPSERT_ROLLUP, params=[
+        {**dict(zip(KEY_COLUMNS, key)), **{counter: values.get(counter, 0) for counter in COUNTERS}}
+        for key, values in sorted(totals.items())
+    ])
+
+
+async def record_reserved(session: AsyncSession, reservations: List[dict], day: date):
+    # reservations - строки Reservation, у каждой есть еще distance (расстояние до хранилища)
+    totals = defaultdict(lambda: defaultdict(int))
+    for reservation in reservations:
+        values = totals[(day, reservation["from_org"], reservation["to_warehouse"], reservation["waste_type"])]
+        values["reserved_count"] += 1
+        values["reserved_quantity"] += reservation["quantity"]
+        values["distance_sum"] += reservation["distance"]
+    await add_to_rollup(session, totals)
+
+
+async def record_cancelled(session: AsyncSession, rows):
+    # rows - (организация, хранилище, тип, количество, день создания брони в виде 'YYYY-MM-DD') отмененных броней
+    totals = defaultdict(lambda: defaultdict(int))
+    for org_id, warehouse_id, waste_type, quantity, day in rows:
+        values = totals[(date.fromisoformat(day), org_id, warehouse_id, waste_type)]
+        values["cancelled_count"] += 1
+        values["cancelled_quantity"] += quantity
+    await add_to_rollup(session, totals)
+
+
+async def get_stats(session: AsyncSession, group_by: Sequence[str], date_from: Optional[date] = None,
+                    date_to: Optional[date] = None, org_id: Optional[int] = None,
+                    warehouse_id: Optional[int] = None, waste_type: Optional[str] = None) -> List[dict]:
+    # Объем, доля отмен и среднее расстояние по выбранным разрезам (день, организация, хранилище, тип отходов).
+    # Без разрезов - одна строка с итогом за весь период
+    daily = sql.ReservationDaily
+    group_columns = [GROUP_COLUMNS[name].label(name) for name in dict.fromkeys(group_by)]
+    statement = select(
+        *group_columns,
+        func.sum(daily.reserved_count), func.sum(daily.reserved_quantity),
+        func.sum(daily.cancelled_count), func.sum(daily.cancelled_quantity), func.sum(daily.distance_sum)
+    ).group_by(*group_columns).order_by(*group_columns)
+    if date_from is not None:
+        statement = statement.where(daily.day >= date_from)
+    if date_to is not None:
+        statement = statement.where(daily.day <= date_to)
+    if org_id is not None:
+        statement = statement.where(daily.org_id == org_id)
+    if warehouse_id is not None:
+        statement = statement.where(daily.warehouse_id == warehouse_id)
+    if waste_type is not None:
+        statement = statement.where(daily.waste_type == waste_type)
+
+    stats = []
+    for row in (await session.exec(statement)).all():
+        keys = row[:len(group_columns)]
+        reserved_count, reserved_quantity, cancelled_count, cancelled_quantity, distance_sum = (
+            value or 0 for value in row[len(group_columns):]
+        )
+        if not group_columns and not reserved_count:  # за период нет ни одной брони
+            continue
+        stats.append({
+            **{column.name: key for column, key in zip(group_columns, keys)},
+            "reserved_count": reserved_count,
+            "reserved_quantity": reserved_quantity,
+            "cancelled_count": cancelled_count,
+            "cancelled_quantity": cancelled_quantity,
+            "cancellation_rate": cancelled_count / reserved_count if reserved_count else 0.0,
+            "average_distance": distance_sum / reserved_count if reserved_count else 0.0,
+        })
+    return stats
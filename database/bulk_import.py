@@ -0,0 +1,325 @@
+# Потоковый импорт хранилищ, организаций и расстояний из NDJSON или CSV.
+# Файл читается по строкам и обрабатывается пачками по config.import_chunk_size строк: ссылки на id проверяются
+# одним запросом IN на пачку, строки вставляются одним executemany, пачка фиксируется отдельной транзакцией.
+# Память не зависит от размера файла: в ней только текущая пачка и не больше config.import_max_errors ошибок.
+#   python -m database.bulk_import warehouses warehouses.csv
+#   python -m database.bulk_import orgs orgs.ndjson
+#   python -m database.bulk_import distances distances.csv
+import argparse
+import asyncio
+import codecs
+import csv
+import json
+from typing import AsyncIterable, AsyncIterator, Dict, List, Optional, Tuple
+from sqlalchemy import tuple_
+from sqlmodel import insert, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+import config
+import database.sql_models as sql
+from database import allocation, allocation_index, capacity
+from database.allocation_index import AllocationIndex
+
+
+async def iter_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[str]:
+    # Байты из тела запроса или файла -> строки. Декодер инкрементальный: символ может разорваться между кусками
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer.rstrip("\r")
+
+
+async def iter_ndjson(lines: AsyncIterable[str]) -> AsyncIterator[Tuple[int, dict | str]]:
+    # (номер строки, объект) или (номер строки, текст ошибки)
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            yield line_number, "Строка не является JSON-объектом"
+            continue
+        yield line_number, record if isinstance(record, dict) else "Строка не является JSON-объектом"
+
+
+async def iter_csv(lines: AsyncIterable[str]) -> AsyncIterator[Tuple[int, dict | str]]:
+    # Первая строка - заголовок. Запись с переводом строки внутри кавычек собирается из нескольких строк:
+    # запись закончена, когда число кавычек в ней четное
+    header = None
+    line_number = 0
+    record_start = 0
+    pending = []
+    async for line in lines:
+        line_number += 1
+        if not pending:
+            record_start = line_number
+            if not line.strip():
+                continue
+        pending.append(line)
+        text = "\n".join(pending)
+        if text.count('"') % 2:
+            continue
+        pending = []
+        values = next(csv.reader([text]))
+        if header is None:
+            header = [column.strip() for column in values]
+        elif len(values) != len(header):
+            yield record_start, f"Ожидается {len(header)} значений, получено {len(values)}"
+        else:
+            yield record_start, dict(zip(header, values))
+    if pending:
+        yield record_start, "Незакрытые кавычки в конце файла"
+
+
+def parse_records(chunks: AsyncIterable[bytes], file_format: str) -> AsyncIterator[Tuple[int, dict | str]]:
+    lines = iter_lines(chunks)
+    return iter_csv(lines) if file_format == "csv" else iter_ndjson(lines)
+
+
+def to_int(value, field: str) -> int:
+    # В NDJSON числа приходят числами, в CSV - строками
+    if isinstance(value, str) and value.strip().lstrip("-").isdigit():
+        return int(value)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    raise ValueError(f"Поле {field}: ожидается целое число")
+
+
+def optional_id(record: dict) -> Optional[int]:
+    value = record.get("id")
+    return None if value in (None, "") else to_int(value, "id")
+
+
+def required_name(record: dict) -> str:
+    name = record.get("name")
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError("Не указано название")
+    return name
+
+
+def parse_warehouse(record: dict) -> Tuple[Optional[int], str, Dict[str, int]]:
+    # Лимиты - поля <тип>_limit (и в NDJSON, и в CSV) и словарь limits (NDJSON), как в post /warehouses/.
+    # Пустая ячейка CSV - хранилище этот тип не принимает
+    limits = {}
+    for field, value in record.items():
+        if field.endswith("_limit") and value not in (None, ""):
+            limits[field.removesuffix("_limit")] = to_int(value, field)
+    extra_limits = record.get("limits") or {}
+    if not isinstance(extra_limits, dict):
+        raise ValueError("Поле limits: ожидается объект {тип отходов: лимит}")
+    for waste_type, value in extra_limits.items():
+        limits[waste_type] = to_int(value, f"limits.{waste_type}")
+    unknown_types = [waste_type for waste_type in limits if waste_type not in allocation.WASTE_TYPES]
+    if unknown_types:
+        raise ValueError(f"Неизвестные типы отходов: {', '.join(unknown_types)}")
+    return optional_id(record), required_name(record), limits
+
+
+def parse_org(record: dict) -> Tuple[Optional[int], str, Dict[int, int]]:
+    # Расстояния до хранилищ можно указать сразу (поле warehouses, как в post /orgs/) или отдельным файлом distances
+    warehouses = record.get("warehouses") or {}
+    if not isinstance(warehouses, dict):
+        raise ValueError("Поле warehouses: ожидается объект {id хранилища: расстояние}")
+    return optional_id(record), required_name(record), {
+        to_int(warehouse_id, "warehouses"): to_int(dist, f"warehouses.{warehouse_id}")
+        for warehouse_id, dist in warehouses.items()
+    }
+
+
+def parse_distance(record: dict) -> Tuple[int, int, int]:
+    return (to_int(record.get("org_id"), "org_id"), to_int(record.get("warehouse_id"), "warehouse_id"),
+            to_int(record.get("dist"), "dist"))
+
+
+async def existing_ids(session: AsyncSession, column, ids) -> set:
+    ids = set(ids)
+    if not ids:
+        return set()
+    return set((await session.exec(select(column).where(column.in_(ids)))).all())
+
+
+async def insert_returning_ids(session: AsyncSession, model, rows: List[dict]) -> List[int]:
+    # Возвращает id строк в их порядке. Строки с явным id вставляются как есть, остальные - executemany
+    # с RETURNING: SQLite присваивает им id = max(id) + 1 по порядку строк, поэтому возвращенные id по возрастанию
+    # соответствуют строкам. RETURNING с sort_by_parameter_order выполнил бы отдельную команду на каждую строку
+    explicit = [row for row in rows if row["id"] is not None]
+    automatic = [{key: value for key, value in row.items() if key != "id"} for row in rows if row["id"] is None]
+    if explicit:
+        await session.exec(insert(model.__table__), params=explicit)
+    assigned = iter([])
+    if automatic:
+        result = await session.exec(insert(model.__table__).returning(model.id), params=automatic)
+        assigned = iter(sorted(result.scalars()))
+    return [row["id"] if row["id"] is not None else next(assigned) for row in rows]
+
+
+@sql.retry_on_busy
+async def write_warehouses(chunk: List[tuple], *, session: AsyncSession,
+                           index: Optional[AllocationIndex]) -> Tuple[int, List[tuple]]:
+    # chunk: (номер строки, (id или None, название, лимиты)). Возвращает число добавленных строк и ошибки
+    taken = await existing_ids(session, sql.Warehouse.id, (row[0] for _, row in chunk if row[0] is not None))
+    accepted, errors = [], []
+    for line_number, (warehouse_id, name, limits) in chunk:
+        if warehouse_id is not None and warehouse_id in taken:
+            errors.append((line_number, f"Хранилище {warehouse_id} уже есть в базе данных"))
+            continue
+        if warehouse_id is not None:
+            taken.add(warehouse_id)
+        accepted.append((warehouse_id, name, limits))
+    if not accepted:
+        return 0, errors
+    ids = await insert_returning_ids(session, sql.Warehouse, [{"id": warehouse_id, "name": name}
+                                                               for warehouse_id, name, _ in accepted])
+    capacity_rows = [row for warehouse_id, (_, _, limits) in zip(ids, accepted)
+                     for row in capacity.capacity_rows(warehouse_id, limits)]
+    if capacity_rows:
+        await session.exec(insert(sql.WarehouseCapacity.__table__), params=capacity_rows)
+    await session.commit()
+    if index is not None:
+        for warehouse_id, (_, name, limits) in zip(ids, accepted):
+            index.add_warehouse(warehouse_id, name, limits)
+    return len(accepted), errors
+
+
+@sql.retry_on_busy
+async def write_orgs(chunk: List[tuple], *, session: AsyncSession,
+                     index: Optional[AllocationIndex]) -> Tuple[int, List[tuple]]:
+    # chunk: (номер строки, (id или None, название, {id хранилища: расстояние}))
+    taken = await existing_ids(session, sql.Organization.id, (row[0] for _, row in chunk if row[0] is not None))
+    known_warehouses = await existing_ids(session, sql.Warehouse.id,
+                                          (warehouse_id for _, row in chunk for warehouse_id in row[2]))
+    accepted, errors = [], []
+    for line_number, (org_id, name, warehouses) in chunk:
+        missing = [warehouse_id for warehouse_id in warehouses if warehouse_id not in known_warehouses]
+        if missing:
+            errors.append((line_number, f"Хранилище {missing[0]} не найдено"))
+        elif org_id is not None and org_id in taken:
+            errors.append((line_number, f"Организация {org_id} уже есть в базе данных"))
+        else:
+            if org_id is not None:
+                taken.add(org_id)
+            accepted.append((org_id, name, warehouses))
+    if not accepted:
+        return 0, errors
+    ids = await insert_returning_ids(session, sql.Organization, [{"id": org_id, "name": name}
+                                                                 for org_id, name, _ in accepted])
+    links = [{"org_id": org_id, "warehouse_id": warehouse_id, "dist": dist}
+             for org_id, (_, _, warehouses) in zip(ids, accepted) for warehouse_id, dist in warehouses.items()]
+    if links:
+        await session.exec(insert(sql.WarehouseAvailability.__table__), params=links)
+    await session.commit()
+    if index is not None:
+        for org_id, (_, _, warehouses) in zip(ids, accepted):
+            index.add_org(org_id, warehouses)
+    return len(accepted), errors
+
+
+@sql.retry_on_busy
+async def write_distances(chunk: List[tuple], *, session: AsyncSession,
+                          index: Optional[AllocationIndex]) -> Tuple[int, List[tuple]]:
+    # chunk: (номер строки, (org_id, warehouse_id, расстояние)). Пара организация-хранилище уникальна
+    known_orgs = await existing_ids(session, sql.Organization.id, (row[0] for _, row in chunk))
+    known_warehouses = await existing_ids(session, sql.Warehouse.id, (row[1] for _, row in chunk))
+    pairs = {(org_id, warehouse_id) for _, (org_id, warehouse_id, _) in chunk}
+    taken = set((await session.exec(
+        select(sql.WarehouseAvailability.org_id, sql.WarehouseAvailability.warehouse_id)
+        .where(tuple_(sql.WarehouseAvailability.org_id, sql.WarehouseAvailability.warehouse_id).in_(pairs))
+    )).all())
+    accepted, errors = [], []
+    for line_number, (org_id, warehouse_id, dist) in chunk:
+        if org_id not in known_orgs:
+            errors.append((line_number, f"Организация {org_id} не найдена"))
+        elif warehouse_id not in known_warehouses:
+            errors.append((line_number, f"Хранилище {warehouse_id} не найдено"))
+        elif (org_id, warehouse_id) in taken:
+            errors.append((line_number, f"Расстояние от организации {org_id} до хранилища {warehouse_id} уже задано"))
+        else:
+            taken.add((org_id, warehouse_id))
+            accepted.append({"org_id": org_id, "warehouse_id": warehouse_id, "dist": dist})
+    if not accepted:
+        return 0, errors
+    await session.exec(insert(sql.WarehouseAvailability.__table__), params=accepted)
+    await session.commit()
+    if index is not None:
+        for org_id in {row["org_id"] for row in accepted}:
+            index.forget_org(org_id)
+    return len(accepted), errors
+
+
+IMPORTERS = {
+    "warehouses": (parse_warehouse, write_warehouses),
+    "orgs": (parse_org, write_orgs),
+    "distances": (parse_distance, write_distances),
+}
+
+
+async def import_stream(session: AsyncSession, kind: str, chunks: AsyncIterable[bytes], file_format: str,
+                        index: Optional[AllocationIndex] = allocation_index.index) -> dict:
+    # kind - warehouses, orgs или distances. Ошибочные строки пропускаются и попадают в отчет с номером строки.
+    # index - индекс распределения, который нужно обновлять вместе с БД (None - не обновлять)
+    parse, write = IMPORTERS[kind]
+    report = {"imported": 0, "failed": 0, "errors": []}
+
+    def add_errors(errors):
+        report["failed"] += len(errors)
+        free_slots = config.import_max_errors - len(report["errors"])
+        report["errors"].extend({"line": line_number, "detail": detail}
+                                for line_number, detail in errors[:max(free_slots, 0)])
+
+    async def flush(chunk):
+        imported, errors = await write(chunk, session=session, index=index)
+        report["imported"] += imported
+        add_errors(errors)
+
+    chunk = []
+    async for line_number, record in parse_records(chunks, file_format):
+        try:
+            if isinstance(record, str):
+                raise ValueError(record)
+            chunk.append((line_number, parse(record)))
+        except ValueError as error:
+            add_errors([(line_number, str(error))])
+        if len(chunk) >= config.import_chunk_size:
+            await flush(chunk)
+            chunk = []
+    if chunk:
+        await flush(chunk)
+    report["errors"].sort(key=lambda error: error["line"])
+    return report
+
+
+async def read_file(path: str, chunk_size: int = 1 << 16) -> AsyncIterator[bytes]:
+    with open(path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            yield chunk
+
+
+async def import_file(kind: str, path: str, file_format: str) -> dict:
+    async with AsyncSession(sql.async_engine) as session:
+        # Индекс этого процесса никому не нужен: сервер прочитает новые данные из БД сам
+        return await import_stream(session, kind, read_file(path), file_format, index=None)
+
+
+def main():
+    # Импорт напрямую в БД из .env - например, до запуска сервера. Запущенный сервер подхватит новые
+    # организации при первом распределении; для импорта в работающее приложение удобнее post /import/...
+    parser = argparse.ArgumentParser(description="Импорт хранилищ, организаций и расстояний из NDJSON или CSV")
+    parser.add_argument("kind", choices=IMPORTERS)
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=["ndjson", "csv"], help="По умолчанию - по расширению файла")
+    args = parser.parse_args()
+
+    file_format = args.format or ("csv" if args.path.lower().endswith(".csv") else "ndjson")
+    sql.create_tables()
+    print(json.dumps(asyncio.run(import_file(args.kind, args.path, file_format)), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
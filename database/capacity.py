@@ -0,0 +1,37 @@
+from typing import Dict, List
+from sqlalchemy import and_, func
+from sqlalchemy.orm import aliased
+import database.sql_models as sql
+
+
+# Совместимость со старой схемой: лимиты хранятся в WarehouseCapacity по строке на тип отходов,
+# а WarehouseResponse, WarehouseRead и тело post /warehouses/ по-прежнему используют поля <тип>_limit
+LEGACY_WASTE_TYPES = ("bio", "plastic", "glass")
+
+
+def legacy_field(waste_type: str) -> str:
+    return f"{waste_type}_limit"
+
+
+def with_legacy_limits(statement):
+    # Добавляет к запросу по Warehouse колонки bio_limit, plastic_limit и glass_limit.
+    # Каждая - LEFT JOIN по первичному ключу WarehouseCapacity; если строки нет, тип не принимается (0)
+    for waste_type in LEGACY_WASTE_TYPES:
+        capacity = aliased(sql.WarehouseCapacity, name=f"capacity_{waste_type}")
+        statement = statement.outerjoin(
+            capacity, and_(capacity.warehouse_id == sql.Warehouse.id, capacity.waste_type == waste_type)
+        ).add_columns(func.coalesce(capacity.remaining, 0).label(legacy_field(waste_type)))
+    return statement
+
+
+def requested_limits(warehouse: sql.CreateWarehouse) -> Dict[str, int]:
+    # Все лимиты из тела запроса: прежние поля и словарь limits
+    data = warehouse.model_dump()
+    limits = {waste_type: data[legacy_field(waste_type)] for waste_type in LEGACY_WASTE_TYPES}
+    limits.update(warehouse.limits)
+    return limits
+
+
+def capacity_rows(warehouse_id: int, limits: Dict[str, int]) -> List[dict]:
+    return [{"warehouse_id": warehouse_id, "waste_type": waste_type, "remaining": remaining}
+            for waste_type, remaining in limits.items()]
@@ -0,0 +1,81 @@
+# Расстояния по координатам. У организаций и хранилищ могут быть широта и долгота (lat, lon); тогда расстояние
+# между ними не нужно вводить вручную: оно считается по формуле гаверсинуса (км по поверхности Земли) сразу
+# для всех кандидатов векторно в NumPy.
+# Пространственный индекс - сетка: поверхность разбита на ячейки CELL_DEGREES × CELL_DEGREES градусов, номер ячейки
+# хранится в колонке geo_cell (с индексом) у организации и хранилища. Кандидаты в радиусе ищутся запросом
+# geo_cell IN (ячейки, которые задевает круг), а не перебором всех объектов. Индекс живет в БД, поэтому его видят
+# все воркеры uvicorn сразу после коммита.
+import math
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+EARTH_RADIUS_KM = 6371.0088
+CELL_DEGREES = 0.5  # ~55 км по широте. Менять только вместе с пересчетом geo_cell в миграции
+GRID_COLUMNS = int(360 / CELL_DEGREES)
+MAX_CELLS = 5000  # если круг задевает больше ячеек, проще проверить все объекты с координатами
+
+
+def cell_of(lat: float, lon: float) -> int:
+    row = int((lat + 90) // CELL_DEGREES)
+    column = int(((lon + 180) % 360) // CELL_DEGREES)
+    return row * GRID_COLUMNS + column
+
+
+def coordinates(lat: Optional[float], lon: Optional[float]) -> Dict[str, Optional[float]]:
+    # Поля lat, lon и geo_cell для новой строки Organization или Warehouse
+    if lat is None or lon is None:
+        return {"lat": None, "lon": None, "geo_cell": None}
+    return {"lat": lat, "lon": lon, "geo_cell": cell_of(lat, lon)}
+
+
+def cells_within(lat: float, lon: float, radius_km: float) -> Optional[List[int]]:
+    # Ячейки сетки, которые задевает круг радиуса radius_km. Границы по долготе - точные для сферы:
+    # delta_lon = asin(sin(r) / cos(lat)); если круг накрывает полюс, берутся все долготы.
+    # None - ячеек слишком много, фильтровать по ним не нужно
+    angular_radius = radius_km / EARTH_RADIUS_KM
+    delta_lat = math.degrees(angular_radius)
+    low, high = max(lat - delta_lat, -90.0), min(lat + delta_lat, 90.0)
+    rows = range(int((low + 90) // CELL_DEGREES), int((high + 90) // CELL_DEGREES) + 1)
+    ratio = math.sin(angular_radius) / max(math.cos(math.radians(lat)), 1e-12)
+    if angular_radius >= math.pi / 2 or ratio >= 1 or high >= 90 or low <= -90:
+        columns = range(GRID_COLUMNS)
+    else:
+        delta_lon = math.degrees(math.asin(ratio))
+        first = int(((lon - delta_lon + 180) % 360) // CELL_DEGREES)
+        count = min(int(2 * delta_lon // CELL_DEGREES) + 2, GRID_COLUMNS)
+        columns = sorted({(first + offset) % GRID_COLUMNS for offset in range(count)})
+    if len(rows) * len(columns) > MAX_CELLS:
+        return None
+    return [row * GRID_COLUMNS + column for row in rows for column in columns]
+
+
+def haversine_km(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    # Расстояния от одной точки до массива точек, км
+    lat1, lon1 = math.radians(lat), math.radians(lon)
+    lat2, lon2 = np.radians(lats), np.radians(lons)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+async def nearby(session: AsyncSession, model, lat: float, lon: float, radius_km: float,
+                 limit: Optional[int] = None) -> List[Tuple[int, int]]:
+    # Объекты model (Organization или Warehouse) с координатами не дальше radius_km: [(id, расстояние в км)]
+    # по возрастанию расстояния, не больше limit ближайших. Один запрос по покрывающему индексу geo_cell.
+    # Строки читаются через Core, без ORM-обертки: кандидатов могут быть десятки тысяч
+    statement = select(model.id, model.lat, model.lon).where(model.geo_cell.is_not(None))
+    cells = cells_within(lat, lon, radius_km)
+    if cells is not None:
+        statement = statement.where(model.geo_cell.in_(cells))
+    rows = (await (await session.connection()).execute(statement)).all()
+    if not rows:
+        return []
+    # Row - не кортеж: np.array по строкам SQLAlchemy идет через медленный поиск ключей, поэтому сначала tuple
+    points = np.array([tuple(row) for row in rows], dtype=float)
+    distances = haversine_km(lat, lon, points[:, 1], points[:, 2])
+    inside = np.flatnonzero(distances <= radius_km)
+    if limit is not None and len(inside) > limit:
+        inside = inside[np.argpartition(distances[inside], limit - 1)[:limit]]
+    inside = inside[np.argsort(distances[inside], kind="stable")]
+    return [(int(points[position, 0]), int(round(distances[position]))) for position in inside]
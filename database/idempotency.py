@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import json
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from typing import Awaitable, Callable, Dict, Optional
+from fastapi import HTTPException, Response
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import bindparam, delete, text
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+import config
+import database.sql_models as sql
+
+
+# Ключи идемпотентности для бронирования (заголовок Idempotency-Key). Первый запрос с ключом сохраняет ответ
+# в той же транзакции, что и брони: либо записаны и брони, и ответ, либо ничего, поэтому "зависших" ключей
+# без ответа не бывает. Повтор в пределах config.idempotency_ttl_s получает сохраненный ответ без распределения.
+# Ответы с ошибкой не сохраняются: место при них не бронируется, и повтор просто выполняется заново.
+# Одновременные дубли: внутри процесса запросы с одним ключом выполняются по очереди (key_lock), второй находит
+# ответ первого. Между воркерами uvicorn решает первичный ключ таблицы: опоздавший получает DuplicateRequest,
+# его транзакция откатывается, и он отдает ответ победителя
+PURGE_EVERY = 100  # раз в сколько сохранений удалять устаревшие ключи и лишние сверх config.idempotency_max_keys
+
+
+class DuplicateRequest(Exception):
+    # Ответ с этим ключом уже сохранил параллельный запрос
+    pass
+
+
+_locks: Dict[tuple, list] = {}  # (scope, ключ) -> [asyncio.Lock, сколько запросов его ждет или держит]
+_stores = 0
+
+
+@asynccontextmanager
+async def key_lock(scope: str, key: str):
+    entry = _locks.setdefault((scope, key), [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:  # словарь содержит только ключи запросов, которые выполняются прямо сейчас
+            del _locks[(scope, key)]
+
+
+def fingerprint(payload) -> str:
+    return hashlib.blake2b(json.dumps(payload, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+
+def cutoff():
+    return sql.utcnow() - timedelta(seconds=config.idempotency_ttl_s)
+
+
+async def lookup(session: AsyncSession, scope: str, key: str, request_fingerprint: str) -> Optional[str]:
+    # Сохраненный ответ (JSON) или None, если запроса с этим ключом еще не было или срок ключа истек
+    row = (await session.exec(select(sql.IdempotencyKey.fingerprint, sql.IdempotencyKey.response).where(
+        sql.IdempotencyKey.scope == scope, sql.IdempotencyKey.key == key,
+        sql.IdempotencyKey.created_at >= cutoff()
+    ))).first()
+    if row is None:
+        return None
+    if row.fingerprint != request_fingerprint:
+        raise HTTPException(
+            status_code=422,
+            detail="Ключ Idempotency-Key уже использован для запроса с другими параметрами"
+        )
+    return row.response
+
+
+# Текстом, а не через sqlite.insert().on_conflict_do_update(): у него нет ключа кэша SQLAlchemy
+# (см. database/analytics.py). Устаревшая строка с тем же ключом перезаписывается, действующая - нет:
+# значит, ее только что записал параллельный запрос
+STORE = text(
+    "INSERT INTO idempotencykey (scope, key, fingerprint, response, created_at) "
+    "VALUES (:scope, :key, :fingerprint, :response, :created_at) "
+    "ON CONFLICT (scope, key) DO UPDATE SET fingerprint = excluded.fingerprint, response = excluded.response, "
+    "created_at = excluded.created_at WHERE idempotencykey.created_at < :cutoff RETURNING key"
+).bindparams(bindparam("created_at", type_=sql.IdempotencyKey.__table__.c.created_at.type),
+             bindparam("cutoff", type_=sql.IdempotencyKey.__table__.c.created_at.type))
+
+
+async def store(session: AsyncSession, scope: str, key: str, request_fingerprint: str, response: str):
+    # Вызывается в транзакции бронирования до коммита
+    global _stores
+    stored = (await session.exec(STORE, params={
+        "scope": scope, "key": key, "fingerprint": request_fingerprint, "response": response,
+        "created_at": sql.utcnow(), "cutoff": cutoff()
+    })).first()
+    if stored is None:
+        raise DuplicateRequest(key)
+    _stores += 1
+    if _stores % PURGE_EVERY == 0:
+        await purge(session)
+
+
+async def purge(session: AsyncSession):
+    # Размер таблицы ограничен: удаляются ключи старше срока и самые старые сверх config.idempotency_max_keys
+    table = sql.IdempotencyKey.__table__
+    await session.exec(delete(table).where(table.c.created_at < cutoff()))
+    newest = select(table.c.created_at).order_by(table.c.created_at.desc()).offset(config.idempotency_max_keys)
+    oldest_kept = (await session.exec(newest.limit(1))).first()
+    if oldest_kept is not None:
+        await session.exec(delete(table).where(table.c.created_at <= oldest_kept))
+
+
+async def run_once(session: AsyncSession, scope: str, key: str, payload, run: Callable[[Callable], Awaitable]):
+    # payload - параметры запроса. run(remember) выполняет запрос; remember(сессия, ответ) должен быть вызван
+    # в его транзакции до коммита. Повтор получает сохраненный ответ с заголовком Idempotent-Replayed
+    request_fingerprint = fingerprint(payload)
+    async with key_lock(scope, key):
+        stored = await lookup(session, scope, key, request_fingerprint)
+        if stored is None:
+            # Читающая транзакция завершается: запись в ней после чужого коммита получила бы SQLITE_BUSY_SNAPSHOT
+            await session.rollback()
+
+            async def remember(write_session: AsyncSession, response):
+                body = json.dumps(jsonable_encoder(response), ensure_ascii=False)
+                await store(write_session, scope, key, request_fingerprint, body)
+            try:
+                return await run(remember)
+            except DuplicateRequest:
+                await session.rollback()
+                stored = await lookup(session, scope, key, request_fingerprint)
+                if stored is None:
+                    raise HTTPException(
+                        status_code=409,
+                        detail="Запрос с этим ключом Idempotency-Key выполняется параллельно, повторите его позже"
+                    )
+    return Response(content=stored, media_type="application/json", headers={"Idempotent-Replayed": "true"})
@@ -0,0 +1,200 @@
+from sqlalchemy import Engine
+
+
+# Версионированные миграции схемы. create_all создает только недостающие таблицы, а изменения в уже
+# существующих таблицах (индексы, новые колонки) добавляются здесь, без drop_tables().
+# Номер примененной миграции хранится в PRAGMA user_version самого файла БД.
+# Новая миграция - новый элемент в конце списка; уже выпущенные миграции не меняются.
+# Команды должны быть идемпотентными (IF NOT EXISTS): на новой БД create_all уже создал все из моделей.
+# Шаг миграции - SQL-строка или функция от соединения, если шаг зависит от текущей схемы
+
+
+def move_limits_to_capacity_table(connection):
+    # Колонки <тип>_limit таблицы warehouse переносятся в строки warehousecapacity и удаляются.
+    # В новой БД этих колонок нет - делать ничего не нужно
+    columns = {row[1] for row in connection.exec_driver_sql("PRAGMA table_info(warehouse)")}
+    legacy_types = [waste_type for waste_type in ("bio", "plastic", "glass") if f"{waste_type}_limit" in columns]
+    if not legacy_types:
+        return
+    connection.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS warehousecapacity (warehouse_id INTEGER NOT NULL, waste_type VARCHAR NOT NULL, "
+        "remaining INTEGER NOT NULL, PRIMARY KEY (warehouse_id, waste_type), "
+        "FOREIGN KEY(warehouse_id) REFERENCES warehouse (id))"
+    )
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_warehousecapacity_free "
+        "ON warehousecapacity (waste_type, remaining, warehouse_id) WHERE remaining > 0"
+    )
+    for waste_type in legacy_types:
+        connection.exec_driver_sql(
+            f"INSERT OR IGNORE INTO warehousecapacity (warehouse_id, waste_type, remaining) "
+            f"SELECT id, '{waste_type}', {waste_type}_limit FROM warehouse"
+        )
+        connection.exec_driver_sql(f"ALTER TABLE warehouse DROP COLUMN {waste_type}_limit")
+
+
+def rebuild_free_capacity_index(connection):
+    if connection.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'warehousecapacity'"
+    ).first() is None:
+        return
+    connection.exec_driver_sql("DROP INDEX IF EXISTS ix_warehousecapacity_free")
+    connection.exec_driver_sql(
+        "CREATE INDEX ix_warehousecapacity_free ON warehousecapacity (waste_type, warehouse_id) WHERE remaining > 0"
+    )
+
+
+def add_reservation_timestamps(connection):
+    # Уже существующие брони считаются созданными в момент миграции. Подтверждать доставку раньше было нельзя,
+    # поэтому действующие (accepted = 1) брони считаются доставленными: иначе их отменила бы автоматическая отмена
+    columns = {row[1] for row in connection.exec_driver_sql("PRAGMA table_info(reservation)")}
+    if not columns:
+        return
+    if "created_at" not in columns:
+        connection.exec_driver_sql("ALTER TABLE reservation ADD COLUMN created_at DATETIME")
+        connection.exec_driver_sql("UPDATE reservation SET created_at = CURRENT_TIMESTAMP")
+    if "confirmed_at" not in columns:
+        connection.exec_driver_sql("ALTER TABLE reservation ADD COLUMN confirmed_at DATETIME")
+        connection.exec_driver_sql("UPDATE reservation SET confirmed_at = created_at WHERE accepted = 1")
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_reservation_pending ON reservation (created_at) "
+        "WHERE accepted = 1 AND confirmed_at IS NULL"
+    )
+
+
+def backfill_reservation_daily(connection):
+    # Дневные итоги по уже существующим броням. Расстояние берется из warehouseavailability: в самой брони
+    # его нет. Обычно таблицу итогов уже создал create_all
+    if connection.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'reservation'"
+    ).first() is None:
+        return
+    connection.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS reservationdaily (day DATE NOT NULL, org_id INTEGER NOT NULL, "
+        "warehouse_id INTEGER NOT NULL, waste_type VARCHAR NOT NULL, reserved_count INTEGER NOT NULL, "
+        "reserved_quantity INTEGER NOT NULL, cancelled_count INTEGER NOT NULL, "
+        "cancelled_quantity INTEGER NOT NULL, distance_sum INTEGER NOT NULL, "
+        "PRIMARY KEY (day, org_id, warehouse_id, waste_type), "
+        "FOREIGN KEY(org_id) REFERENCES organization (id), FOREIGN KEY(warehouse_id) REFERENCES warehouse (id))"
+    )
+    connection.exec_driver_sql(
+        "INSERT OR IGNORE INTO reservationdaily (day, org_id, warehouse_id, waste_type, reserved_count, "
+        "reserved_quantity, cancelled_count, cancelled_quantity, distance_sum) "
+        "SELECT date(r.created_at), r.from_org, r.to_warehouse, r.waste_type, COUNT(*), SUM(r.quantity), "
+        "SUM(r.accepted = 0), SUM(CASE WHEN r.accepted = 0 THEN r.quantity ELSE 0 END), SUM(COALESCE(a.dist, 0)) "
+        "FROM reservation r LEFT JOIN warehouseavailability a "
+        "ON a.org_id = r.from_org AND a.warehouse_id = r.to_warehouse "
+        "WHERE r.created_at IS NOT NULL "
+        "GROUP BY date(r.created_at), r.from_org, r.to_warehouse, r.waste_type"
+    )
+
+
+def add_remaining_to_free_capacity_index(connection):
+    if connection.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'warehousecapacity'"
+    ).first() is None:
+        return
+    connection.exec_driver_sql("DROP INDEX IF EXISTS ix_warehousecapacity_free")
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_warehousecapacity_free_remaining "
+        "ON warehousecapacity (waste_type, warehouse_id, remaining) WHERE remaining > 0"
+    )
+
+
+def add_coordinates(connection):
+    # Необязательные координаты и ячейка сетки (database/geo.py) у организаций и хранилищ
+    for table in ("organization", "warehouse"):
+        columns = {row[1] for row in connection.exec_driver_sql(f"PRAGMA table_info({table})")}
+        if not columns:
+            continue
+        for column, column_type in (("lat", "FLOAT"), ("lon", "FLOAT"), ("geo_cell", "INTEGER")):
+            if column not in columns:
+                connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        connection.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS ix_{table}_geo ON {table} (geo_cell, lat, lon)")
+
+
+MIGRATIONS = [
+    (
+        1,
+        "Покрывающий индекс для transfer_waste, уникальная пара (org_id, warehouse_id), индексы Reservation",
+        [
+            # Дубликаты пары организация-хранилище мешают уникальному индексу: оставляем самую раннюю запись
+            "DELETE FROM warehouseavailability WHERE id NOT IN "
+            "(SELECT MIN(id) FROM warehouseavailability GROUP BY org_id, warehouse_id)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_warehouseavailability_org_warehouse "
+            "ON warehouseavailability (org_id, warehouse_id)",
+            "CREATE INDEX IF NOT EXISTS ix_warehouseavailability_org_dist_warehouse "
+            "ON warehouseavailability (org_id, dist, warehouse_id)",
+            # Оба новых индекса начинаются с org_id, отдельный индекс по org_id больше не нужен
+            "DROP INDEX IF EXISTS ix_warehouseavailability_org_id",
+            "CREATE INDEX IF NOT EXISTS ix_reservation_from_org ON reservation (from_org)",
+            "CREATE INDEX IF NOT EXISTS ix_reservation_to_warehouse ON reservation (to_warehouse)",
+            "CREATE INDEX IF NOT EXISTS ix_reservation_accepted ON reservation (accepted)",
+        ],
+    ),
+    (
+        2,
+        "Лимиты хранилищ по типам отходов - в отдельной таблице warehousecapacity",
+        [move_limits_to_capacity_table],
+    ),
+    (
+        3,
+        "Частичный индекс warehousecapacity без remaining: дешевле списания и массовая вставка",
+        [rebuild_free_capacity_index],
+    ),
+    (
+        4,
+        "Время создания и подтверждения брони, индекс неподтвержденных броней для автоматической отмены",
+        [add_reservation_timestamps],
+    ),
+    (
+        5,
+        "Дневные итоги броней для аналитики (reservationdaily)",
+        [backfill_reservation_daily],
+    ),
+    (
+        6,
+        "Координаты организаций и хранилищ, индекс по ячейке сетки",
+        [add_coordinates],
+    ),
+    (
+        7,
+        "Покрывающий индекс (warehouse_id, org_id, dist) для постраничного списка организаций хранилища",
+        [
+            "CREATE INDEX IF NOT EXISTS ix_warehouseavailability_warehouse_org_dist "
+            "ON warehouseavailability (warehouse_id, org_id, dist)",
+            # Новый индекс начинается с warehouse_id и заменяет прежний
+            "DROP INDEX IF EXISTS ix_warehouseavailability_warehouse_id",
+        ],
+    ),
+    (
+        8,
+        "remaining в частичном индексе warehousecapacity: пороги свободного места в get /warehouses/ по индексу",
+        [add_remaining_to_free_capacity_index],
+    ),
+]
+
+
+def current_version(connection) -> int:
+    return connection.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def migrate(engine: Engine) -> int:
+    # BEGIN IMMEDIATE сразу берет блокировку на запись: если воркеры стартуют одновременно,
+    # миграции выполнит только первый, остальные дождутся его и увидят уже новую версию.
+    # Все непримененные миграции вместе с новым номером версии фиксируются одной транзакцией
+    with engine.connect() as connection:
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+        version = current_version(connection)
+        for number, description, statements in MIGRATIONS:
+            if number <= version:
+                continue
+            for statement in statements:
+                if callable(statement):
+                    statement(connection)
+                else:
+                    connection.exec_driver_sql(statement)
+            connection.exec_driver_sql(f"PRAGMA user_version = {number}")
+            version = number
+        connection.commit()
+    return version
@@ -0,0 +1,177 @@
+from typing import Dict, List, Optional
+from sqlalchemy import tuple_
+from sqlalchemy.orm import aliased
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+import config
+import database.sql_models as sql
+from database import capacity
+
+
+# Колонки, которых достаточно для ответа по хранилищу: забираем кортежи, а не ORM-объекты.
+# Лимиты добавляет capacity.with_legacy_limits
+# Функции ниже возвращают словари с ключами в порядке полей моделей ответа (sql.WarehouseResponse,
+# sql.OrganizationsWithWarehousesResponse, sql.WarehouseSearchResponse): из них response_cache.encode
+# собирает JSON без создания моделей pydantic
+WAREHOUSE_COLUMNS = (
+    sql.Warehouse.id,
+    sql.Warehouse.name,
+)
+
+
+async def build_org_responses(session: AsyncSession, orgs, org_filter=None) -> List[dict]:
+    # Расстояния всех переданных организаций - одним запросом, хранилища с лимитами - вторым, по одной строке
+    # на хранилище, а не на пару организация-хранилище. Группировка - в Python. Запросы идут через Core:
+    # нужны только кортежи, обработка строк ORM на больших страницах стоит дороже самого запроса
+    orgs = list(orgs)
+    if not orgs:
+        return []
+    if org_filter is None:
+        org_filter = sql.WarehouseAvailability.org_id.in_([org_id for org_id, _ in orgs])
+    connection = await session.connection()
+    links = (await connection.execute(
+        select(sql.WarehouseAvailability.org_id, sql.WarehouseAvailability.warehouse_id,
+               sql.WarehouseAvailability.dist)
+        .where(org_filter)
+        .order_by(sql.WarehouseAvailability.org_id, sql.WarehouseAvailability.warehouse_id)
+    )).all()
+    warehouses = {}
+    for warehouse_id, name, bio_limit, plastic_limit, glass_limit in (await connection.execute(
+        capacity.with_legacy_limits(select(*WAREHOUSE_COLUMNS).where(sql.Warehouse.id.in_(
+            select(sql.WarehouseAvailability.warehouse_id).where(org_filter).distinct()
+        )))
+    )).all():
+        warehouses[warehouse_id] = {
+            "warehouse_id": warehouse_id,
+            "warehouse_name": name,
+            "bio_limit": bio_limit,
+            "plastic_limit": plastic_limit,
+            "glass_limit": glass_limit,
+        }
+    grouped = {org_id: [] for org_id, _ in orgs}
+    for org_id, warehouse_id, dist in links:
+        grouped[org_id].append({**warehouses[warehouse_id], "distance": dist})
+    return [
+        {"organization_name": org_name, "organization_id": org_id, "warehouses": grouped[org_id]}
+        for org_id, org_name in orgs
+    ]
+
+
+async def get_orgs_page(session: AsyncSession, after_org_id: int = 0,
+                        limit: int = 100) -> List[dict]:
+    # Keyset-пагинация: следующая страница начинается после последнего id предыдущей, OFFSET не нужен
+    orgs = (await session.exec(
+        select(sql.Organization.id, sql.Organization.name)
+        .where(sql.Organization.id > after_org_id)
+        .order_by(sql.Organization.id)
+        .limit(limit)
+    )).all()
+    if not orgs:
+        return []
+    # На странице - все организации с id из этого диапазона: вместо IN из limit параметров хватает двух
+    return await build_org_responses(session, orgs, sql.WarehouseAvailability.org_id.between(orgs[0][0], orgs[-1][0]))
+
+
+async def get_org(session: AsyncSession, org_id: int) -> Optional[dict]:
+    org = (await session.exec(
+        select(sql.Organization.id, sql.Organization.name).where(sql.Organization.id == org_id)
+    )).one_or_none()
+    if org is None:
+        return None
+    return (await build_org_responses(session, [org]))[0]
+
+
+async def get_warehouse(session: AsyncSession, warehouse_id: int, after_org_id: int = 0,
+                        limit: Optional[int] = None) -> Optional[dict]:
+    warehouse = (await session.exec(capacity.with_legacy_limits(
+        select(*WAREHOUSE_COLUMNS).where(sql.Warehouse.id == warehouse_id)
+    ))).one_or_none()
+    if warehouse is None:
+        return None
+    _, name, bio_limit, plastic_limit, glass_limit = warehouse
+    # Список расстояний - тоже keyset-страница по org_id, ее читает индекс (warehouse_id, org_id, dist)
+    distances = (await (await session.connection()).execute(
+        select(sql.WarehouseAvailability.org_id, sql.WarehouseAvailability.dist)
+        .where(sql.WarehouseAvailability.warehouse_id == warehouse_id,
+               sql.WarehouseAvailability.org_id > after_org_id)
+        .order_by(sql.WarehouseAvailability.org_id)
+        .limit(limit)
+    )).all()
+    return {
+        "warehouse_id": warehouse_id,
+        "warehouse_name": name,
+        "bio_limit": bio_limit,
+        "plastic_limit": plastic_limit,
+        "glass_limit": glass_limit,
+        "distance": [{"org_id": org_id, "distance": dist} for org_id, dist in distances]
+    }
+
+
+async def search_warehouses(session: AsyncSession, min_free: Dict[str, int], org_id: Optional[int] = None,
+                            max_distance: Optional[int] = None, sort: str = "id", after_warehouse_id: int = 0,
+                            after_distance: Optional[int] = None,
+                            limit: int = 50) -> List[dict]:
+    # Keyset-пагинация по порядку сортировки. Если указана организация - индексы пары (org_id, warehouse_id)
+    # или (org_id, dist, warehouse_id), пороги проверяются поиском по первичному ключу WarehouseCapacity
+    # среди хранилищ организации. Без организации запрос ведет первый порог: хранилища со свободным местом
+    # этого типа по порядку id вместе с остатком читает покрывающий индекс ix_warehousecapacity_free_remaining.
+    # Условие remaining > 0 повторяет условие частичного индекса: из remaining >= q SQLite его не выводит
+    columns = [sql.Warehouse.id, sql.Warehouse.name]
+    if org_id is None and min_free:
+        (waste_type, quantity), *other = min_free.items()
+        min_free = dict(other)
+        free = aliased(sql.WarehouseCapacity, name="free")
+        statement = (
+            select(*columns)
+            .select_from(free)
+            .join(sql.Warehouse, sql.Warehouse.id == free.warehouse_id)
+            .where(free.waste_type == waste_type, free.remaining > 0, free.remaining >= quantity,
+                   free.warehouse_id > after_warehouse_id)
+            .order_by(free.warehouse_id)
+        )
+    elif org_id is None:
+        statement = select(*columns).where(sql.Warehouse.id > after_warehouse_id).order_by(sql.Warehouse.id)
+    else:
+        availability = sql.WarehouseAvailability
+        statement = (
+            select(*columns, availability.dist)
+            .join(sql.Warehouse, sql.Warehouse.id == availability.warehouse_id)
+            .where(availability.org_id == org_id)
+        )
+        if max_distance is not None:
+            statement = statement.where(availability.dist <= max_distance)
+        if sort == "distance":
+            if after_distance is not None:
+                statement = statement.where(
+                    tuple_(availability.dist, availability.warehouse_id) > (after_distance, after_warehouse_id)
+                )
+            statement = statement.order_by(availability.dist, availability.warehouse_id)
+        else:
+            statement = statement.where(availability.warehouse_id > after_warehouse_id).order_by(
+                availability.warehouse_id)
+    for waste_type, quantity in min_free.items():
+        free = aliased(sql.WarehouseCapacity, name=f"free_{waste_type}")
+        statement = statement.join(free, (free.warehouse_id == sql.Warehouse.id) & (free.waste_type == waste_type)
+                                   & (free.remaining >= quantity))
+    connection = await session.connection()
+    rows = (await connection.execute(statement.limit(limit))).all()
+    if not rows:
+        return []
+    # Остатки всех типов для страницы - одним запросом
+    remaining = {row[0]: {waste_type: 0 for waste_type in config.waste_types} for row in rows}
+    for warehouse_id, waste_type, quantity in (await connection.execute(
+        select(sql.WarehouseCapacity.warehouse_id, sql.WarehouseCapacity.waste_type,
+               sql.WarehouseCapacity.remaining)
+        .where(sql.WarehouseCapacity.warehouse_id.in_(remaining.keys()))
+    )).all():
+        if waste_type in remaining[warehouse_id]:
+            remaining[warehouse_id][waste_type] = quantity
+    return [
+        {
+            "warehouse_id": row[0],
+            "warehouse_name": row[1],
+            "remaining": remaining[row[0]],
+            "distance": row[2] if org_id is not None else None
+        }
+        for row in rows
+    ]
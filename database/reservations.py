@@ -0,0 +1,156 @@
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from typing import Dict, Iterable, List, Tuple
+from sqlalchemy import DateTime, bindparam, func, text
+from sqlmodel import select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+import config
+import database.sql_models as sql
+import database.analytics as analytics
+from database.allocation_index import AllocationIndex
+
+logger = logging.getLogger(__name__)
+
+
+async def refund(session: AsyncSession, totals: Dict[Tuple[int, str], int]):
+    # Возврат места одним executemany: по строке параметров на пару (хранилище, тип отходов), а не на каждую бронь
+    if not totals:
+        return
+    capacity = sql.WarehouseCapacity.__table__.c
+    await session.exec(
+        update(sql.WarehouseCapacity.__table__)
+        .where(capacity.warehouse_id == bindparam("refund_warehouse_id"),
+               capacity.waste_type == bindparam("refund_waste_type"))
+        .values(remaining=capacity.remaining + bindparam("refund_quantity")),
+        params=[{"refund_warehouse_id": warehouse_id, "refund_waste_type": waste_type, "refund_quantity": quantity}
+                for (warehouse_id, waste_type), quantity in totals.items()]
+    )
+
+
+async def refund_released(session: AsyncSession, rows) -> Dict[Tuple[int, str], int]:
+    # rows - (организация, хранилище, тип, количество, день создания) отмененных броней: место возвращается
+    # суммой по паре (хранилище, тип), отмены попадают в дневные итоги аналитики
+    rows = list(rows)
+    totals = defaultdict(int)
+    for _, warehouse_id, waste_type, quantity, _ in rows:
+        totals[(warehouse_id, waste_type)] += quantity
+    await refund(session, totals)
+    await analytics.record_cancelled(session, rows)
+    return totals
+
+
+async def cancel_orders(session: AsyncSession,
+                        order_ids: Iterable[int]) -> Tuple[List[int], Dict[Tuple[int, str], int]]:
+    # Условная отмена: UPDATE затрагивает только действующие брони (accepted = 1), поэтому уже отмененный заказ
+    # не вернет место второй раз - ни при повторном запросе, ни при одновременных. Возвращает id отмененных
+    # заказов и возвраты по (хранилище, тип)
+    order_ids = list(order_ids)
+    if not order_ids:
+        return [], {}
+    reservation = sql.Reservation.__table__.c
+    rows = (await session.exec(
+        update(sql.Reservation.__table__)
+        .where(reservation.id.in_(order_ids), reservation.accepted == True)
+        .values(accepted=False)
+        .returning(reservation.id, reservation.from_org, reservation.to_warehouse, reservation.waste_type,
+                   reservation.quantity, func.date(reservation.created_at))
+    )).all()
+    totals = await refund_released(session, (row[1:] for row in rows))
+    return [row[0] for row in rows], totals
+
+
+async def confirm_orders(session: AsyncSession, order_ids: Iterable[int]) -> List[int]:
+    # Подтверждение доставки действующих броней: после него бронь не истечет. Отмененный заказ
+    # так не вернуть - место под него уже освобождено
+    order_ids = list(order_ids)
+    if not order_ids:
+        return []
+    reservation = sql.Reservation.__table__.c
+    rows = (await session.exec(
+        update(sql.Reservation.__table__)
+        .where(reservation.id.in_(order_ids), reservation.accepted == True)
+        .values(confirmed_at=func.coalesce(reservation.confirmed_at, sql.utcnow()))
+        .returning(reservation.id)
+    )).all()
+    return [row[0] for row in rows]
+
+
+async def apply_order_updates(session: AsyncSession,
+                              updates: Dict[int, bool]) -> Tuple[List[dict], Dict[Tuple[int, str], int]]:
+    # Новые состояния заказов {id: accepted} в текущей транзакции: одна команда на отмену, одна на подтверждение
+    # и один запрос, чтобы объяснить, почему остальные заказы не изменились. Коммит - за вызывающим
+    cancelled, totals = await cancel_orders(
+        session, [order_id for order_id, accepted in updates.items() if not accepted]
+    )
+    confirmed = await confirm_orders(session, [order_id for order_id, accepted in updates.items() if accepted])
+    updated = set(cancelled) | set(confirmed)
+    unchanged = [order_id for order_id in updates if order_id not in updated]
+    found = set()
+    if unchanged:
+        found = set((await session.exec(
+            select(sql.Reservation.id).where(sql.Reservation.id.in_(unchanged))
+        )).all())
+    results = []
+    for order_id, accepted in updates.items():
+        result = {"order_id": order_id, "accepted": accepted, "updated": order_id in updated}
+        if order_id not in updated:
+            if order_id not in found:
+                result["detail"] = f"Заказа с id {order_id} нет в базе данных"
+            elif accepted:
+                result["detail"] = f"Заказ {order_id} отменен, подтвердить доставку нельзя"
+            else:
+                result["detail"] = f"Заказ {order_id} уже отменен, место не возвращается повторно"
+        results.append(result)
+    return results, totals
+
+
+# id самых старых неподтвержденных броней, созданных раньше :cutoff. Без статистики (ANALYZE) SQLite выбирает
+# индекс по accepted и сортирует все действующие брони, поэтому частичный индекс указан явно (INDEXED BY)
+EXPIRED_RESERVATIONS = (
+    "SELECT id FROM reservation INDEXED BY ix_reservation_pending "
+    "WHERE accepted = 1 AND confirmed_at IS NULL AND created_at < :cutoff ORDER BY created_at LIMIT :limit"
+)
+RELEASE_EXPIRED = text(
+    f"UPDATE reservation SET accepted = 0 WHERE id IN ({EXPIRED_RESERVATIONS}) "
+    f"RETURNING from_org, to_warehouse, waste_type, quantity, date(created_at)"
+).bindparams(bindparam("cutoff", type_=DateTime()))  # та же запись времени, что и в колонке created_at
+
+
+@sql.retry_on_busy
+async def release_expired(*, session: AsyncSession, cutoff, limit: int) -> Tuple[int, Dict[Tuple[int, str], int]]:
+    # Отменяет до limit самых старых неподтвержденных броней, созданных раньше cutoff, и возвращает их место.
+    # Выбор и отмена - одна команда UPDATE ... RETURNING, поэтому бронь не отменится дважды, даже если
+    # проверку одновременно запустили несколько воркеров. Возвращает число броней и возвраты по (хранилище, тип)
+    rows = (await session.exec(RELEASE_EXPIRED, params={"cutoff": cutoff, "limit": limit})).all()
+    totals = await refund_released(session, rows)
+    await session.commit()
+    return len(rows), totals
+
+
+async def sweep(index: AllocationIndex) -> int:
+    # Отменяет все просроченные брони пачками по config.reservation_sweep_batch, каждая пачка - своя транзакция
+    cutoff = sql.utcnow() - timedelta(seconds=config.reservation_ttl_s)
+    released = 0
+    while True:
+        async with AsyncSession(sql.async_engine) as session:
+            count, totals = await release_expired(session=session, cutoff=cutoff,
+                                                  limit=config.reservation_sweep_batch)
+        for (warehouse_id, waste_type), quantity in totals.items():
+            index.adjust(warehouse_id, waste_type, quantity)
+        released += count
+        if count < config.reservation_sweep_batch:
+            return released
+
+
+async def run_sweeper(index: AllocationIndex):
+    # Фоновая задача приложения: раз в config.reservation_sweep_interval_s секунд отменяет просроченные брони
+    while True:
+        await asyncio.sleep(config.reservation_sweep_interval_s)
+        try:
+            released = await sweep(index)
+            if released:
+                logger.info("Отменено просроченных броней: %s", released)
+        except Exception:
+            logger.exception("Не удалось отменить просроченные брони")
@@ -1,16 +1,36 @@
+import asyncio
+import functools
 import os
+import random
+from datetime import date, datetime, timezone
 from typing import Annotated, Optional, Dict, List
-from pydantic import BaseModel
+from pydantic import BaseModel, model_validator
 from fastapi import Depends
-from sqlalchemy import false
+from sqlalchemy import Index, event, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlmodel import Field, Session, SQLModel, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
 import config
+import metrics
+from database import migrations
+
+
+def utcnow() -> datetime:
+    # Время в БД хранится в UTC без часового пояса
+    return datetime.now(timezone.utc).replace(tzinfo=None)
 
 
 # Данные об организации. Информации о типах отходов здесь нет, потому что они будут в запросах на утилизацию
+# Координаты (lat, lon) необязательны; geo_cell - номер ячейки сетки для поиска соседей (database/geo.py).
+# Индекс по ячейке покрывающий: координаты кандидатов читаются из него, без обращения к строкам таблицы
 class Organization(SQLModel, table=True):
+    __table_args__ = (Index("ix_organization_geo", "geo_cell", "lat", "lon"),)
     id: Optional[int] = Field(default=None, primary_key=True)  # id будет присваиваться автоматически
     name: str = Field(default=..., description="Название организации")
+    lat: Optional[float] = Field(default=None)
+    lon: Optional[float] = Field(default=None)
+    geo_cell: Optional[int] = Field(default=None)
     model_config = {
         "json_schema_extra": {
             "examples": [
@@ -27,9 +47,33 @@ class Organization(SQLModel, table=True):
     }
 
 
-class CreateOrganization(SQLModel):
+# Необязательные координаты в теле post /orgs/ и post /warehouses/: указываются обе или ни одной.
+# Проверки моделей бросают ValueError (ValidationError pydantic), в ответ 422 их превращает main.body_validation_error
+class Coordinates(SQLModel):
+    lat: Optional[float] = Field(default=None, ge=-90, le=90, description="Широта, градусы")
+    lon: Optional[float] = Field(default=None, ge=-180, le=180, description="Долгота, градусы")
+
+    @model_validator(mode="after")
+    def check_coordinates(self):
+        if (self.lat is None) != (self.lon is None):
+            raise ValueError("Укажите обе координаты: lat и lon")
+        return self
+
+
+# Если у организации есть координаты, расстояния до хранилищ в радиусе config.geo_radius_km считаются
+# автоматически; указанные в warehouses расстояния важнее вычисленных
+class CreateOrganization(Coordinates):
     name: str
-    warehouses: Dict[int, int]  # id склада, расстояние до него от организации
+    warehouses: Optional[Dict[int, int]] = Field(default=None)  # id склада, расстояние до него от организации
+
+    @model_validator(mode="after")
+    def check_warehouses(self):
+        if self.warehouses is None:
+            if self.lat is None:
+                raise ValueError("Укажите хранилища (warehouses) или координаты организации (lat и lon)")
+            self.warehouses = {}
+        return self
+
     model_config = {
         "json_schema_extra": {
             "examples": [
@@ -47,11 +91,37 @@ class CreateOrganization(SQLModel):
 
 
 class Warehouse(SQLModel, table=True):
+    __table_args__ = (Index("ix_warehouse_geo", "geo_cell", "lat", "lon"),)
     id: Optional[int] = Field(default=None, primary_key=True)
+    name: str = Field(default=..., description="Название хранилища")
+    lat: Optional[float] = Field(default=None)
+    lon: Optional[float] = Field(default=None)
+    geo_cell: Optional[int] = Field(default=None)
+
+
+# Остаток места в хранилище по каждому типу отходов: одна строка на пару (хранилище, тип).
+# Новый тип отходов - новые строки, а не новая колонка. Частичный индекс содержит только строки со свободным
+# местом, поэтому "хранилища, где есть место для типа X" ищутся по индексу, а не перебором всех хранилищ.
+# remaining в индексе - для порогов свободного места в get /warehouses/: их проверяет сам индекс, без чтения
+# таблицы. Списание из-за этого обновляет и индекс (замер - ~2 мкс на UPDATE), новые хранилища по-прежнему
+# дописываются в конец индекса (массовый импорт)
+class WarehouseCapacity(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_warehousecapacity_free_remaining", "waste_type", "warehouse_id", "remaining",
+              sqlite_where=text("remaining > 0")),
+    )
+    warehouse_id: int = Field(default=..., primary_key=True, foreign_key="warehouse.id")
+    waste_type: str = Field(default=..., primary_key=True)
+    remaining: int = Field(default=...)
+
+
+# Тело post /warehouses/. Лимиты стекла, пластика и биоотходов - прежние поля API, остальные типы - в limits
+class CreateWarehouse(Coordinates):
     name: str = Field(default=..., description="Название хранилища")
     bio_limit: int = Field(default=...)
     plastic_limit: int = Field(default=...)
     glass_limit: int = Field(default=...)
+    limits: Dict[str, int] = Field(default={}, description="Лимиты остальных типов отходов, например {\"metal\": 100}")
 
     model_config = {
         "json_schema_extra": {
@@ -66,12 +136,46 @@ class Warehouse(SQLModel, table=True):
         }
     }
 
+    @model_validator(mode="before")
+    @classmethod
+    def check_limits(cls, data):
+        # Лимиты проверяем до pydantic, чтобы "10т" не превращалось в стандартную ошибку валидации
+        if isinstance(data, dict):
+            limits = [data[field] for field in ("bio_limit", "plastic_limit", "glass_limit") if field in data]
+            if isinstance(data.get("limits"), dict):
+                limits.extend(data["limits"].values())
+            if not all(isinstance(limit, int) for limit in limits):
+                raise ValueError("Указывая лимиты отходов, используйте только числа")
+        return data
+
+
+# Ответ post /warehouses/ - в том же виде, что и до переноса лимитов в WarehouseCapacity.
+# Координаты и число привязанных организаций есть в ответе, только если координаты указаны
+class WarehouseRead(SQLModel):
+    id: int
+    name: str
+    bio_limit: int
+    plastic_limit: int
+    glass_limit: int
+    lat: Optional[float] = None
+    lon: Optional[float] = None
+    linked_orgs: Optional[int] = None
+
 
 # Хранилища, доступные для конкретных организаций, расстояние между организациями и хранилищами
+# Индекс (org_id, dist, warehouse_id) покрывает запрос transfer_waste: хранилища организации сразу идут
+# по возрастанию расстояния, в таблицу лезть не нужно. Пара (org_id, warehouse_id) уникальна.
+# Имена индексов совпадают с database/migrations.py - там они добавляются в уже существующую БД
 class WarehouseAvailability(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_warehouseavailability_org_dist_warehouse", "org_id", "dist", "warehouse_id"),
+        Index("ux_warehouseavailability_org_warehouse", "org_id", "warehouse_id", unique=True),
+        # Организации хранилища по порядку id: страница списка расстояний в get /warehouses/{warehouse_id}/
+        Index("ix_warehouseavailability_warehouse_org_dist", "warehouse_id", "org_id", "dist"),
+    )
     id: Optional[int] = Field(default=None, primary_key=True)
-    org_id: int = Field(default=..., index=True, foreign_key="organization.id")
-    warehouse_id: int = Field(default=..., index=True, foreign_key="warehouse.id")
+    org_id: int = Field(default=..., foreign_key="organization.id")
+    warehouse_id: int = Field(default=..., foreign_key="warehouse.id")
     dist: int = Field(default=...)
 
 
@@ -79,15 +183,47 @@ class WarehouseAvailability(SQLModel, table=True):
 # Если отходы не доставят, сотрудник хранилища укажет в accepted False, бронь отменится, лимиты обновятся.
 # Каждая доставка сохраняется в отдельной строке (если ОО1 отдает 20 единиц стекла в МНО2 и 40 - в МНО3 в рамках
 # одной отправки, будет создано 2 заказа - по одному на хранилище)
-# Можно добавить функцию проверки для аналитики: сколько доставок отменили в конкретный период,
-# какая организация делает это чаще всего.
+# Аналитика (сколько доставок отменили в конкретный период, какая организация делает это чаще всего) считается
+# не по этой таблице, а по дневным итогам ReservationDaily.
+# Бронь без подтверждения доставки (confirmed_at) через config.reservation_ttl_s отменяется автоматически
+# (database/reservations.py). Частичный индекс содержит только такие брони, в порядке created_at
 class Reservation(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_reservation_pending", "created_at", sqlite_where=text("accepted = 1 AND confirmed_at IS NULL")),
+    )
     id: Optional[int] = Field(default=None, primary_key=True)
-    from_org: int = Field(default=..., foreign_key="organization.id")
-    to_warehouse: int = Field(default=..., foreign_key="warehouse.id")
+    from_org: int = Field(default=..., index=True, foreign_key="organization.id")
+    to_warehouse: int = Field(default=..., index=True, foreign_key="warehouse.id")
     waste_type: str = Field(default=..., description="Укажите тип отходов: стекло, пластик или биоотходы")
     quantity: int = Field(default=...)
-    accepted: bool = Field(default=None)
+    accepted: bool = Field(default=None, index=True)
+    created_at: Optional[datetime] = Field(default_factory=utcnow)
+    confirmed_at: Optional[datetime] = Field(default=None)
+
+
+# Дневные итоги броней для аналитики (database/analytics.py): строка на день создания брони, организацию,
+# хранилище и тип отходов. Обновляются в той же транзакции, что и сами брони, поэтому запросы аналитики
+# читают по строке на день, а не все брони. Отмена учитывается в дне создания брони
+class ReservationDaily(SQLModel, table=True):
+    day: date = Field(primary_key=True)
+    org_id: int = Field(primary_key=True, foreign_key="organization.id")
+    warehouse_id: int = Field(primary_key=True, foreign_key="warehouse.id")
+    waste_type: str = Field(primary_key=True)
+    reserved_count: int = Field(default=0)
+    reserved_quantity: int = Field(default=0)
+    cancelled_count: int = Field(default=0)
+    cancelled_quantity: int = Field(default=0)
+    distance_sum: int = Field(default=0)  # сумма расстояний по броням: среднее = distance_sum / reserved_count
+
+
+# Ответы на запросы бронирования с заголовком Idempotency-Key (database/idempotency.py): повтор запроса с тем же
+# ключом получает сохраненный ответ, а не бронирует место второй раз. Строка пишется в одной транзакции с бронями
+class IdempotencyKey(SQLModel, table=True):
+    scope: str = Field(primary_key=True)  # endpoint: один и тот же ключ у разных endpoint'ов - разные запросы
+    key: str = Field(primary_key=True)
+    fingerprint: str = Field(default=...)  # хэш параметров запроса
+    response: str = Field(default=...)  # тело ответа, JSON
+    created_at: datetime = Field(default_factory=utcnow, index=True)
 
 
 # Для обновления accepted: получены отходы или нет
@@ -107,6 +243,34 @@ class ReservationUpdate(BaseModel):
     }
 
 
+# Новое состояние одного заказа в пакетном запросе (patch /orders/)
+class OrderStatusUpdate(BaseModel):
+    order_id: int
+    accepted: bool
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {"order_id": 1, "accepted": True},
+                {"order_id": 2, "accepted": False}
+            ]
+        }
+    }
+
+
+# Одна заявка на утилизацию в пакетном запросе (post /transfer_waste/batch/)
+class TransferRequest(BaseModel):
+    org_id: int
+    waste_type: str
+    quantity: int = Field(default=..., gt=0)
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {"org_id": 1, "waste_type": "glass", "quantity": 20}
+            ]
+        }
+    }
+
+
 class WarehouseResponse(BaseModel):
     warehouse_id: int
     warehouse_name: str
@@ -116,24 +280,101 @@ class WarehouseResponse(BaseModel):
     distance: int | list  # int для одного хранилища (get /orgs/), list для нескольких (get /warehouses/{warehouse_id}/)
 
 
+# Хранилище в поиске get /warehouses/: остатки по всем типам отходов, расстояние - если указана организация
+class WarehouseSearchResponse(BaseModel):
+    warehouse_id: int
+    warehouse_name: str
+    remaining: Dict[str, int]
+    distance: Optional[int] = None
+
+
 class OrganizationsWithWarehousesResponse(BaseModel):
     organization_name: str
     organization_id: int
     warehouses: List[WarehouseResponse]
 
 
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    # Вызывается для каждого нового соединения в пуле: кроме journal_mode, эти настройки действуют только
+    # на текущее соединение
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={config.sqlite_journal_mode}")
+    cursor.execute(f"PRAGMA synchronous={config.sqlite_synchronous}")
+    cursor.execute(f"PRAGMA busy_timeout={config.sqlite_busy_timeout_ms}")
+    cursor.execute(f"PRAGMA cache_size=-{config.sqlite_cache_size_kib}")  # отрицательное значение - в КиБ
+    cursor.execute(f"PRAGMA mmap_size={config.sqlite_mmap_size}")
+    cursor.close()
+
+
+def engine_options() -> dict:
+    return {
+        "pool_size": config.db_pool_size,
+        "max_overflow": config.db_max_overflow,
+        "pool_timeout": config.db_pool_timeout,
+        "connect_args": {"timeout": config.sqlite_busy_timeout_ms / 1000},
+    }
+
+
 def create_db():
     if os.environ.get("TESTING") == "True":
-        return create_engine(config.test_db_url)
+        db_engine = create_engine(config.test_db_url, **engine_options())
+    else:
+        db_engine = create_engine(config.database_url, **engine_options())
+    event.listen(db_engine, "connect", apply_sqlite_pragmas)
+    if config.metrics_enabled:
+        metrics.instrument_engine(db_engine)
+    return db_engine
+
+
+def create_async_db():
+    if os.environ.get("TESTING") == "True":
+        db_engine = create_async_engine(config.test_async_db_url, **engine_options())
     else:
-        return create_engine(config.database_url)
+        db_engine = create_async_engine(config.async_database_url, **engine_options())
+    event.listen(db_engine.sync_engine, "connect", apply_sqlite_pragmas)
+    if config.metrics_enabled:
+        metrics.instrument_engine(db_engine.sync_engine)
+    return db_engine
 
 
 engine = create_db()
+async_engine = create_async_db()
+
+
+def is_busy_error(error: OperationalError) -> bool:
+    # SQLITE_BUSY/SQLITE_LOCKED: файл занят другой транзакцией (например, другим воркером uvicorn)
+    return (getattr(error.orig, "sqlite_errorname", None) in ("SQLITE_BUSY", "SQLITE_LOCKED")
+            or "database is locked" in str(error.orig))
+
+
+def retry_on_busy(endpoint):
+    # Повторяет пишущий обработчик целиком, если SQLite ответил "database is locked".
+    # Перед повтором транзакция откатывается, пауза растет экспоненциально (со случайным разбросом)
+    @functools.wraps(endpoint)
+    async def wrapper(*args, **kwargs):
+        for attempt in range(config.db_busy_retries + 1):
+            try:
+                return await endpoint(*args, **kwargs)
+            except OperationalError as error:
+                if attempt == config.db_busy_retries or not is_busy_error(error):
+                    raise
+                session = kwargs.get("session")
+                if session is not None:
+                    await session.rollback()
+                await asyncio.sleep(config.db_busy_backoff_ms / 1000 * 2 ** attempt * random.uniform(0.5, 1.5))
+    return wrapper
 
 
 def create_tables():
-    SQLModel.metadata.create_all(engine)
+    # Воркеры uvicorn стартуют одновременно: если таблицу успел создать соседний процесс, просто проверяем заново
+    for attempt in range(config.db_busy_retries + 1):
+        try:
+            SQLModel.metadata.create_all(engine)
+            migrations.migrate(engine)
+            return
+        except OperationalError as error:
+            if attempt == config.db_busy_retries or not (is_busy_error(error) or "already exists" in str(error.orig)):
+                raise
 
 
 def drop_tables():
@@ -147,3 +388,12 @@ def get_session():
 
 
 SessionDep = Annotated[Session, Depends(get_session)]
+
+
+# Асинхронная сессия для async-обработчиков: пока запрос ждет БД, event loop обслуживает другие запросы
+async def get_async_session():
+    async with AsyncSession(async_engine) as session:
+        yield session
+
+
+AsyncSessionDep = Annotated[AsyncSession, Depends(get_async_session)]
@@ -0,0 +1,127 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, List, Optional
+import config
+import database.sql_models as sql
+import metrics
+from database import allocation_index
+
+
+# Режим одного писателя для transfer_waste (config.write_batching). SQLite пропускает одного писателя за раз,
+# поэтому при нагрузке каждый запрос ждет блокировку записи и платит за свой коммит. Здесь запросы становятся
+# в очередь, а одна задача-писатель забирает из нее до config.write_batch_size заявок (или сколько придет
+# за config.write_batch_wait_ms после первой) и записывает их одной транзакцией: BEGIN IMMEDIATE, каждая заявка
+# в своем SAVEPOINT, один COMMIT. Отказ по заявке откатывает только ее SAVEPOINT - остальные заявки группы
+# не затрагиваются, и каждый запрос получает свой результат. Писатель один на процесс; воркеры uvicorn
+# по-прежнему конкурируют друг с другом за блокировку, но уже группами, а не по одному запросу.
+# Метрики: глубина очереди, размер группы, ожидание в очереди и длительность транзакции группы
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+metrics.registry.describe("write_batch_queue_depth", "Заявок transfer_waste в очереди писателя")
+metrics.registry.describe("write_batch_size", "Заявок в одной транзакции писателя")
+metrics.registry.describe("write_batch_wait_seconds", "Ожидание заявки в очереди писателя")
+metrics.registry.describe("write_batch_duration_seconds", "Длительность транзакции группы заявок")
+
+
+class Job:
+    def __init__(self, org_id: int, waste_type: str, quantity: int, before_commit: Optional[Callable]):
+        self.org_id = org_id
+        self.waste_type = waste_type
+        self.quantity = quantity
+        self.before_commit = before_commit
+        self.queued_at = time.perf_counter()
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class WriteBatcher:
+    def __init__(self, index: allocation_index.AllocationIndex):
+        self.index = index
+        self._loop = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def allocate(self, org_id: int, waste_type: str, quantity: int,
+                       before_commit: Optional[Callable[[sql.AsyncSession, List[dict]], Awaitable]] = None
+                       ) -> List[dict]:
+        # То же, что AllocationIndex.allocate, но запись - в транзакции группы. Писатель запускается при первой
+        # заявке (и заново, если event loop сменился - как в тестах без общего TestClient)
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run())
+        job = Job(org_id, waste_type, quantity, before_commit)
+        await self._queue.put(job)
+        return await job.future
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._loop = self._queue = self._task = None
+
+    async def _collect(self) -> List[Job]:
+        jobs = [await self._queue.get()]
+        deadline = time.perf_counter() + config.write_batch_wait_ms / 1000
+        while len(jobs) < config.write_batch_size:
+            if not self._queue.empty():
+                jobs.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                jobs.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return jobs
+
+    async def _run(self):
+        while True:
+            jobs = await self._collect()
+            try:
+                await self._write(jobs)
+            except Exception as error:  # писатель не должен останавливаться: ошибку получают запросы группы
+                for job in jobs:
+                    resolve(job, error=error)
+
+    async def _write(self, jobs: List[Job]):
+        started = time.perf_counter()
+        metrics.registry.observe("write_batch_size", BATCH_SIZE_BUCKETS, (), len(jobs))
+        for job in jobs:
+            metrics.registry.observe("write_batch_wait_seconds", metrics.LATENCY_BUCKETS, (), started - job.queued_at)
+        results = {}
+        async with sql.AsyncSession(sql.async_engine) as session:
+            # Блокировка записи берется сразу: внутри группы не будет SQLITE_BUSY_SNAPSHOT, а SAVEPOINT
+            # не станет началом транзакции, которое RELEASE зафиксировал бы раньше времени
+            await (await session.connection()).exec_driver_sql("BEGIN IMMEDIATE")
+            for job in jobs:
+                try:
+                    results[job] = await self.index.allocate(session, job.org_id, job.waste_type, job.quantity,
+                                                             job.before_commit, savepoint=True)
+                except Exception as error:  # HTTPException (нет места, нет организации) и прочие - только этой заявке
+                    resolve(job, error=error)
+            try:
+                await session.commit()
+            except Exception:
+                await session.rollback()
+                for org_id in {job.org_id for job in results}:  # в памяти остатки уже списаны - перечитываем
+                    await self.index.refresh_org(session, org_id)
+                raise
+        metrics.registry.observe("write_batch_duration_seconds", metrics.LATENCY_BUCKETS, (),
+                                 time.perf_counter() - started)
+        for job, transfer_data in results.items():
+            resolve(job, transfer_data)
+
+
+def resolve(job: Job, transfer_data: Optional[List[dict]] = None, error: Optional[Exception] = None):
+    if job.future.done():  # запрос уже отменен: клиент не дождался ответа
+        return
+    if error is not None:
+        job.future.set_exception(error)
+    else:
+        job.future.set_result(transfer_data)
+
+
+batcher = WriteBatcher(allocation_index.index)
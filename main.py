@@ -1,7 +1,29 @@
-from fastapi import FastAPI, HTTPException
-from sqlmodel import select
-from typing import List
+import asyncio
+from datetime import date, datetime
+from fastapi import Body, FastAPI, Header, HTTPException, Query, Request
+from fastapi.exception_handlers import request_validation_exception_handler
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import TypeAdapter
+from sqlmodel import insert
+from typing import Callable, Dict, List, Literal, Optional
+import config
 import database.sql_models as sql
+import database.queries as queries
+import database.capacity as capacity
+import database.allocation as allocation
+import database.allocation_index as allocation_index
+import database.bulk_import as bulk_import
+import database.reservations as reservations
+import database.analytics as analytics
+import database.export as export
+import database.geo as geo
+import database.idempotency as idempotency
+import database.write_batcher as write_batcher
+import metrics
+import optimizer
+import response_cache
+from response_cache import cached_json
 from testing.testing_script import generate_test_data
 
 
@@ -9,14 +31,40 @@ description = ("Если нужно создать несколько новых
                "`post /warehouses/`, а затем `post /orgs/`. "
                "При создании организации можно указать доступные хранилища и расстояние до них.")
 app = FastAPI(title="Система учета отходов", description=description)
+if config.metrics_enabled:
+    app.add_middleware(metrics.MetricsMiddleware)
+background_tasks = set()
 
 
 @app.on_event("startup")  # если базы данных нет, она создается при запуске приложения
-def on_startup():
+async def on_startup():
     try:
         sql.create_tables()
     except FileExistsError:
         pass
+    if config.allocation_index_preload:  # индекс для transfer_waste строится по таблицам заранее
+        async with sql.AsyncSession(sql.async_engine) as session:
+            await allocation_index.index.rebuild(session)
+    if config.reservation_ttl_s > 0:  # брони без подтверждения доставки отменяются по истечении срока
+        background_tasks.add(asyncio.create_task(reservations.run_sweeper(allocation_index.index)))
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    await write_batcher.batcher.stop()
+
+
+@app.exception_handler(RequestValidationError)
+async def body_validation_error(request: Request, exc: RequestValidationError):
+    # Проверки тела целиком (ValueError в model_validator моделей database/sql_models.py) отвечают одной строкой
+    # в detail, как раньше проверки в обработчиках. Ошибки отдельных полей - стандартный ответ FastAPI
+    for error in exc.errors():
+        if error["type"] == "value_error" and tuple(error["loc"]) == ("body",):
+            return JSONResponse(status_code=422, content={"detail": str(error["ctx"]["error"])})
+    return await request_validation_exception_handler(request, exc)
 
 
 @app.get("/")
@@ -30,268 +78,489 @@ def start_message():
 @app.put("/testing/", summary="Если БД пуста, в нее можно добавить уже готовые тестовые данные")
 def generate_data():
     generate_test_data()
+    allocation_index.index.clear()
+    response_cache.cache.clear()
     return {"message": "Данные добавлены, можно тестировать"}
 
 
-@app.post("/warehouses/", status_code=201, summary="Добавление хранилища")
-def add_warehouse(warehouse: sql.Warehouse, session: sql.SessionDep) -> sql.Warehouse:
-    new_warehouse = sql.Warehouse(name=warehouse.name,
-                                  bio_limit=warehouse.bio_limit,
-                                  plastic_limit=warehouse.plastic_limit,
-                                  glass_limit=warehouse.glass_limit)
-    if not all(isinstance(limit, int) for limit in [new_warehouse.bio_limit, new_warehouse.plastic_limit, new_warehouse.glass_limit]):
+@app.post("/warehouses/", status_code=201, summary="Добавление хранилища", response_model_exclude_none=True)
+@sql.retry_on_busy
+async def add_warehouse(warehouse: sql.CreateWarehouse, session: sql.AsyncSessionDep) -> sql.WarehouseRead:
+    limits = capacity.requested_limits(warehouse)  # нечисловые лимиты отклоняет сама модель CreateWarehouse
+    unknown_types = [waste_type for waste_type in limits if waste_type not in allocation.WASTE_TYPES]
+    if unknown_types:
         raise HTTPException(
             status_code=422,
-            detail="Указывая лимиты отходов, используйте только числа"
+            detail=f"Неизвестные типы отходов: {', '.join(unknown_types)}"
         )
+    new_warehouse = sql.Warehouse(name=warehouse.name, **geo.coordinates(warehouse.lat, warehouse.lon))
     session.add(new_warehouse)
-    session.commit()
-    session.refresh(new_warehouse)
-    return new_warehouse
+    await session.flush()  # id нужен для строк с лимитами, хранилище и лимиты сохраняются одной транзакцией
+    warehouse_id = new_warehouse.id
+    await session.exec(insert(sql.WarehouseCapacity), params=capacity.capacity_rows(warehouse_id, limits))
+    linked_orgs = []
+    if warehouse.lat is not None:
+        # Организации с координатами в радиусе config.geo_radius_km сразу получают расстояние до нового хранилища
+        linked_orgs = await geo.nearby(session, sql.Organization, warehouse.lat, warehouse.lon, config.geo_radius_km)
+        if linked_orgs:
+            await session.exec(insert(sql.WarehouseAvailability), params=[
+                {"org_id": org_id, "warehouse_id": warehouse_id, "dist": distance} for org_id, distance in linked_orgs
+            ])
+    await session.commit()
+    allocation_index.index.add_warehouse(warehouse_id, warehouse.name, limits)
+    for org_id, _ in linked_orgs:  # перечитаются из БД при следующем распределении
+        allocation_index.index.forget_org(org_id)
+    response_cache.cache.bump()
+    legacy_limits = {capacity.legacy_field(waste_type): limits[waste_type]
+                     for waste_type in capacity.LEGACY_WASTE_TYPES}
+    return sql.WarehouseRead(id=warehouse_id, name=warehouse.name, lat=warehouse.lat, lon=warehouse.lon,
+                             linked_orgs=len(linked_orgs) if warehouse.lat is not None else None, **legacy_limits)
 
 
 @app.post("/orgs/", status_code=201, summary="Добавление организации")
-def add_org(org: sql.CreateOrganization, session: sql.SessionDep) -> sql.Organization:
-    new_org = sql.Organization(name=org.name)  # id добавится автоматически
+@sql.retry_on_busy
+async def add_org(org: sql.CreateOrganization, session: sql.AsyncSessionDep) -> sql.Organization:
+    new_org = sql.Organization(name=org.name, **geo.coordinates(org.lat, org.lon))  # id добавится автоматически
     session.add(new_org)
-    session.commit()
-    session.refresh(new_org)
-
-    warehouses = session.exec(select(sql.Warehouse)).all()
-    warehouses_id_list = [warehouse.id for warehouse in warehouses]
-
-    # в warehouse_availability добавляем список доступных хранилищ и расстояний до них
-    for warehouse_id, distance in org.warehouses.items():
-        if warehouse_id in warehouses_id_list:
-            warehouse_availability = sql.WarehouseAvailability(
-                org_id=new_org.id,
-                warehouse_id=warehouse_id,
-                dist=distance
-            )
-            session.add(warehouse_availability)
-        else:
+    await session.flush()  # получаем id без коммита: организация и ее хранилища сохраняются одной транзакцией
+
+    # проверяем только указанные хранилища, одним запросом
+    warehouses_id_list = await bulk_import.existing_ids(session, sql.Warehouse.id, org.warehouses)
+    for warehouse_id in org.warehouses:
+        if warehouse_id not in warehouses_id_list:
             raise HTTPException(
                 status_code=404,
                 detail=f"Хранилище {warehouse_id} не найдено"
             )
-    session.commit()
+    warehouses = dict(org.warehouses)
+    if org.lat is not None:
+        # ближайшие config.geo_max_links хранилищ в радиусе config.geo_radius_km; указанные вручную расстояния важнее
+        for warehouse_id, distance in await geo.nearby(session, sql.Warehouse, org.lat, org.lon,
+                                                       config.geo_radius_km, config.geo_max_links):
+            warehouses.setdefault(warehouse_id, distance)
+
+    # в warehouse_availability добавляем список доступных хранилищ и расстояний до них, одним executemany
+    org_id = new_org.id
+    if warehouses:
+        await session.exec(insert(sql.WarehouseAvailability), params=[
+            {"org_id": org_id, "warehouse_id": warehouse_id, "dist": distance}
+            for warehouse_id, distance in warehouses.items()
+        ])
+    await session.commit()
+    allocation_index.index.add_org(org_id, warehouses)
+    response_cache.cache.bump()
     return new_org
 
 
-@app.get("/orgs/", summary="Информация обо всех организациях и хранилищах")
-async def get_org_and_warehouses(session: sql.SessionDep) -> List[sql.OrganizationsWithWarehousesResponse]:
-    orgs = session.exec(select(sql.Organization)).all()
-    response = []
-    for organization in orgs:
-        query = (
-            select(sql.Warehouse)
-            .join(sql.WarehouseAvailability, sql.WarehouseAvailability.warehouse_id == sql.Warehouse.id)
-            .where(sql.WarehouseAvailability.org_id == organization.id)
-        )
+ORGS_PAGE = TypeAdapter(List[sql.OrganizationsWithWarehousesResponse])
+ORG = TypeAdapter(sql.OrganizationsWithWarehousesResponse)
+WAREHOUSE = TypeAdapter(sql.WarehouseResponse)
+WAREHOUSES_PAGE = TypeAdapter(List[sql.WarehouseSearchResponse])
 
-        warehouses = session.exec(query).all()
-        warehouses_response = []
-        for warehouse in warehouses:
-            availability = session.exec(
-                select(sql.WarehouseAvailability)
-                .where(
-                    sql.WarehouseAvailability.warehouse_id == warehouse.id,
-                    sql.WarehouseAvailability.org_id == organization.id
-                )
-            ).one_or_none()
-            if availability:
-                warehouses_response.append(
-                    sql.WarehouseResponse(
-                        warehouse_id=warehouse.id,
-                        warehouse_name=warehouse.name,
-                        distance=availability.dist,
-                        bio_limit=warehouse.bio_limit,
-                        plastic_limit=warehouse.plastic_limit,
-                        glass_limit=warehouse.glass_limit,
-                    )
-                )
-
-        response.append(
-            sql.OrganizationsWithWarehousesResponse(
-                organization_name=organization.name,
-                organization_id=organization.id,
-                warehouses=warehouses_response
-            )
-        )
-    return response
 
+# Четыре GET ниже отвечают из кэша (response_cache.py) с заголовком ETag; If-None-Match с тем же ETag - ответ 304
+@app.get("/orgs/", summary="Информация обо всех организациях и хранилищах",
+         response_model=List[sql.OrganizationsWithWarehousesResponse])
+async def get_org_and_warehouses(
+        request: Request,
+        session: sql.AsyncSessionDep,
+        after_org_id: int = Query(default=0, ge=0, description="id последней организации с предыдущей страницы"),
+        limit: int = Query(default=100, ge=1, le=1000, description="Количество организаций на странице")
+):
+    return await cached_json(request, lambda: queries.get_orgs_page(session, after_org_id, limit), ORGS_PAGE)
 
-@app.get("/orgs/{org_id}/", summary="Информация о конкретной организации")
-async def get_specific_org(org_id: int, session: sql.SessionDep) -> sql.OrganizationsWithWarehousesResponse:
-    org = session.get(sql.Organization, org_id)
-    if not org:
-        raise HTTPException(
-            status_code=404,
-            detail=f"Организации с id {org_id} нет в базе данных"
-        )
 
-    query = (
-        select(sql.Warehouse)
-        .join(sql.WarehouseAvailability, sql.WarehouseAvailability.warehouse_id == sql.Warehouse.id)
-        .where(sql.WarehouseAvailability.org_id == org.id)
-    )
-    warehouses = session.exec(query).all()
-    warehouses_response = []
-    for warehouse in warehouses:
-        availability = session.exec(
-            select(sql.WarehouseAvailability)
-            .where(
-                sql.WarehouseAvailability.warehouse_id == warehouse.id,
-                sql.WarehouseAvailability.org_id == org.id
-            )
-        ).one_or_none()
-        if availability:
-            warehouses_response.append(
-                sql.WarehouseResponse(
-                    warehouse_id=warehouse.id,
-                    warehouse_name=warehouse.name,
-                    distance=availability.dist,
-                    bio_limit=warehouse.bio_limit,
-                    plastic_limit=warehouse.plastic_limit,
-                    glass_limit=warehouse.glass_limit,
-                )
+@app.get("/orgs/{org_id}/", summary="Информация о конкретной организации",
+         response_model=sql.OrganizationsWithWarehousesResponse)
+async def get_specific_org(org_id: int, request: Request, session: sql.AsyncSessionDep):
+    async def build():
+        response = await queries.get_org(session, org_id)
+        if response is None:
+            raise HTTPException(
+                status_code=404,
+                detail=f"Организации с id {org_id} нет в базе данных"
             )
+        return response
+    return await cached_json(request, build, ORG)
 
-    response = sql.OrganizationsWithWarehousesResponse(
-            organization_name=org.name,
-            organization_id=org.id,
-            warehouses=warehouses_response
-        )
-    return response
 
-
-@app.get("/warehouses/{warehouse_id}/", summary="Информация о конкретном хранилище")
-def get_specific_warehouse(warehouse_id: int, session: sql.SessionDep) -> sql.WarehouseResponse:
-    warehouse = session.get(sql.Warehouse, warehouse_id)
-    if not warehouse:
+def parse_min_free(min_free: List[str]) -> Dict[str, int]:
+    # "glass:200" -> {"glass": 200}; для одного типа действует самый строгий порог
+    thresholds = {}
+    for item in min_free:
+        waste_type, _, quantity = item.partition(":")
+        if not quantity.strip().isdigit():
+            raise HTTPException(
+                status_code=422,
+                detail="Порог свободного места указывается как <тип отходов>:<количество>, например glass:200"
+            )
+        thresholds[waste_type] = max(thresholds.get(waste_type, 0), int(quantity))
+    unknown_types = [waste_type for waste_type in thresholds if waste_type not in allocation.WASTE_TYPES]
+    if unknown_types:
         raise HTTPException(
-            status_code=404,
-            detail=f"Хранилища с id {warehouse_id} нет в базе данных"
+            status_code=422,
+            detail=f"Неизвестные типы отходов: {', '.join(unknown_types)}"
         )
-    query = (
-        select(sql.WarehouseAvailability.org_id, sql.WarehouseAvailability.dist)
-        .where(sql.WarehouseAvailability.warehouse_id == warehouse_id)
-    )
-    distances = session.exec(query).all()
-    warehouse_response = sql.WarehouseResponse(
-        warehouse_id=warehouse_id,
-        warehouse_name=warehouse.name,
-        bio_limit=warehouse.bio_limit,
-        plastic_limit=warehouse.plastic_limit,
-        glass_limit=warehouse.glass_limit,
-        distance=[{"org_id": dist.org_id, "distance": dist.dist} for dist in distances]
-    )
-    return warehouse_response
+    return {waste_type: quantity for waste_type, quantity in thresholds.items() if quantity > 0}  # 0 - без порога
+
+
+@app.get("/warehouses/", summary="Поиск хранилищ по свободному месту и расстоянию до организации",
+         response_model=List[sql.WarehouseSearchResponse])
+async def search_warehouses(
+        request: Request,
+        session: sql.AsyncSessionDep,
+        min_free: List[str] = Query(default=[], description="Порог свободного места по типу отходов, например "
+                                                            "glass:200. Можно указать несколько"),
+        org_id: Optional[int] = Query(default=None, description="Только хранилища, доступные этой организации"),
+        max_distance: Optional[int] = Query(default=None, ge=0, description="Не дальше этого расстояния "
+                                                                            "от организации org_id"),
+        sort: Literal["id", "distance"] = Query(default="id", description="distance - ближайшие к org_id первыми"),
+        after_warehouse_id: int = Query(default=0, ge=0, description="id последнего хранилища "
+                                                                     "с предыдущей страницы"),
+        after_distance: Optional[int] = Query(default=None, ge=0, description="При sort=distance: расстояние "
+                                                                              "до последнего хранилища страницы"),
+        limit: int = Query(default=50, ge=1, le=1000, description="Количество хранилищ на странице")
+):
+    if org_id is None and (max_distance is not None or sort == "distance"):
+        raise HTTPException(
+            status_code=422,
+            detail="Для max_distance и sort=distance укажите org_id"
+        )
+    if (sort == "distance" and after_warehouse_id > 0 and after_distance is None
+            or sort != "distance" and after_distance is not None):
+        # Курсор по расстоянию - пара (after_distance, after_warehouse_id): без расстояния следующая страница
+        # совпала бы с первой
+        raise HTTPException(
+            status_code=422,
+            detail="При sort=distance курсор - это after_distance вместе с after_warehouse_id, при sort=id - "
+                   "только after_warehouse_id"
+        )
+    thresholds = parse_min_free(min_free)
+    return await cached_json(request, lambda: queries.search_warehouses(
+        session, thresholds, org_id, max_distance, sort, after_warehouse_id, after_distance, limit
+    ), WAREHOUSES_PAGE)
+
+
+@app.get("/warehouses/{warehouse_id}/", summary="Информация о конкретном хранилище",
+         response_model=sql.WarehouseResponse)
+async def get_specific_warehouse(
+        warehouse_id: int,
+        request: Request,
+        session: sql.AsyncSessionDep,
+        after_org_id: int = Query(default=0, ge=0, description="id последней организации в списке distance "
+                                                               "с предыдущей страницы"),
+        limit: int = Query(default=1000, ge=1, le=10000, description="Количество организаций в списке distance")
+):
+    async def build():
+        warehouse_response = await queries.get_warehouse(session, warehouse_id, after_org_id, limit)
+        if warehouse_response is None:
+            raise HTTPException(
+                status_code=404,
+                detail=f"Хранилища с id {warehouse_id} нет в базе данных"
+            )
+        return warehouse_response
+    return await cached_json(request, build, WAREHOUSE)
+
+
+def transfer_response(org_id: int, waste_type: str, quantity: int, transfer_data: List[dict]) -> dict:
+    return {
+        "organization_id": org_id,
+        "waste_type": waste_type,
+        "initial_quantity": quantity,
+        "transfer_data": transfer_data
+    }
 
 
 @app.post("/transfer_waste/", summary="Бронируем место в хранилищах для распределения отходов")
-def transfer_waste(org_id: int, waste_type: str, quantity: int, session: sql.SessionDep):
-    if waste_type not in ["glass", "plastic", "bio"]:
+@sql.retry_on_busy
+async def transfer_waste(
+        org_id: int, waste_type: str, session: sql.AsyncSessionDep,
+        quantity: int = Query(gt=0, description="Количество отходов"),
+        idempotency_key: Optional[str] = Header(default=None, max_length=255,
+                                                description="Повтор запроса с тем же ключом вернет первый ответ, "
+                                                            "не бронируя место второй раз")
+):
+    if waste_type not in allocation.WASTE_TYPES:
         raise HTTPException(
             status_code=400,
-            detail="Неверный тип отходов. Укажите 'glass', 'plastic' или 'bio'"
+            detail=allocation.waste_type_message()
         )
-    available_warehouses = session.exec(  # получили список доступных хранилищ, отсортированных по расстоянию
-        select(sql.Warehouse, sql.WarehouseAvailability.dist)
-        .join(sql.WarehouseAvailability, sql.Warehouse.id == sql.WarehouseAvailability.warehouse_id)
-        .where(sql.WarehouseAvailability.org_id == org_id)
-        .order_by(sql.WarehouseAvailability.dist)
-    ).all()
-    if not available_warehouses:
+
+    async def run(remember=None):
+        # Решение принимается по индексу в памяти, в БД записываются только списания лимитов и заказы.
+        # В режиме одного писателя заявка записывается в общей транзакции группы (database/write_batcher.py)
+        async def remember_response(write_session, transfer_data):
+            await remember(write_session, transfer_response(org_id, waste_type, quantity, transfer_data))
+        before_commit = remember_response if remember is not None else None
+        try:
+            if config.write_batching:
+                transfer_data = await write_batcher.batcher.allocate(org_id, waste_type, quantity, before_commit)
+            else:
+                transfer_data = await allocation_index.index.allocate(session, org_id, waste_type, quantity,
+                                                                      before_commit)
+        except HTTPException:
+            metrics.record_transfer(waste_type, 0, quantity)
+            raise
+        metrics.record_transfer(waste_type, quantity, 0)
+        response_cache.cache.bump()
+        return transfer_response(org_id, waste_type, quantity, transfer_data)
+
+    if idempotency_key is None:
+        return await run()
+    return await idempotency.run_once(session, "transfer_waste", idempotency_key,
+                                      [org_id, waste_type, quantity], run)
+
+
+@app.get("/transfer_waste/quote/", summary="План распределения отходов без бронирования места")
+async def quote_transfer(org_id: int, waste_type: str, session: sql.AsyncSessionDep,
+                         quantity: int = Query(gt=0, description="Количество отходов")):
+    # Та же логика, что у post /transfer_waste/, но ничего не списывается и не записывается
+    if waste_type not in allocation.WASTE_TYPES:
         raise HTTPException(
-            status_code=404,
-            detail=f"Нет доступных хранилищ для организации с id {org_id}"
+            status_code=400,
+            detail=allocation.waste_type_message()
         )
+    transfer_data, remaining_quantity = await allocation_index.index.quote(session, org_id, waste_type, quantity)
+    response = transfer_response(org_id, waste_type, quantity, transfer_data)
+    response["allocated"] = remaining_quantity == 0
+    if remaining_quantity > 0:
+        response["detail"] = (f"Места в хранилищах хватит на {quantity - remaining_quantity} из {quantity} "
+                              f"единиц отходов")
+    return response
 
-    remaining_quantity = quantity
-    transfer_data = []  # Список словарей: куда отправили, в каком количестве, на какое расстояние
-    reservations_to_add = []  # Хранение Reservation до коммита (на случай, если распределить отходы не удастся)
-    for warehouse, distance in available_warehouses:
-        if remaining_quantity <= 0:
-            break
-
-        current_limit = getattr(warehouse, f"{waste_type}_limit")
-        if current_limit > 0:
-            deliver_quantity = min(current_limit, remaining_quantity)
-            remaining_quantity -= deliver_quantity
-            setattr(warehouse, f"{waste_type}_limit", current_limit - deliver_quantity)
-            session.add(warehouse)  # пока что добавляем без коммита
-
-            reservations_to_add.append(
-                sql.Reservation(
-                    from_org=org_id,
-                    to_warehouse=warehouse.id,
-                    waste_type=waste_type,
-                    quantity=deliver_quantity,
-                    accepted=True
-                )
-            )
 
-            transfer_data.append({
-                "warehouse_id": warehouse.id,
-                "warehouse_name": warehouse.name,
-                "delivered_quantity": deliver_quantity,
-                "distance": distance
-            })
+def record_batch_metrics(results: List[dict], cancelled: bool = False):
+    for result in results:
+        if result["waste_type"] not in allocation.WASTE_TYPES:  # произвольная строка не должна стать новой серией
+            continue
+        allocated = result["initial_quantity"] if result["allocated"] and not cancelled else 0
+        metrics.record_transfer(result["waste_type"], allocated, result["initial_quantity"] - allocated)
 
-    # Проверяем, удалось ли распределить все отходы
-    if remaining_quantity > 0:
+
+async def commit_batch(session: sql.AsyncSession, requests: List[sql.TransferRequest], atomic: bool,
+                       respond: Callable[[List[dict]], dict], planner=allocation.plan_sequential,
+                       remember=None) -> dict:
+    # Общая часть пакетного бронирования: распределение по одному снимку остатков и один коммит.
+    # respond(результаты заявок) - тело ответа; remember(сессия, ответ) - сохранение ответа для Idempotency-Key
+    results, all_allocated = await allocation.allocate_batch(session, requests, atomic, planner)
+    if atomic and not all_allocated:
+        await session.rollback()
+        record_batch_metrics(results, cancelled=True)
         raise HTTPException(
             status_code=400,
-            detail=f"Невозможно переработать {remaining_quantity} из {quantity} единиц отходов: "
-                   f"места в хранилищах недостаточно. Запрос на отправку отходов отменен"
+            detail={"message": "Не все заявки можно распределить. Пакет отменен целиком", **respond(results)}
         )
+    response = respond(results)
+    if remember is not None:
+        await remember(session, response)
+    await session.commit()
+    record_batch_metrics(results)
+    for result in results:
+        for transfer in result["transfer_data"]:
+            allocation_index.index.adjust(transfer["warehouse_id"], result["waste_type"],
+                                          -transfer["delivered_quantity"])
+    response_cache.cache.bump()
+    return response
 
-    # Если отходы распределены, добавляем записи в Reservation: по одной строке на каждую доставку отходов
-    for reservation in reservations_to_add:
-        session.add(reservation)
-    session.commit()
 
-    return {
-        "organization_id": org_id,
-        "waste_type": waste_type,
-        "initial_quantity": quantity,
-        "transfer_data": transfer_data
-    }
+@app.post("/transfer_waste/batch/", summary="Пакетное бронирование места для нескольких заявок одной транзакцией")
+@sql.retry_on_busy
+async def transfer_waste_batch(
+        requests: List[sql.TransferRequest],
+        session: sql.AsyncSessionDep,
+        atomic: bool = Query(default=False, description="true - если хотя бы одну заявку распределить нельзя, "
+                                                        "отменяется весь пакет"),
+        strategy: Literal["greedy", "optimal"] = Query(
+            default="greedy",
+            description="greedy - заявки по очереди в ближайшие хранилища, "
+                        "optimal - минимум суммарного расстояния × количество по всему пакету"
+        ),
+        idempotency_key: Optional[str] = Header(default=None, max_length=255,
+                                                description="Повтор запроса с тем же ключом вернет первый ответ, "
+                                                            "не бронируя место второй раз")
+):
+    planner = optimizer.plan_optimal if strategy == "optimal" else allocation.plan_sequential
+
+    async def run(remember=None):
+        return await commit_batch(session, requests, atomic, lambda results: {"atomic": atomic, "results": results},
+                                  planner, remember)
+
+    if idempotency_key is None:
+        return await run()
+    return await idempotency.run_once(session, "transfer_waste/batch", idempotency_key,
+                                      [[request.model_dump() for request in requests], atomic, strategy], run)
+
+
+@app.post("/transfer_waste/streams/", summary="Бронирование места сразу для нескольких типов отходов организации")
+@sql.retry_on_busy
+async def transfer_waste_streams(
+        org_id: int,
+        streams: Dict[str, int] = Body(min_length=1, examples=[{"glass": 20, "plastic": 10, "bio": 5}]),
+        *, session: sql.AsyncSessionDep,
+        atomic: bool = Query(default=False, description="true - если хотя бы один тип отходов распределить нельзя, "
+                                                        "не бронируется ничего"),
+        idempotency_key: Optional[str] = Header(default=None, max_length=255,
+                                                description="Повтор запроса с тем же ключом вернет первый ответ, "
+                                                            "не бронируя место второй раз")
+):
+    # Тип отходов -> количество. Хранилища организации загружаются одним запросом для всех типов,
+    # все потоки распределяются и записываются одной транзакцией
+    if any(waste_type not in allocation.WASTE_TYPES for waste_type in streams):
+        raise HTTPException(
+            status_code=400,
+            detail=allocation.waste_type_message()
+        )
+    if any(quantity <= 0 for quantity in streams.values()):
+        raise HTTPException(
+            status_code=422,
+            detail="Количество отходов должно быть больше нуля"
+        )
+    requests = [sql.TransferRequest(org_id=org_id, waste_type=waste_type, quantity=quantity)
+                for waste_type, quantity in streams.items()]
+
+    def respond(results: List[dict]) -> dict:
+        return {"organization_id": org_id, "atomic": atomic, "streams": {
+            result["waste_type"]: {key: value for key, value in result.items()
+                                   if key not in ("organization_id", "waste_type")}
+            for result in results
+        }}
+
+    async def run(remember=None):
+        return await commit_batch(session, requests, atomic, respond, remember=remember)
+
+    if idempotency_key is None:
+        return await run()
+    return await idempotency.run_once(session, "transfer_waste/streams", idempotency_key,
+                                      [org_id, streams, atomic], run)
 
 
 @app.patch("/order/{order_id}", summary="Указываем accepted false, если нужно отменить заказ на утилизацию")
-def delivery_confirmed(order_id: int, update: sql.ReservationUpdate, session: sql.SessionDep):
-    reserve = session.get(sql.Reservation, order_id)
+@sql.retry_on_busy
+async def delivery_confirmed(order_id: int, update: sql.ReservationUpdate, session: sql.AsyncSessionDep):
+    reserve = await session.get(sql.Reservation, order_id)
     if not reserve:
         raise HTTPException(
             status_code=404,
             detail=f"Заказа с id {order_id} нет в базе данных"
         )
     new_order_data = update.model_dump(exclude_unset=True)
-    reserve.sqlmodel_update(new_order_data)
-    if reserve.accepted == False:  # возвращаем лимиты, но оставляем саму запись о заказе
-        warehouse = session.get(sql.Warehouse, reserve.to_warehouse)
-        if not warehouse:
+    # accepted меняется только условным UPDATE, чтобы повторная отмена не возвращала место второй раз
+    reserve.sqlmodel_update({key: value for key, value in new_order_data.items() if key != "accepted"})
+    session.add(reserve)
+    refunds = {}
+    if new_order_data.get("accepted") is not None:
+        results, refunds = await reservations.apply_order_updates(session, {order_id: new_order_data["accepted"]})
+        if new_order_data["accepted"] and not results[0]["updated"]:
             raise HTTPException(
-                status_code=404,
-                detail=f"Хранилища с id {reserve.to_warehouse} нет в базе данных"
+                status_code=409,
+                detail=results[0]["detail"]
             )
+    await session.commit()
+    for (warehouse_id, waste_type), quantity in refunds.items():
+        allocation_index.index.adjust(warehouse_id, waste_type, quantity)
+    response_cache.cache.bump()
+    return new_order_data
 
-        waste_limit_field = f"{reserve.waste_type}_limit"
-        current_limit = getattr(warehouse, waste_limit_field, None)
 
-        if current_limit is not None:
-            setattr(warehouse, waste_limit_field, current_limit + reserve.quantity)
-            session.add(warehouse)
-    session.add(reserve)
-    session.commit()
-    session.refresh(reserve)
-    return new_order_data
+@app.patch("/orders/", summary="Пакетное подтверждение и отмена заказов одной транзакцией")
+@sql.retry_on_busy
+async def update_orders(
+        updates: List[sql.OrderStatusUpdate] = Body(max_length=config.orders_batch_limit),
+        *, session: sql.AsyncSessionDep
+):
+    # Если заказ указан несколько раз, действует последнее состояние. Место отмененных заказов возвращается
+    # одной командой на пару (хранилище, тип отходов); уже отмененные заказы повторно не возвращают ничего
+    results, refunds = await reservations.apply_order_updates(
+        session, {update.order_id: update.accepted for update in updates}
+    )
+    await session.commit()
+    for (warehouse_id, waste_type), quantity in refunds.items():
+        allocation_index.index.adjust(warehouse_id, waste_type, quantity)
+    response_cache.cache.bump()
+    return {
+        "updated": sum(result["updated"] for result in results),
+        "results": results,
+        "refunded": [{"warehouse_id": warehouse_id, "waste_type": waste_type, "quantity": quantity}
+                     for (warehouse_id, waste_type), quantity in sorted(refunds.items())]
+    }
+
+
+@app.get("/analytics/reservations/", summary="Объем броней, доля отмен и среднее расстояние по дням, "
+                                             "организациям, хранилищам и типам отходов")
+async def reservation_stats(
+        session: sql.AsyncSessionDep,
+        group_by: List[Literal["day", "org_id", "warehouse_id", "waste_type"]] = Query(
+            default=["day"], description="Разрезы, можно указать несколько: ?group_by=org_id&group_by=waste_type"
+        ),
+        date_from: Optional[date] = Query(default=None, description="Первый день периода (день создания брони)"),
+        date_to: Optional[date] = Query(default=None, description="Последний день периода"),
+        org_id: Optional[int] = None,
+        warehouse_id: Optional[int] = None,
+        waste_type: Optional[str] = None
+):
+    # Считается по дневным итогам: время запроса зависит от числа дней и разрезов, а не от числа броней
+    return await analytics.get_stats(session, group_by, date_from, date_to, org_id, warehouse_id, waste_type)
+
+
+@app.get("/reservations/export/", summary="Потоковая выгрузка броней в NDJSON или CSV")
+async def export_reservations(
+        file_format: Literal["ndjson", "csv"] = Query(default="ndjson", alias="format"),
+        after_id: int = Query(default=0, ge=0, description="Курсор: id последней полученной брони, "
+                                                           "выгрузка продолжится со следующей"),
+        until_id: Optional[int] = Query(default=None, ge=0, description="id последней брони в выгрузке"),
+        created_from: Optional[datetime] = Query(default=None, description="Брони, созданные начиная с этого времени"),
+        created_to: Optional[datetime] = Query(default=None, description="Брони, созданные раньше этого времени"),
+        limit: Optional[int] = Query(default=None, ge=1, description="Максимальное число броней")
+):
+    # Строки по возрастанию id, отправляются по мере чтения из БД; сессию открывает сама выгрузка,
+    # потому что ответ продолжает отправляться после выхода из обработчика
+    return StreamingResponse(
+        export.export_reservations(file_format, after_id, until_id, created_from, created_to, limit),
+        media_type=export.MEDIA_TYPES[file_format],
+        headers={"Content-Disposition": f'attachment; filename="reservations.{file_format}"'}
+    )
+
+
+IMPORT_BODY = {
+    "requestBody": {
+        "content": {
+            "application/x-ndjson": {"schema": {"type": "string"}},
+            "text/csv": {"schema": {"type": "string"}},
+        },
+        "required": True,
+    }
+}
+
+
+@app.post("/import/{kind}/", summary="Потоковый импорт хранилищ, организаций или расстояний из NDJSON или CSV",
+          openapi_extra=IMPORT_BODY)
+async def import_data(
+        kind: Literal["warehouses", "orgs", "distances"],
+        request: Request,
+        session: sql.AsyncSessionDep,
+        file_format: Literal["ndjson", "csv"] = Query(default="ndjson", alias="format")
+):
+    # Тело запроса разбирается по мере поступления, каждые config.import_chunk_size строк - отдельная транзакция.
+    # Строки с ошибками пропускаются, в ответе - их номера и причины
+    report = await bulk_import.import_stream(session, kind, request.stream(), file_format)
+    response_cache.cache.bump()
+    return report
+
+
+@app.get("/metrics", summary="Метрики в формате Prometheus", response_class=PlainTextResponse)
+def get_metrics():
+    metrics.registry.set("response_cache_requests_total", ("hit",), response_cache.cache.hits)
+    metrics.registry.set("response_cache_requests_total", ("miss",), response_cache.cache.misses)
+    metrics.registry.gauge("write_batch_queue_depth", (), write_batcher.batcher.queue_depth())
+    metrics.registry.set("quote_cache_requests_total", ("hit",), allocation_index.index.quote_hits)
+    metrics.registry.set("quote_cache_requests_total", ("miss",), allocation_index.index.quote_misses)
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.delete("/testing/", summary="Очистка базы и создание тестовых таблиц. Работает только в режиме тестирования")
 def clear_db():
     sql.drop_tables()
     sql.create_tables()
+    allocation_index.index.clear()
+    response_cache.cache.clear()
 
@@ -0,0 +1,193 @@
+# Метрики в текстовом формате Prometheus (get /metrics) и журнал медленных SQL-запросов.
+# Запросы к API считает ASGI-middleware: число по маршруту, методу и коду ответа и гистограмма времени ответа.
+# SQL-команды считают события движков SQLAlchemy (database/sql_models.create_db и create_async_db): число
+# и суммарное время команд всего и в пересчете на запрос к API. Запрос, к которому относится команда,
+# передается через contextvars - так он виден и в async-обработчиках, и в потоках для синхронных.
+# Метрики хранятся в памяти процесса: при нескольких воркерах uvicorn у каждого свои значения.
+# Накладные расходы - несколько микросекунд на запрос и на SQL-команду: метрики можно не выключать под нагрузкой
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+from sqlalchemy import event
+import config
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последний - больше самой большой границы (+Inf)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[str, Dict[Tuple, float]] = defaultdict(lambda: defaultdict(float))
+        self.histograms: Dict[str, Dict[Tuple, Histogram]] = defaultdict(dict)
+        self.gauges: Dict[str, Dict[Tuple, float]] = defaultdict(dict)
+        self.help: Dict[str, Tuple[str, Tuple[str, ...]]] = {}  # имя -> (описание, имена меток)
+
+    def describe(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        self.help[name] = (description, labels)
+
+    def inc(self, name: str, labels: Tuple = (), value: float = 1):
+        with self._lock:
+            self.counters[name][labels] += value
+
+    def observe(self, name: str, buckets: tuple, labels: Tuple, value: float):
+        with self._lock:
+            histogram = self.histograms[name].get(labels)
+            if histogram is None:
+                histogram = self.histograms[name][labels] = Histogram(buckets)
+            histogram.observe(value)
+
+    def set(self, name: str, labels: Tuple, value: float):
+        # Для счетчиков, которые ведет другой объект (например, попадания в кэш ответов)
+        with self._lock:
+            self.counters[name][labels] = value
+
+    def gauge(self, name: str, labels: Tuple, value: float):
+        # Текущее значение, которое может и уменьшаться (например, длина очереди)
+        with self._lock:
+            self.gauges[name][labels] = value
+
+    def clear(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.gauges.clear()
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, (description, label_names) in self.help.items():
+                if name in self.histograms:
+                    lines += [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+                    for labels, histogram in sorted(self.histograms[name].items()):
+                        cumulative = 0
+                        for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                            cumulative += count
+                            lines.append(f"{name}_bucket{format_labels(label_names, labels, bound)} {cumulative}")
+                        lines.append(f"{name}_sum{format_labels(label_names, labels)} {histogram.sum}")
+                        lines.append(f"{name}_count{format_labels(label_names, labels)} {histogram.count}")
+                elif name in self.counters or name in self.gauges:
+                    kind = "counter" if name in self.counters else "gauge"
+                    values = self.counters[name] if kind == "counter" else self.gauges[name]
+                    lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+                    for labels, value in sorted(values.items()):
+                        lines.append(f"{name}{format_labels(label_names, labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple, bound=None) -> str:
+    pairs = [(name, value) for name, value in zip(names, values)]
+    if bound is not None:
+        pairs.append(("le", bound))
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+registry = Registry()
+registry.describe("http_requests_total", "Запросы к API", ("method", "route", "status"))
+registry.describe("http_request_duration_seconds", "Время ответа API", ("method", "route"))
+registry.describe("http_request_sql_statements", "SQL-команд за один запрос к API", ("method", "route"))
+registry.describe("http_request_sql_duration_seconds_total", "Суммарное время SQL-команд запросов к API",
+                  ("method", "route"))
+registry.describe("sql_statements_total", "SQL-команды, включая фоновые задачи")
+registry.describe("sql_statement_duration_seconds_total", "Суммарное время SQL-команд, включая фоновые задачи")
+registry.describe("sql_slow_statements_total", "SQL-команды дольше config.slow_query_ms")
+registry.describe("waste_allocated_quantity_total", "Распределено отходов по хранилищам", ("waste_type",))
+registry.describe("waste_rejected_quantity_total", "Отходов в отклоненных заявках на распределение", ("waste_type",))
+registry.describe("response_cache_requests_total", "Обращения к кэшу ответов", ("result",))
+registry.describe("quote_cache_requests_total", "Обращения к кэшу планов get /transfer_waste/quote/", ("result",))
+
+# [число SQL-команд, их суммарное время] текущего запроса к API
+request_sql: ContextVar[Optional[list]] = ContextVar("request_sql", default=None)
+
+
+def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+
+def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - connection.info["metrics_started"].pop()
+    registry.inc("sql_statements_total")
+    registry.inc("sql_statement_duration_seconds_total", value=elapsed)
+    current = request_sql.get()
+    if current is not None:
+        current[0] += 1
+        current[1] += elapsed
+    if config.slow_query_ms and elapsed * 1000 >= config.slow_query_ms:
+        registry.inc("sql_slow_statements_total")
+        logger.warning("Медленный SQL-запрос (%.1f мс): %s", elapsed * 1000, " ".join(statement.split())[:1000])
+
+
+def handle_error(exception_context):
+    # Команда завершилась ошибкой: after_cursor_execute не вызовется, убираем ее время начала
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("metrics_started"):
+        connection.info["metrics_started"].pop()
+
+
+def instrument_engine(engine):
+    # engine - синхронный движок; для асинхронного передается async_engine.sync_engine
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(engine, "handle_error", handle_error)
+
+
+def record_transfer(waste_type: str, allocated: int, rejected: int):
+    # Счетчики Prometheus только растут: неположительные значения не учитываются
+    if allocated > 0:
+        registry.inc("waste_allocated_quantity_total", (waste_type,), allocated)
+    if rejected > 0:
+        registry.inc("waste_rejected_quantity_total", (waste_type,), rejected)
+
+
+class MetricsMiddleware:
+    # Чистое ASGI-middleware, а не BaseHTTPMiddleware: не создает отдельную задачу и поток ответа на каждый запрос
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = [500]  # если ответ не начался из-за исключения
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        sql_stats = [0, 0.0]
+        token = request_sql.set(sql_stats)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            request_sql.reset(token)
+            route = scope.get("route")
+            # Шаблон маршрута, а не путь: /orgs/{org_id}/ - одна серия, а не по серии на каждый id
+            labels = (scope["method"], route.path if route is not None else "unmatched")
+            registry.inc("http_requests_total", labels + (status[0],))
+            registry.observe("http_request_duration_seconds", LATENCY_BUCKETS, labels, elapsed)
+            registry.observe("http_request_sql_statements", STATEMENT_BUCKETS, labels, sql_stats[0])
+            registry.inc("http_request_sql_duration_seconds_total", labels, sql_stats[1])
@@ -0,0 +1,120 @@
+from collections import defaultdict
+from typing import Dict, List, Tuple
+import numpy as np
+from ortools.graph.python import min_cost_flow
+from database.allocation import plan_greedy
+
+
+# Глобально оптимальное распределение пакета заявок: транспортная задача (min-cost flow)
+# "организации -> хранилища" для каждого типа отходов. Минимизируем сумму расстояние × количество
+# при максимально возможном объеме распределенных отходов. Решается в процессе, на CPU,
+# сетевым алгоритмом OR-Tools (SimpleMinCostFlow), поток получается целочисленным.
+
+
+def _solve_transportation(supply: np.ndarray, capacity: np.ndarray, edge_src: np.ndarray,
+                          edge_dst: np.ndarray, edge_cost: np.ndarray) -> np.ndarray:
+    # Сеть: организация -> хранилище (стоимость - расстояние), хранилище -> сток (вместимость - остаток лимита).
+    # Нераспределенные отходы уходят в сток по отдельной дуге со стоимостью big_m. big_m больше стоимости
+    # любого увеличивающего пути, поэтому решатель сначала максимизирует объем, а потом минимизирует расстояние.
+    # Возвращает поток по каждому ребру организация -> хранилище
+    orgs_count, warehouses_count = len(supply), len(capacity)
+    sink = orgs_count + warehouses_count
+    big_m = (min(orgs_count, warehouses_count) + 1) * (int(edge_cost.max()) + 1) + 1
+    warehouse_nodes = np.arange(orgs_count, sink)
+
+    flow = min_cost_flow.SimpleMinCostFlow()
+    edges = flow.add_arcs_with_capacity_and_unit_cost(edge_src, orgs_count + edge_dst, supply[edge_src], edge_cost)
+    flow.add_arcs_with_capacity_and_unit_cost(warehouse_nodes, np.full(warehouses_count, sink), capacity,
+                                              np.zeros(warehouses_count, dtype=np.int64))
+    flow.add_arcs_with_capacity_and_unit_cost(np.arange(orgs_count), np.full(orgs_count, sink), supply,
+                                              np.full(orgs_count, big_m, dtype=np.int64))
+    flow.set_nodes_supplies(np.arange(sink + 1), np.concatenate([
+        supply, np.zeros(warehouses_count, dtype=np.int64), [-supply.sum()]
+    ]))
+    status = flow.solve()
+    if status != flow.OPTIMAL:
+        raise RuntimeError(f"Не удалось решить транспортную задачу, статус {status}")
+    return flow.flows(edges)
+
+
+def _plan_waste_type(requests: List[Tuple[int, str, int]], indexes: List[int], candidates: Dict[int, list],
+                     capacity: Dict[Tuple[int, str], int], waste_type: str, plans: list):
+    # Заявки одной организации объединяются в один источник: у них одинаковые ребра и расстояния
+    org_ids = list(dict.fromkeys(requests[index][0] for index in indexes))
+    org_position = {org_id: position for position, org_id in enumerate(org_ids)}
+    supply = np.zeros(len(org_ids), dtype=np.int64)
+    for index in indexes:
+        supply[org_position[requests[index][0]]] += requests[index][2]
+
+    warehouse_position = {}
+    edges = []  # (организация, хранилище, название, расстояние) в порядке возрастания расстояния
+    for org_id in org_ids:
+        for warehouse_id, warehouse_name, distance in candidates[org_id]:
+            if capacity.get((warehouse_id, waste_type), 0) > 0:
+                warehouse_position.setdefault(warehouse_id, len(warehouse_position))
+                edges.append((org_id, warehouse_id, warehouse_name, distance))
+
+    flows = np.zeros(len(edges), dtype=np.int64)
+    if edges:
+        limits = np.zeros(len(warehouse_position), dtype=np.int64)
+        for warehouse_id, position in warehouse_position.items():
+            limits[position] = capacity[(warehouse_id, waste_type)]
+        flows = _solve_transportation(
+            supply, limits,
+            np.fromiter((org_position[edge[0]] for edge in edges), dtype=np.int64, count=len(edges)),
+            np.fromiter((warehouse_position[edge[1]] for edge in edges), dtype=np.int64, count=len(edges)),
+            np.fromiter((edge[3] for edge in edges), dtype=np.int64, count=len(edges)),
+        )
+
+    org_flows = defaultdict(list)  # куда решатель отправил отходы каждой организации, ближайшие первыми
+    for (org_id, warehouse_id, warehouse_name, distance), flow in zip(edges, flows.tolist()):
+        if flow > 0:
+            org_flows[org_id].append([warehouse_id, warehouse_name, distance, flow])
+
+    # Поток организации раздается ее заявкам по порядку. Заявка принимается только целиком,
+    # поэтому неразданный остаток потока в хранилищах не списывается
+    rejected = []
+    for index in indexes:
+        org_id, _, quantity = requests[index]
+        flows_left = org_flows[org_id]
+        available = sum(flow[3] for flow in flows_left)
+        if available < quantity:
+            rejected.append(index)
+            continue
+        remaining_quantity = quantity
+        transfer_data = []
+        for flow in flows_left:
+            if remaining_quantity == 0:
+                break
+            deliver_quantity = min(flow[3], remaining_quantity)
+            if deliver_quantity == 0:
+                continue
+            flow[3] -= deliver_quantity
+            remaining_quantity -= deliver_quantity
+            capacity[(flow[0], waste_type)] -= deliver_quantity
+            transfer_data.append({
+                "warehouse_id": flow[0],
+                "warehouse_name": flow[1],
+                "delivered_quantity": deliver_quantity,
+                "distance": flow[2]
+            })
+        plans[index] = (transfer_data, 0)
+
+    # Отклоненные заявки пробуем разместить жадно в оставшемся после оптимизации месте
+    for index in rejected:
+        org_id, _, quantity = requests[index]
+        plans[index] = plan_greedy(candidates[org_id], capacity, waste_type, quantity)
+
+
+def plan_optimal(requests: List[Tuple[int, str, int]], candidates: Dict[int, list],
+                 capacity: Dict[Tuple[int, str], int]) -> List[Tuple[List[dict], int]]:
+    # requests - (org_id, waste_type, quantity); у каждой организации должны быть хранилища в candidates.
+    # Возвращает для каждой заявки то же, что plan_greedy: план доставки и нераспределенный остаток.
+    # capacity уменьшается на объем всех принятых заявок
+    plans = [None] * len(requests)
+    by_waste_type = defaultdict(list)
+    for index, (_, waste_type, _) in enumerate(requests):
+        by_waste_type[waste_type].append(index)
+    for waste_type, indexes in by_waste_type.items():
+        _plan_waste_type(requests, indexes, candidates, capacity, waste_type, plans)
+    return plans
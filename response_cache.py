@@ -0,0 +1,109 @@
+# Кэш ответов для часто опрашиваемых GET: /orgs/, /orgs/{org_id}/, /warehouses/, /warehouses/{warehouse_id}/.
+# Запись в кэше - готовое тело ответа (JSON) и его ETag, ключ - путь и параметры запроса.
+# Записи действительны, пока не изменилась версия данных: ее увеличивают пишущие обработчики этого процесса
+# (cache.bump()), а коммиты других соединений - других воркеров uvicorn, фоновой отмены броней, импорта
+# из командной строки - видны по PRAGMA data_version. Эта проверка читает только заголовок WAL в разделяемой
+# памяти, а не таблицы, поэтому ответ из кэша и 304 обходятся без запросов к БД.
+# ETag - хэш тела ответа, а не номер версии: номера версий у воркеров разные, а хэш одинаков у всех
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional, Tuple
+import orjson
+from fastapi import Request, Response
+from pydantic import TypeAdapter
+import config
+import database.sql_models as sql
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int, database_path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # ключ -> (версия, etag, тело); в конце - последние использованные
+        self._lock = threading.Lock()
+        self._database_path = database_path
+        self._watcher = None
+        self._data_version = None
+
+    def bump(self):
+        with self._lock:
+            self.version += 1
+
+    def current_version(self) -> int:
+        with self._lock:
+            if self._database_path is not None:
+                if self._watcher is None:
+                    self._watcher = sqlite3.connect(self._database_path, check_same_thread=False)
+                data_version = self._watcher.execute("PRAGMA data_version").fetchone()[0]
+                if data_version != self._data_version:
+                    self._data_version = data_version
+                    self.version += 1
+            return self.version
+
+    def get(self, key: str, version: int) -> Optional[Tuple[str, bytes]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, key: str, version: int, etag: str, body: bytes):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (version, etag, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.version += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def etag_matches(etag: str, if_none_match: Optional[str]) -> bool:
+    # If-None-Match может содержать несколько ETag через запятую, слабые (W/"...") или *
+    if not if_none_match:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in tags or etag in tags
+
+
+def encode(data, adapter: TypeAdapter) -> bytes:
+    # data - словари и списки с ключами в порядке полей модели ответа (database/queries.py). С config.fast_json
+    # они сразу сериализуются orjson; иначе - проверка по модели adapter и сериализация pydantic, как раньше.
+    # Тело ответа в обоих режимах одинаковое до байта, поэтому совпадают и ETag
+    if config.fast_json:
+        return orjson.dumps(data)
+    return adapter.dump_json(adapter.validate_python(data))
+
+
+async def cached_json(request: Request, build: Callable[[], Awaitable], adapter: TypeAdapter) -> Response:
+    # build - сборка ответа из БД, вызывается только если в кэше нет записи для текущей версии данных.
+    # Версия берется до сборки: если данные изменятся во время нее, запись просто устареет
+    key = f"{request.url.path}?{request.query_params}"
+    version = cache.current_version()
+    entry = cache.get(key, version)
+    if entry is None:
+        body = encode(await build(), adapter)
+        etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+        cache.put(key, version, etag, body)
+    else:
+        etag, body = entry
+    if etag_matches(etag, request.headers.get("if-none-match")):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+cache = ResponseCache(config.response_cache_size, sql.engine.url.database)
@@ -0,0 +1,58 @@
+# Сравнение жадного и оптимального (min-cost flow) распределения на случайном пакете заявок.
+# Запуск из корня проекта: python -m testing.bench_allocation --orgs 3000 --warehouses 3000
+import argparse
+import random
+import time
+from optimizer import plan_optimal
+from database.allocation import WASTE_TYPES, plan_sequential
+
+
+def generate_instance(orgs: int, warehouses: int, links: int, load: float, seed: int):
+    rng = random.Random(seed)
+    candidates = {}
+    for org_id in range(1, orgs + 1):
+        linked = rng.sample(range(1, warehouses + 1), min(links, warehouses))
+        candidates[org_id] = sorted(((warehouse_id, f"МНО {warehouse_id}", rng.randint(10, 1000))
+                                     for warehouse_id in linked), key=lambda candidate: candidate[2])
+    capacity = {(warehouse_id, waste_type): rng.randint(0, 300)
+                for warehouse_id in range(1, warehouses + 1) for waste_type in WASTE_TYPES}
+    # Суммарный спрос по каждому типу отходов - load от суммарной вместимости
+    mean_quantity = max(1, int(load * sum(capacity.values()) / orgs))
+    requests = [(org_id, rng.choice(WASTE_TYPES), rng.randint(1, 2 * mean_quantity))
+                for org_id in range(1, orgs + 1)]
+    return requests, candidates, capacity
+
+
+def run(planner, requests, candidates, capacity):
+    capacity = dict(capacity)
+    started = time.perf_counter()
+    plans = planner(requests, candidates, capacity)
+    elapsed = time.perf_counter() - started
+    accepted = [(request, transfer_data) for request, (transfer_data, remaining) in zip(requests, plans)
+                if remaining == 0]
+    return {
+        "seconds": round(elapsed, 4),
+        "accepted_requests": len(accepted),
+        "rejected_requests": len(requests) - len(accepted),
+        "allocated_quantity": sum(request[2] for request, _ in accepted),
+        "distance_x_quantity": sum(transfer["distance"] * transfer["delivered_quantity"]
+                                   for _, transfer_data in accepted for transfer in transfer_data),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение жадного и оптимального распределения")
+    parser.add_argument("--orgs", type=int, default=3000)
+    parser.add_argument("--warehouses", type=int, default=3000)
+    parser.add_argument("--links", type=int, default=10, help="Сколько хранилищ доступно каждой организации")
+    parser.add_argument("--load", type=float, default=0.9, help="Спрос относительно суммарной вместимости")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    instance = generate_instance(args.orgs, args.warehouses, args.links, args.load, args.seed)
+    for name, planner in (("greedy", plan_sequential), ("optimal", plan_optimal)):
+        print(name, run(planner, *instance))
+
+
+if __name__ == "__main__":
+    main()
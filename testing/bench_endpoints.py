@@ -0,0 +1,217 @@
+# Нагрузочный прогон всех endpoint'ов main.py (кроме /testing/) с заданной конкурентностью.
+# Endpoint'ы нагружаются по очереди, для каждого - пропускная способность, p50/p95/p99 и коды ответов.
+# Отчет - JSON: его можно сохранить (--output) и сравнить со следующим прогоном (--compare), чтобы ловить регрессии.
+# Сервер запускается отдельно на БД, заполненной testing.data_generator:
+#   python -m testing.data_generator --orgs 100000 --warehouses 2000 --density 0.005
+#   python -m testing.bench_endpoints --orgs 100000 --warehouses 2000 --output baseline.json
+#   python -m testing.bench_endpoints --orgs 100000 --warehouses 2000 --compare baseline.json --tolerance 0.2
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timezone
+import httpx
+import config
+from testing.bench_latency import summary
+
+
+def warehouse_body(rng: random.Random, number: int) -> dict:
+    return {"name": f"МНО нагрузка {number}", "bio_limit": rng.randint(0, 500), "plastic_limit": rng.randint(0, 500),
+            "glass_limit": rng.randint(0, 500)}
+
+
+def ndjson(records) -> bytes:
+    return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode()
+
+
+# Сценарий - функция (rng, контекст, номер запроса) -> параметры httpx.request.
+# Контекст: диапазоны id организаций и хранилищ и id заказов, найденные после сценариев с бронированием
+SCENARIOS = {
+    "GET /": lambda rng, ctx, number: {"method": "GET", "url": "/"},
+    "GET /orgs/": lambda rng, ctx, number: {
+        "method": "GET", "url": "/orgs/", "params": {"after_org_id": rng.randint(0, ctx["orgs"] - 1), "limit": 100}
+    },
+    "GET /orgs/{org_id}/": lambda rng, ctx, number: {
+        "method": "GET", "url": f"/orgs/{rng.randint(1, ctx['orgs'])}/"
+    },
+    "GET /warehouses/": lambda rng, ctx, number: {
+        "method": "GET", "url": "/warehouses/",
+        "params": {"org_id": rng.randint(1, ctx["orgs"]), "sort": "distance", "max_distance": 500,
+                   "min_free": f"{rng.choice(config.waste_types)}:{rng.randint(1, 200)}"}
+    },
+    "GET /warehouses/{warehouse_id}/": lambda rng, ctx, number: {
+        "method": "GET", "url": f"/warehouses/{rng.randint(1, ctx['warehouses'])}/"
+    },
+    "POST /warehouses/": lambda rng, ctx, number: {
+        "method": "POST", "url": "/warehouses/", "json": warehouse_body(rng, number)
+    },
+    "POST /orgs/": lambda rng, ctx, number: {
+        "method": "POST", "url": "/orgs/", "json": {
+            "name": f"ОО нагрузка {number}",
+            "warehouses": {str(warehouse_id): rng.randint(1, 1000)
+                           for warehouse_id in rng.sample(range(1, ctx["warehouses"] + 1), min(3, ctx["warehouses"]))}
+        }
+    },
+    "POST /transfer_waste/": lambda rng, ctx, number: {
+        "method": "POST", "url": "/transfer_waste/", "params": {
+            "org_id": rng.randint(1, ctx["orgs"]), "waste_type": rng.choice(config.waste_types),
+            "quantity": rng.randint(1, 20)
+        }
+    },
+    "GET /transfer_waste/quote/": lambda rng, ctx, number: {
+        "method": "GET", "url": "/transfer_waste/quote/", "params": {
+            "org_id": rng.randint(1, min(ctx["orgs"], 1000)), "waste_type": rng.choice(config.waste_types),
+            "quantity": rng.randint(1, 20)
+        }
+    },
+    "POST /transfer_waste/batch/": lambda rng, ctx, number: {
+        "method": "POST", "url": "/transfer_waste/batch/", "json": [
+            {"org_id": rng.randint(1, ctx["orgs"]), "waste_type": rng.choice(config.waste_types),
+             "quantity": rng.randint(1, 20)} for _ in range(10)
+        ]
+    },
+    "POST /transfer_waste/streams/": lambda rng, ctx, number: {
+        "method": "POST", "url": "/transfer_waste/streams/", "params": {"org_id": rng.randint(1, ctx["orgs"])},
+        "json": {waste_type: rng.randint(1, 20) for waste_type in config.waste_types}
+    },
+    "PATCH /order/{order_id}": lambda rng, ctx, number: {
+        "method": "PATCH", "url": f"/order/{rng.choice(ctx['orders'])}", "json": {"accepted": rng.random() > 0.1}
+    },
+    "PATCH /orders/": lambda rng, ctx, number: {
+        "method": "PATCH", "url": "/orders/", "json": [
+            {"order_id": rng.choice(ctx["orders"]), "accepted": rng.random() > 0.1} for _ in range(50)
+        ]
+    },
+    "GET /analytics/reservations/": lambda rng, ctx, number: {
+        "method": "GET", "url": "/analytics/reservations/",
+        "params": {"group_by": ["day", "waste_type"], "org_id": rng.randint(1, ctx["orgs"])}
+    },
+    "GET /reservations/export/": lambda rng, ctx, number: {
+        "method": "GET", "url": "/reservations/export/",
+        "params": {"after_id": rng.choice(ctx["orders"]) - 1, "limit": 100}
+    },
+    "POST /import/warehouses/": lambda rng, ctx, number: {
+        "method": "POST", "url": "/import/warehouses/", "params": {"format": "ndjson"},
+        "content": ndjson(warehouse_body(rng, number * 100 + row) for row in range(100))
+    },
+    "POST /import/orgs/": lambda rng, ctx, number: {
+        "method": "POST", "url": "/import/orgs/", "params": {"format": "ndjson"},
+        "content": ndjson({"name": f"ОО импорт {number * 100 + row}", "warehouses": {
+            warehouse_id: rng.randint(1, 1000)
+            for warehouse_id in rng.sample(range(1, ctx["warehouses"] + 1), min(3, ctx["warehouses"]))
+        }} for row in range(100))
+    },
+    # Случайные пары организация-хранилище: при малой плотности данных почти все новые, уже заданные
+    # попадают в отчет импорта как отклоненные строки
+    "POST /import/distances/": lambda rng, ctx, number: {
+        "method": "POST", "url": "/import/distances/", "params": {"format": "ndjson"},
+        "content": ndjson({"org_id": rng.randint(1, ctx["orgs"]), "warehouse_id": rng.randint(1, ctx["warehouses"]),
+                           "dist": rng.randint(1, 1000)} for _ in range(100))
+    },
+    "GET /metrics": lambda rng, ctx, number: {"method": "GET", "url": "/metrics"},
+}
+
+
+async def find_orders(client: httpx.AsyncClient, limit: int = 10000) -> list:
+    # id заказов для сценариев PATCH и выгрузки: первые limit броней
+    response = await client.get("/reservations/export/", params={"limit": limit})
+    return [json.loads(line)["id"] for line in response.text.splitlines()] or [1]
+
+
+async def run_scenario(client: httpx.AsyncClient, name: str, ctx: dict, total: int, concurrency: int,
+                       seed: int) -> dict:
+    rng = random.Random(f"{seed}:{name}")
+    requests = [SCENARIOS[name](rng, ctx, number) for number in range(total)]  # готовим до замера
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    statuses = Counter()
+
+    async def one(request: dict):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await client.request(**request)
+                statuses[str(response.status_code)] += 1
+            except httpx.HTTPError as error:
+                statuses[type(error).__name__] += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(request) for request in requests))
+    result = summary(latencies, time.perf_counter() - started)
+    result["statuses"] = dict(sorted(statuses.items()))
+    result["errors"] = sum(count for status, count in statuses.items()
+                           if not status.isdigit() or int(status) >= 500)
+    return result
+
+
+async def bench(url: str, names: list, ctx: dict, total: int, concurrency: int, seed: int) -> dict:
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=120) as client:
+        results = {}
+        for name in names:
+            if "{order_id}" in name or name in ("PATCH /orders/", "GET /reservations/export/"):
+                ctx.setdefault("orders", await find_orders(client))
+            results[name] = await run_scenario(client, name, ctx, total, concurrency, seed)
+            print(name, results[name], file=sys.stderr)
+    return results
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    # Регрессия: p95 вырос или пропускная способность упала больше чем на tolerance, либо появились ошибки 5xx
+    regressions = []
+    for name, result in report["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(name)
+        if previous is None:
+            continue
+        if result["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {previous['p95_ms']} -> {result['p95_ms']} мс")
+        if result["rps"] < previous["rps"] * (1 - tolerance):
+            regressions.append(f"{name}: rps {previous['rps']} -> {result['rps']}")
+        if result["errors"] > previous["errors"]:
+            regressions.append(f"{name}: ошибок {previous['errors']} -> {result['errors']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пропускная способность и задержки всех endpoint'ов, отчет в JSON")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--orgs", type=int, required=True, help="Сколько организаций в БД (id от 1)")
+    parser.add_argument("--warehouses", type=int, required=True, help="Сколько хранилищ в БД (id от 1)")
+    parser.add_argument("--requests", type=int, default=1000, help="Запросов на каждый endpoint")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--only", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Сохранить отчет в файл")
+    parser.add_argument("--compare", help="Отчет предыдущего прогона: вывести регрессии и завершиться с кодом 1")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Допустимое ухудшение, доля")
+    args = parser.parse_args()
+
+    ctx = {"orgs": args.orgs, "warehouses": args.warehouses}
+    endpoints = asyncio.run(bench(args.url, args.only, ctx, args.requests, args.concurrency, args.seed))
+    report = {
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "url": args.url,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "seed": args.seed,
+        "endpoints": endpoints,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        for regression in regressions:
+            print("Регрессия:", regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
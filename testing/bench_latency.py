@@ -0,0 +1,109 @@
+# Задержки endpoint'ов под конкурентной нагрузкой. Сервер запускается отдельно (fastapi run / uvicorn main:app).
+# Параллельно с нагрузкой на чтение опрашивается GET / без обращения к БД: если обработчики блокируют
+# event loop, растут задержки и у него.
+#   python -m testing.bench_latency --populate 2000   # заполнить БД из .env тестовыми данными
+#   python -m testing.bench_latency --url http://127.0.0.1:8000 --concurrency 50 --requests 2000
+import argparse
+import asyncio
+import random
+import time
+import httpx
+
+
+def percentile(latencies: list, share: float) -> float:
+    ordered = sorted(latencies)
+    return round(ordered[min(len(ordered) - 1, int(share * len(ordered)))] * 1000, 2)
+
+
+def summary(latencies: list, elapsed: float) -> dict:
+    return {
+        "requests": len(latencies),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+        "max_ms": round(max(latencies) * 1000, 2),
+    }
+
+
+async def load(client: httpx.AsyncClient, paths: list, total: int, concurrency: int, latencies: list):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(path: str):
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.get(path)
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(one(paths[number % len(paths)]) for number in range(total)))
+
+
+async def probe(client: httpx.AsyncClient, stop: asyncio.Event, latencies: list):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await client.get("/")
+        latencies.append(time.perf_counter() - started)
+        await asyncio.sleep(0.01)
+
+
+async def bench(url: str, paths: list, total: int, concurrency: int):
+    limits = httpx.Limits(max_connections=concurrency + 1)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        load_latencies, probe_latencies = [], []
+        stop = asyncio.Event()
+        probe_task = asyncio.create_task(probe(client, stop, probe_latencies))
+        started = time.perf_counter()
+        await load(client, paths, total, concurrency, load_latencies)
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await probe_task
+    print("load ", paths, summary(load_latencies, elapsed))
+    print("probe", ["/"], summary(probe_latencies, elapsed))
+
+
+def populate(orgs: int, warehouses: int, links: int, seed: int):
+    from sqlmodel import Session, func, insert, select
+    import database.sql_models as sql
+
+    rng = random.Random(seed)
+    sql.create_tables()
+    with Session(sql.engine) as session:
+        first_warehouse = (session.exec(select(func.max(sql.Warehouse.id))).one() or 0) + 1
+        first_org = (session.exec(select(func.max(sql.Organization.id))).one() or 0) + 1
+        session.exec(insert(sql.Warehouse), params=[{"name": f"МНО {number}"} for number in range(warehouses)])
+        session.exec(insert(sql.WarehouseCapacity), params=[
+            {"warehouse_id": warehouse_id, "waste_type": waste_type, "remaining": rng.randint(0, 500)}
+            for warehouse_id in range(first_warehouse, first_warehouse + warehouses)
+            for waste_type in ("bio", "plastic", "glass")
+        ])
+        session.exec(insert(sql.Organization), params=[{"name": f"ОО {number}"} for number in range(orgs)])
+        session.exec(insert(sql.WarehouseAvailability), params=[
+            {"org_id": org_id, "warehouse_id": warehouse_id, "dist": rng.randint(10, 1000)}
+            for org_id in range(first_org, first_org + orgs)
+            for warehouse_id in rng.sample(range(first_warehouse, first_warehouse + warehouses),
+                                           min(links, warehouses))
+        ])
+        session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Задержки endpoint'ов под конкурентной нагрузкой")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--paths", nargs="+", default=["/orgs/?limit=100", "/orgs/1/", "/warehouses/1/"])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--populate", type=int, default=0, help="Добавить в БД столько организаций и выйти")
+    parser.add_argument("--warehouses", type=int, default=500)
+    parser.add_argument("--links", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.populate:
+        populate(args.populate, args.warehouses, args.links, args.seed)
+        return
+    asyncio.run(bench(args.url, args.paths, args.requests, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+# Процессорное время на один большой ответ get /orgs/ и get /warehouses/: сборка из БД и сериализация в JSON,
+# через модели pydantic (FAST_JSON=false) и напрямую через orjson (FAST_JSON=true). Вызываются те же функции,
+# что и в обработчиках, без HTTP и без кэша ответов. Нужна БД из .env с данными testing.data_generator, например
+# 2000 организаций по 10 хранилищ - страница из 1000 организаций содержит 10 000 строк:
+#   python -m testing.data_generator --orgs 2000 --warehouses 100 --density 0.1
+#   python -m testing.bench_serialization --limit 1000
+import argparse
+import asyncio
+import json
+import time
+import config
+import database.sql_models as sql
+import response_cache
+from database import queries
+from main import ORGS_PAGE, WAREHOUSES_PAGE
+
+
+async def measure(build, adapter, repeat: int) -> dict:
+    build_s = encode_s = 0.0
+    body = b""
+    async with sql.AsyncSession(sql.async_engine) as session:
+        await build(session)  # прогрев: кэш запросов SQLAlchemy и страницы БД
+        for _ in range(repeat):
+            started = time.process_time()
+            data = await build(session)
+            built = time.process_time()
+            body = response_cache.encode(data, adapter)
+            build_s += built - started
+            encode_s += time.process_time() - built
+    return {
+        "build_cpu_ms": round(build_s / repeat * 1000, 2),
+        "encode_cpu_ms": round(encode_s / repeat * 1000, 2),
+        "total_cpu_ms": round((build_s + encode_s) / repeat * 1000, 2),
+        "bytes": len(body),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сборка и сериализация больших ответов: pydantic против orjson")
+    parser.add_argument("--limit", type=int, default=1000, help="Организаций на странице get /orgs/")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    endpoints = {
+        "GET /orgs/": (lambda session: queries.get_orgs_page(session, 0, args.limit), ORGS_PAGE),
+        "GET /warehouses/": (lambda session: queries.search_warehouses(session, {}, limit=args.limit),
+                             WAREHOUSES_PAGE),
+    }
+    report = {}
+    for name, (build, adapter) in endpoints.items():
+        report[name] = {}
+        for mode, fast_json in (("pydantic", False), ("orjson", True)):
+            config.fast_json = fast_json
+            report[name][mode] = asyncio.run(measure(build, adapter, args.repeat))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# Пропускная способность записи transfer_waste: коммит на каждый запрос против режима одного писателя
+# (database/write_batcher.py). Заявки идут прямо в AllocationIndex.allocate и WriteBatcher.allocate, без HTTP,
+# поэтому замер показывает только запись в БД, а не разбор запросов. Нужна БД из .env с данными
+# testing.data_generator и большими остатками, чтобы заявкам хватало места в обоих прогонах:
+#   python -m testing.data_generator --orgs 20000 --warehouses 500 --density 0.02 --capacity-mean 100000
+#   python -m testing.bench_write_batching --orgs 20000 --requests 5000 --concurrency 100
+# Выгода зависит от стоимости коммита: при SQLITE_SYNCHRONOUS=FULL каждый коммит - fsync, при NORMAL (WAL) - нет
+import argparse
+import asyncio
+import json
+import random
+import time
+import config
+import database.sql_models as sql
+from database.allocation_index import AllocationIndex
+from database.write_batcher import WriteBatcher
+from testing.bench_latency import summary
+
+
+async def run_mode(batching: bool, requests: list, concurrency: int) -> dict:
+    index = AllocationIndex()
+    async with sql.AsyncSession(sql.async_engine) as session:
+        await index.rebuild(session)
+    batcher = WriteBatcher(index)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = {}
+
+    async def one(org_id: int, waste_type: str, quantity: int):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                if batching:
+                    await batcher.allocate(org_id, waste_type, quantity)
+                else:
+                    async with sql.AsyncSession(sql.async_engine) as session:
+                        await index.allocate(session, org_id, waste_type, quantity)
+            except Exception as error:
+                errors[type(error).__name__] = errors.get(type(error).__name__, 0) + 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(*request) for request in requests))
+    result = summary(latencies, time.perf_counter() - started)
+    result["errors"] = errors
+    await batcher.stop()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Коммит на каждый запрос transfer_waste против записи группами")
+    parser.add_argument("--orgs", type=int, required=True, help="Сколько организаций в БД (id от 1)")
+    parser.add_argument("--requests", type=int, default=5000, help="Заявок в каждом режиме")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=config.write_batch_size)
+    parser.add_argument("--batch-wait-ms", type=float, default=config.write_batch_wait_ms)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    config.write_batch_size = args.batch_size
+    config.write_batch_wait_ms = args.batch_wait_ms
+    rng = random.Random(args.seed)
+    requests = [(rng.randint(1, args.orgs), rng.choice(config.waste_types), rng.randint(1, 20))
+                for _ in range(args.requests)]
+    report = {"synchronous": config.sqlite_synchronous, "concurrency": args.concurrency,
+              "batch_size": args.batch_size, "batch_wait_ms": args.batch_wait_ms}
+    for name, batching in (("commit_per_request", False), ("write_batching", True)):
+        report[name] = asyncio.run(run_mode(batching, requests, args.concurrency))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
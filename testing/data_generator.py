@@ -0,0 +1,104 @@
+# Генератор синтетических данных для нагрузочных тестов: N организаций, M хранилищ, граф доступности
+# заданной плотности и остатки по выбранному распределению. Один и тот же seed дает одни и те же данные.
+# Строки пишутся executemany драйвера sqlite3 прямо из генераторов, одной транзакцией: списки в памяти не
+# строятся, 100 тысяч организаций с 10 хранилищами у каждой вставляются за секунды.
+#   python -m testing.data_generator --orgs 100000 --warehouses 2000 --density 0.005 --seed 1
+#   python -m testing.data_generator --orgs 1000 --warehouses 100 --capacity exponential --capacity-mean 200
+import argparse
+import json
+import math
+import random
+import time
+from typing import Iterator
+import config
+import database.sql_models as sql
+
+CAPACITY_DISTRIBUTIONS = ("uniform", "exponential", "pareto")
+
+
+def capacity_sampler(rng: random.Random, distribution: str, mean: int, maximum: int):
+    # uniform - от 0 до 2 * mean; exponential - много малых остатков и мало больших;
+    # pareto - почти все хранилища маленькие, несколько очень больших. Все значения обрезаются до maximum
+    if distribution == "uniform":
+        return lambda: min(rng.randint(0, 2 * mean), maximum)
+    if distribution == "exponential":
+        return lambda: min(int(rng.expovariate(1 / mean)), maximum)
+    if distribution == "pareto":
+        alpha = 1.5  # среднее распределения Парето: alpha / (alpha - 1) * минимум
+        minimum = mean * (alpha - 1) / alpha
+        return lambda: min(int(minimum * rng.paretovariate(alpha)), maximum)
+    raise ValueError(f"Неизвестное распределение остатков: {distribution}")
+
+
+def links_per_org(warehouses: int, density: float) -> int:
+    # density - доля хранилищ, доступных каждой организации; хотя бы одно хранилище доступно всегда
+    return max(1, min(warehouses, math.ceil(warehouses * density)))
+
+
+def generate(orgs: int, warehouses: int, density: float = 0.01, capacity: str = "uniform",
+             capacity_mean: int = 250, capacity_max: int = 10 ** 6, max_distance: int = 1000,
+             waste_types=config.waste_types, seed: int = 1) -> dict:
+    # Добавляет данные к уже существующим (id продолжают текущие). Возвращает диапазоны id и число строк
+    rng = random.Random(seed)
+    sample_capacity = capacity_sampler(rng, capacity, capacity_mean, capacity_max)
+    links = links_per_org(warehouses, density)
+    sql.create_tables()
+    connection = sql.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        first_warehouse = cursor.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM warehouse").fetchone()[0]
+        first_org = cursor.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM organization").fetchone()[0]
+        warehouse_ids = range(first_warehouse, first_warehouse + warehouses)
+        org_ids = range(first_org, first_org + orgs)
+
+        def capacity_rows() -> Iterator[tuple]:
+            for warehouse_id in warehouse_ids:
+                for waste_type in waste_types:
+                    yield warehouse_id, waste_type, sample_capacity()
+
+        def availability_rows() -> Iterator[tuple]:
+            for org_id in org_ids:
+                for warehouse_id in rng.sample(warehouse_ids, links):
+                    yield org_id, warehouse_id, rng.randint(1, max_distance)
+
+        cursor.executemany("INSERT INTO warehouse (id, name) VALUES (?, ?)",
+                           ((warehouse_id, f"МНО {warehouse_id}") for warehouse_id in warehouse_ids))
+        cursor.executemany("INSERT INTO warehousecapacity (warehouse_id, waste_type, remaining) VALUES (?, ?, ?)",
+                           capacity_rows())
+        cursor.executemany("INSERT INTO organization (id, name) VALUES (?, ?)",
+                           ((org_id, f"ОО {org_id}") for org_id in org_ids))
+        cursor.executemany("INSERT INTO warehouseavailability (org_id, warehouse_id, dist) VALUES (?, ?, ?)",
+                           availability_rows())
+        connection.commit()
+    finally:
+        connection.close()
+    return {
+        "orgs": [first_org, first_org + orgs - 1],
+        "warehouses": [first_warehouse, first_warehouse + warehouses - 1],
+        "links_per_org": links,
+        "availability_rows": orgs * links,
+        "capacity_rows": warehouses * len(waste_types),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Синтетические организации, хранилища и расстояния для БД из .env")
+    parser.add_argument("--orgs", type=int, default=1000)
+    parser.add_argument("--warehouses", type=int, default=100)
+    parser.add_argument("--density", type=float, default=0.1, help="Доля хранилищ, доступных каждой организации")
+    parser.add_argument("--capacity", choices=CAPACITY_DISTRIBUTIONS, default="uniform")
+    parser.add_argument("--capacity-mean", type=int, default=250)
+    parser.add_argument("--capacity-max", type=int, default=10 ** 6)
+    parser.add_argument("--max-distance", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    report = generate(args.orgs, args.warehouses, args.density, args.capacity, args.capacity_mean,
+                      args.capacity_max, args.max_distance, seed=args.seed)
+    report["seconds"] = round(time.perf_counter() - started, 2)
+    print(json.dumps(report, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,26 @@
+import asyncio
+import numpy as np
+import json
+import pytest
+import sqlite3
+from contextlib import contextmanager
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
 from fastapi.testclient import TestClient
+from pydantic import ValidationError
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, create_engine, select, text, update
 import os
 
 os.environ['TESTING'] = 'True'  # Эту строку нельзя переносить ниже, иначе app создастся до включения тестового режима
 from main import app
+import metrics
+import response_cache
+import config
+import database.sql_models as sql
+from database import allocation, allocation_index, bulk_import, export, geo, idempotency, migrations, reservations
+from testing import data_generator
 
 client = TestClient(app)
 
@@ -12,6 +30,24 @@ def db_reset():
     client.put("/testing/")
 
 
+@contextmanager
+def count_queries():
+    # SQL-команды обоих движков (синхронного и асинхронного), выполненные внутри блока
+    statements = []
+
+    def listener(connection, cursor, statement, *args):
+        statements.append(statement)
+
+    engines = (sql.engine, sql.async_engine.sync_engine)
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", listener)
+    try:
+        yield statements
+    finally:
+        for engine in engines:
+            event.remove(engine, "before_cursor_execute", listener)
+
+
 def test_read_main():
     db_reset()
     response = client.get("/")
@@ -37,6 +73,8 @@ def test_create_warehouse_bad_request():
     assert response.status_code == 422
     assert response.json() == {"detail": "Указывая лимиты отходов, используйте только числа"
                                }
+    with pytest.raises(ValidationError):
+        sql.CreateWarehouse(name="Название", bio_limit="10т", plastic_limit=20, glass_limit=30)
 
 
 def test_create_org():
@@ -297,6 +335,56 @@ def test_get_specific_warehouse():
     }
 
 
+def test_search_warehouses():
+    db_reset()
+    # Не дальше 650 от организации 1, ближайшие первыми, минимум 20 единиц свободного места для биоотходов
+    url = "/warehouses/?org_id=1&sort=distance&max_distance=650&min_free=bio:20&limit=3"
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.json()[0] == {"warehouse_id": 2, "warehouse_name": "МНО 2",
+                                  "remaining": {"glass": 0, "plastic": 50, "bio": 150}, "distance": 50}
+    assert [(wh["warehouse_id"], wh["distance"]) for wh in response.json()] == [(2, 50), (4, 100), (3, 600)]
+
+    # Следующая страница начинается после пары (расстояние, id) последнего хранилища
+    response = client.get(url + "&after_distance=600&after_warehouse_id=3")
+    assert [(wh["warehouse_id"], wh["distance"]) for wh in response.json()] == [(7, 600), (8, 610), (6, 650)]
+    assert client.get(url + "&after_warehouse_id=3").status_code == 422  # неполный курсор не дает первую страницу
+    assert client.get("/warehouses/?after_distance=600").status_code == 422
+
+    response = client.get("/warehouses/?min_free=glass:100&min_free=bio:20&after_warehouse_id=1")
+    assert [wh["warehouse_id"] for wh in response.json()] == [4, 5]
+
+    # Без организации порог проверяет индекс: ни перебора всех хранилищ, ни чтения строк warehousecapacity
+    executed = []
+
+    def capture(connection, cursor, statement, parameters, *args):
+        executed.append((statement, parameters))
+
+    event.listen(sql.async_engine.sync_engine, "before_cursor_execute", capture)
+    try:
+        response = client.get("/warehouses/?min_free=glass:490&limit=5")
+    finally:
+        event.remove(sql.async_engine.sync_engine, "before_cursor_execute", capture)
+    assert response.json() == []
+    with sql.engine.connect() as connection:
+        plan = " ".join(str(row[-1]) for row in connection.exec_driver_sql(
+            f"EXPLAIN QUERY PLAN {executed[0][0]}", executed[0][1]
+        ))
+    assert "COVERING INDEX ix_warehousecapacity_free_remaining (waste_type=? AND warehouse_id>?)" in plan
+
+    response = client.get("/warehouses/?sort=distance")
+    assert response.status_code == 422
+    assert response.json() == {"detail": "Для max_distance и sort=distance укажите org_id"}
+    assert client.get("/warehouses/?min_free=metal:1").json() == {"detail": "Неизвестные типы отходов: metal"}
+    assert client.get("/warehouses/?min_free=glass").status_code == 422
+
+    # Список расстояний хранилища тоже постраничный
+    response = client.get("/warehouses/5/?limit=1")
+    assert response.json()["distance"] == [{"org_id": 1, "distance": 1200}]
+    response = client.get("/warehouses/5/?after_org_id=1")
+    assert response.json()["distance"] == [{"org_id": 2, "distance": 650}]
+
+
 def test_not_found_specific_warehouse():
     db_reset()
     response = client.get("/warehouses/200")
@@ -330,6 +418,17 @@ def test_transfer_bad_request():
     assert response.json() == {"detail": "Неверный тип отходов. Укажите 'glass', 'plastic' или 'bio'"}
 
 
+def test_transfer_non_positive_quantity():
+    db_reset()
+    for url in ("/transfer_waste/?org_id=2&waste_type=bio&quantity=-50",
+                "/transfer_waste/?org_id=2&waste_type=bio&quantity=0"):
+        assert client.post(url).status_code == 422
+    assert client.get("/transfer_waste/quote/?org_id=2&waste_type=bio&quantity=-5").status_code == 422
+    allocated = {name: dict(values) for name, values in metrics.registry.counters.items()}
+    metrics.record_transfer("bio", -50, 0)  # счетчик не уменьшается
+    assert {name: dict(values) for name, values in metrics.registry.counters.items()} == allocated
+
+
 def test_transfer_too_much_waste():
     db_reset()
     response = client.post("/transfer_waste/?org_id=2&waste_type=bio&quantity=1000")
@@ -338,3 +437,801 @@ def test_transfer_too_much_waste():
         "detail":
             "Невозможно переработать 350 из 1000 единиц отходов: места в хранилищах недостаточно. "
             "Запрос на отправку отходов отменен"}
+
+
+def test_get_all_paginated():
+    db_reset()
+    response = client.get("/orgs/?limit=1")
+    assert response.status_code == 200
+    assert [org["organization_id"] for org in response.json()] == [1]
+
+    response = client.get("/orgs/?after_org_id=1&limit=1")
+    assert response.status_code == 200
+    assert [org["organization_id"] for org in response.json()] == [2]
+    assert [wh["warehouse_id"] for wh in response.json()[0]["warehouses"]] == [3, 5, 6]
+
+    response = client.get("/orgs/?after_org_id=2")
+    assert response.status_code == 200
+    assert response.json() == []
+
+
+def test_concurrent_transfers_never_overbook():
+    db_reset()
+    # У ОО 2 три хранилища с биоотходами: 250 + 150 + 250 = 650. Запрашиваем 40 раз по 20 = 800.
+    # Внутри with все запросы обслуживает один event loop, как в uvicorn
+    with TestClient(app) as shared_client, ThreadPoolExecutor(max_workers=16) as pool:
+        responses = list(pool.map(
+            lambda _: shared_client.post("/transfer_waste/?org_id=2&waste_type=bio&quantity=20"), range(40)
+        ))
+    assert {response.status_code for response in responses} <= {200, 400}
+    accepted = sum(response.status_code == 200 for response in responses)
+    assert accepted == 650 // 20
+
+    with Session(sql.engine) as session:
+        limits = session.exec(select(sql.WarehouseCapacity.remaining).where(
+            sql.WarehouseCapacity.warehouse_id.in_([3, 5, 6]), sql.WarehouseCapacity.waste_type == "bio"
+        )).all()
+        reserved = session.exec(select(sql.Reservation.quantity)).all()
+    assert all(limit >= 0 for limit in limits)
+    assert sum(reserved) == accepted * 20
+    assert sum(limits) == 650 - sum(reserved)
+
+
+def test_transfer_streams():
+    db_reset()
+    streams = {"bio": 30, "glass": 10, "plastic": 10}
+    with count_queries() as statements:
+        response = client.post("/transfer_waste/streams/?org_id=1", json=streams)
+    assert response.status_code == 200
+    assert response.json()["organization_id"] == 1
+    assert {waste_type: stream["allocated"] for waste_type, stream in response.json()["streams"].items()} == {
+        "bio": True, "glass": True, "plastic": True
+    }
+    assert response.json()["streams"]["bio"]["transfer_data"] == [
+        {"warehouse_id": 2, "warehouse_name": "МНО 2", "delivered_quantity": 30, "distance": 50}
+    ]
+    # Хранилища организации читаются один раз для всех типов отходов
+    assert sum("FROM warehouseavailability" in statement for statement in statements) == 1
+    assert reserved_total() == 50
+
+    # atomic: если один поток не помещается, не бронируется ничего; без atomic - остальные потоки
+    streams = {"glass": 10, "bio": 100000}
+    response = client.post("/transfer_waste/streams/?org_id=1&atomic=true", json=streams)
+    assert response.status_code == 400
+    assert response.json()["detail"]["streams"]["bio"]["allocated"] is False
+    assert reserved_total() == 50
+    response = client.post("/transfer_waste/streams/?org_id=1", json=streams)
+    assert [stream["allocated"] for stream in response.json()["streams"].values()] == [True, False]
+    assert reserved_total() == 60
+
+    assert client.post("/transfer_waste/streams/?org_id=1", json={"paper": 1}).status_code == 400
+    assert client.post("/transfer_waste/streams/?org_id=1", json={"bio": 0}).status_code == 422
+    assert client.post("/transfer_waste/streams/?org_id=1", json={}).status_code == 422
+
+
+def test_transfer_quote(monkeypatch):
+    db_reset()
+    url = "/transfer_waste/quote/?org_id=2&waste_type=bio&quantity=400"
+    quote = client.get(url)
+    assert quote.status_code == 200
+    assert quote.json()["allocated"] is True
+    assert sum(transfer["delivered_quantity"] for transfer in quote.json()["transfer_data"]) == 400
+    with count_queries() as statements:
+        assert client.get(url).json() == quote.json()
+    assert statements == []  # повторный план - из кэша
+    assert reserved_total() == 0
+
+    # План совпадает с тем, что забронирует transfer_waste, а бронирование сбрасывает кэш
+    transfer = client.post("/transfer_waste/?org_id=2&waste_type=bio&quantity=400")
+    assert transfer.json()["transfer_data"] == quote.json()["transfer_data"]
+    shortage = client.get(url).json()
+    assert shortage["allocated"] is False
+    assert shortage["detail"] == "Места в хранилищах хватит на 250 из 400 единиц отходов"
+    assert sum(transfer["delivered_quantity"] for transfer in shortage["transfer_data"]) == 250
+
+    # Изменение в обход процесса (другой воркер) видно после истечения срока плана
+    with Session(sql.engine) as session:
+        session.exec(update(sql.WarehouseCapacity).where(sql.WarehouseCapacity.waste_type == "bio")
+                     .values(remaining=1000))
+        session.commit()
+    assert client.get(url).json() == shortage
+    monkeypatch.setattr(config, "quote_cache_ttl_s", 0)
+    assert client.get(url).json()["transfer_data"] == [
+        {**quote.json()["transfer_data"][0], "delivered_quantity": 400}
+    ]
+
+    assert client.get("/transfer_waste/quote/?org_id=100&waste_type=bio&quantity=1").status_code == 404
+    assert client.get("/transfer_waste/quote/?org_id=2&waste_type=paper&quantity=1").status_code == 400
+
+    # Подписки на остатки удаляются вместе с планами: при вытеснении из кэша и при сбросе организации
+    index = allocation_index.index
+    monkeypatch.setattr(config, "quote_cache_ttl_s", 60)
+    monkeypatch.setattr(config, "quote_cache_size", 1)
+    for org_id in (1, 2, 1):
+        client.get(f"/transfer_waste/quote/?org_id={org_id}&waste_type=glass&quantity=1")
+    assert list(index._quotes) == [(1, "glass")]
+    assert {key for key, orgs in index._quote_watchers.items() if 2 in orgs} == set()
+    index.forget_org(1)
+    assert index._quotes == {} and index._quote_watchers == {}
+
+
+def reserved_total() -> int:
+    with Session(sql.engine) as session:
+        return sum(session.exec(select(sql.Reservation.quantity)).all())
+
+
+def test_idempotency_key_replays_response():
+    db_reset()
+    url = "/transfer_waste/?org_id=2&waste_type=bio&quantity=20"
+    first = client.post(url, headers={"Idempotency-Key": "retry-1"})
+    assert first.status_code == 200
+    assert "Idempotent-Replayed" not in first.headers
+    # Повтор и одновременные дубли получают тот же ответ, место бронируется один раз
+    with TestClient(app) as shared_client, ThreadPoolExecutor(max_workers=8) as pool:
+        retries = list(pool.map(lambda _: shared_client.post(url, headers={"Idempotency-Key": "retry-1"}), range(8)))
+    assert [(retry.status_code, retry.json()) for retry in retries] == [(200, first.json())] * 8
+    assert all(retry.headers["Idempotent-Replayed"] == "true" for retry in retries)
+    assert reserved_total() == 20
+
+    with TestClient(app) as shared_client, ThreadPoolExecutor(max_workers=8) as pool:
+        fresh = list(pool.map(lambda _: shared_client.post(url, headers={"Idempotency-Key": "retry-2"}), range(8)))
+    assert {response.json()["transfer_data"][0]["delivered_quantity"] for response in fresh} == {20}
+    assert sum("Idempotent-Replayed" in response.headers for response in fresh) == 7
+    assert reserved_total() == 40
+
+    response = client.post("/transfer_waste/?org_id=2&waste_type=bio&quantity=5",
+                           headers={"Idempotency-Key": "retry-1"})
+    assert response.status_code == 422
+    assert response.json()["detail"] == "Ключ Idempotency-Key уже использован для запроса с другими параметрами"
+
+    # Ошибка не сохраняется: после освобождения места повтор с тем же ключом выполняется заново
+    batch = [{"org_id": 1, "waste_type": "bio", "quantity": 30}]
+    response = client.post("/transfer_waste/batch/", json=batch, headers={"Idempotency-Key": "retry-1"})
+    assert response.json()["results"][0]["allocated"] is True
+    replay = client.post("/transfer_waste/batch/", json=batch, headers={"Idempotency-Key": "retry-1"})
+    assert replay.json() == response.json() and replay.headers["Idempotent-Replayed"] == "true"
+    assert reserved_total() == 70
+
+
+def test_idempotency_key_duplicate_from_other_worker(monkeypatch):
+    db_reset()
+    url = "/transfer_waste/?org_id=2&waste_type=bio&quantity=20"
+    winner = json.dumps({"organization_id": 2, "waste_type": "bio", "initial_quantity": 20, "transfer_data": []})
+    lookup = idempotency.lookup
+    calls = []
+
+    async def racing_lookup(session, scope, key, request_fingerprint):
+        # Другой воркер сохраняет ответ между проверкой ключа и бронированием в этом процессе
+        calls.append(key)
+        if len(calls) == 1:
+            with Session(sql.engine) as other:
+                other.add(sql.IdempotencyKey(scope=scope, key=key, fingerprint=request_fingerprint, response=winner))
+                other.commit()
+            return None
+        return await lookup(session, scope, key, request_fingerprint)
+
+    monkeypatch.setattr(idempotency, "lookup", racing_lookup)
+    response = client.post(url, headers={"Idempotency-Key": "race"})
+    assert response.status_code == 200
+    assert response.json() == json.loads(winner)
+    assert reserved_total() == 0
+    assert client.post(url).json()["transfer_data"][0]["delivered_quantity"] == 20  # индекс в памяти не потерял место
+
+    # Устаревшие ключи и самые старые сверх лимита удаляются
+    monkeypatch.setattr(idempotency, "lookup", lookup)
+    monkeypatch.setattr(idempotency, "PURGE_EVERY", 1)
+    monkeypatch.setattr(config, "idempotency_max_keys", 2)
+    for number in range(4):
+        client.post("/transfer_waste/?org_id=2&waste_type=bio&quantity=1", headers={"Idempotency-Key": f"k{number}"})
+    with Session(sql.engine) as session:
+        assert sorted(session.exec(select(sql.IdempotencyKey.key)).all()) == ["k2", "k3"]
+
+
+def test_write_batching_groups_transfers(monkeypatch):
+    db_reset()
+    monkeypatch.setattr(config, "write_batching", True)
+    monkeypatch.setattr(config, "write_batch_wait_ms", 50)
+    metrics.registry.clear()
+    # Те же 40 заявок по 20, что и в test_concurrent_transfers_never_overbook, и 4 заявки несуществующей ОО
+    urls = ["/transfer_waste/?org_id=2&waste_type=bio&quantity=20"] * 40
+    urls += ["/transfer_waste/?org_id=100&waste_type=bio&quantity=1"] * 4
+    with TestClient(app) as shared_client, ThreadPoolExecutor(max_workers=16) as pool:
+        responses = list(pool.map(shared_client.post, urls))
+    assert [response.status_code for response in responses[40:]] == [404] * 4
+    assert {response.status_code for response in responses[:40]} == {200, 400}
+    assert sum(response.status_code == 200 for response in responses) == 650 // 20
+    assert reserved_total() == 650 // 20 * 20
+    groups = metrics.registry.histograms["write_batch_size"][()]
+    assert groups.sum == 44 and groups.count < 44  # отказы не мешают остальным заявкам своей группы
+    assert "write_batch_queue_depth 0" in client.get("/metrics").text
+
+
+def test_transfer_batch_per_item():
+    db_reset()
+    response = client.post("/transfer_waste/batch/", json=[
+        {"org_id": 1, "waste_type": "bio", "quantity": 30},
+        {"org_id": 2, "waste_type": "bio", "quantity": 1000},
+        {"org_id": 2, "waste_type": "glass", "quantity": 100},
+    ])
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["allocated"] for result in results] == [True, False, True]
+    assert results[0]["transfer_data"] == [
+        {"warehouse_id": 2, "warehouse_name": "МНО 2", "delivered_quantity": 30, "distance": 50}
+    ]
+    assert results[1]["detail"] == ("Невозможно переработать 350 из 1000 единиц отходов: места в хранилищах "
+                                    "недостаточно. Запрос на отправку отходов отменен")
+    assert results[2]["transfer_data"] == [
+        {"warehouse_id": 5, "warehouse_name": "МНО 6", "delivered_quantity": 100, "distance": 650}
+    ]
+    assert client.get("/warehouses/2").json()["bio_limit"] == 120
+    assert client.get("/warehouses/5").json()["glass_limit"] == 0
+    assert client.get("/warehouses/3").json()["bio_limit"] == 250
+
+
+def test_transfer_batch_atomic():
+    db_reset()
+    response = client.post("/transfer_waste/batch/?atomic=true", json=[
+        {"org_id": 1, "waste_type": "bio", "quantity": 30},
+        {"org_id": 2, "waste_type": "bio", "quantity": 1000},
+    ])
+    assert response.status_code == 400
+    assert [result["allocated"] for result in response.json()["detail"]["results"]] == [True, False]
+    assert client.get("/warehouses/2").json()["bio_limit"] == 150
+
+
+def test_transfer_batch_optimal_strategy():
+    db_reset()
+    # Жадно ОО 1 займет часть ближайшего к ОО 2 хранилища МНО 3, и ОО 2 не хватит места.
+    # Оптимальное распределение отправит ОО 1 в другие хранилища, и обе заявки будут приняты
+    batch = [{"org_id": 1, "waste_type": "bio", "quantity": 240},
+             {"org_id": 2, "waste_type": "bio", "quantity": 650}]
+    response = client.post("/transfer_waste/batch/?strategy=greedy&atomic=true", json=batch)
+    assert response.status_code == 400
+
+    response = client.post("/transfer_waste/batch/?strategy=optimal&atomic=true", json=batch)
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["allocated"] for result in results] == [True, True]
+    assert 3 not in [transfer["warehouse_id"] for transfer in results[0]["transfer_data"]]
+    assert sum(transfer["delivered_quantity"] for transfer in results[0]["transfer_data"]) == 240
+    assert sum(transfer["delivered_quantity"] for transfer in results[1]["transfer_data"]) == 650
+
+
+def test_sqlite_profile_applied():
+    with sql.engine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1  # NORMAL
+        assert connection.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+
+
+def test_retry_on_busy():
+    calls = []
+
+    @sql.retry_on_busy
+    async def flaky_write():
+        calls.append(1)
+        if len(calls) < 3:
+            raise OperationalError("UPDATE warehouse", {}, sqlite3.OperationalError("database is locked"))
+        return "ok"
+
+    assert asyncio.run(flaky_write()) == "ok"
+    assert len(calls) == 3
+
+
+def test_migrations_upgrade_existing_db(tmp_path):
+    # Схема до появления миграций: индексы только на org_id и warehouse_id
+    legacy_db = sqlite3.connect(tmp_path / "legacy_db")
+    legacy_db.executescript("""
+        CREATE TABLE warehouseavailability (id INTEGER PRIMARY KEY, org_id INTEGER NOT NULL,
+                                            warehouse_id INTEGER NOT NULL, dist INTEGER NOT NULL);
+        CREATE INDEX ix_warehouseavailability_org_id ON warehouseavailability (org_id);
+        CREATE INDEX ix_warehouseavailability_warehouse_id ON warehouseavailability (warehouse_id);
+        CREATE TABLE reservation (id INTEGER PRIMARY KEY, from_org INTEGER NOT NULL, to_warehouse INTEGER NOT NULL,
+                                  waste_type VARCHAR NOT NULL, quantity INTEGER NOT NULL, accepted BOOLEAN NOT NULL);
+        INSERT INTO warehouseavailability (org_id, warehouse_id, dist) VALUES (1, 1, 10), (1, 1, 20), (1, 2, 30);
+        INSERT INTO reservation (from_org, to_warehouse, waste_type, quantity, accepted)
+        VALUES (1, 1, 'bio', 5, 1), (1, 1, 'bio', 7, 0), (1, 2, 'glass', 3, 1);
+    """)
+    legacy_db.close()
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy_db'}")
+    assert migrations.migrate(engine) == len(migrations.MIGRATIONS)
+    assert migrations.migrate(engine) == len(migrations.MIGRATIONS)  # повторный запуск ничего не делает
+    with engine.connect() as connection:
+        indexes = {row[0] for row in connection.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND name NOT LIKE 'sqlite_%'"
+        )}
+        rows = connection.exec_driver_sql("SELECT org_id, warehouse_id, dist FROM warehouseavailability").all()
+        confirmed = connection.exec_driver_sql(
+            "SELECT id, confirmed_at = created_at FROM reservation ORDER BY id"
+        ).all()
+        daily = connection.exec_driver_sql(
+            "SELECT warehouse_id, waste_type, reserved_count, reserved_quantity, cancelled_count, cancelled_quantity, "
+            "distance_sum FROM reservationdaily ORDER BY warehouse_id"
+        ).all()
+    assert indexes == {
+        "ix_warehouseavailability_warehouse_org_dist",
+        "ix_warehouseavailability_org_dist_warehouse",
+        "ux_warehouseavailability_org_warehouse",
+        "ix_reservation_from_org",
+        "ix_reservation_to_warehouse",
+        "ix_reservation_accepted",
+        "ix_reservation_pending",
+    }
+    assert sorted(rows) == [(1, 1, 10), (1, 2, 30)]
+    assert daily == [(1, "bio", 2, 12, 1, 7, 20), (2, "glass", 1, 3, 0, 0, 30)]
+    assert confirmed == [(1, 1), (2, None), (3, 1)]  # старые действующие брони не отменятся автоматически
+    engine.dispose()
+
+
+def test_transfer_query_uses_covering_index():
+    db_reset()
+    with sql.engine.connect() as connection:
+        plan = " ".join(str(row[-1]) for row in connection.exec_driver_sql(
+            "EXPLAIN QUERY PLAN SELECT warehouse_id, dist FROM warehouseavailability WHERE org_id = 1 ORDER BY dist"
+        ))
+    assert "COVERING INDEX ix_warehouseavailability_org_dist_warehouse" in plan
+
+
+def test_transfer_index_follows_cancellation_and_topology():
+    db_reset()
+    response = client.post("/transfer_waste/?org_id=2&waste_type=bio&quantity=650")
+    assert response.status_code == 200
+    assert client.post("/transfer_waste/?org_id=2&waste_type=bio&quantity=1").status_code == 400
+
+    # Отмена заказа возвращает место: заказ 1 - 250 единиц в МНО 3
+    response = client.patch("/order/1", json={"accepted": False})
+    assert response.status_code == 200
+    response = client.post("/transfer_waste/?org_id=2&waste_type=bio&quantity=250")
+    assert response.status_code == 200
+    assert response.json()["transfer_data"] == [
+        {"warehouse_id": 3, "warehouse_name": "МНО 3", "delivered_quantity": 250, "distance": 50}
+    ]
+
+    # Новое хранилище и новая организация сразу участвуют в распределении
+    client.post("/warehouses/", json={"name": "МНО 10", "bio_limit": 40, "plastic_limit": 0, "glass_limit": 0})
+    client.post("/orgs/", json={"name": "ОО 3", "warehouses": {"9": 5, "3": 1}})
+    response = client.post("/transfer_waste/?org_id=3&waste_type=bio&quantity=40")
+    assert response.status_code == 200
+    assert response.json()["transfer_data"] == [
+        {"warehouse_id": 9, "warehouse_name": "МНО 10", "delivered_quantity": 40, "distance": 5}
+    ]
+
+
+def test_transfer_index_recovers_from_external_changes():
+    db_reset()
+    assert client.post("/transfer_waste/?org_id=2&waste_type=bio&quantity=10").status_code == 200
+    # Лимиты изменились в обход этого процесса (например, другим воркером)
+    with Session(sql.engine) as session:
+        for warehouse_id, remaining in [(3, 0), (5, 1000)]:
+            session.exec(update(sql.WarehouseCapacity).where(
+                sql.WarehouseCapacity.warehouse_id == warehouse_id, sql.WarehouseCapacity.waste_type == "bio"
+            ).values(remaining=remaining))
+        session.commit()
+    response = client.post("/transfer_waste/?org_id=2&waste_type=bio&quantity=1200")
+    assert response.status_code == 200
+    assert [(transfer["warehouse_id"], transfer["delivered_quantity"])
+            for transfer in response.json()["transfer_data"]] == [(6, 250), (5, 950)]
+
+
+def test_transfer_index_releases_hold_on_cancel(monkeypatch):
+    # Запрос отменен (клиент отключился) посреди записи: отметка о брони снимается, остаток не занижается
+    db_reset()
+
+    async def cancelled(*args, **kwargs):
+        raise asyncio.CancelledError
+
+    async def allocate():
+        async with sql.AsyncSession(sql.async_engine) as session:
+            try:
+                await allocation_index.index.allocate(session, 2, "bio", 10)
+            except asyncio.CancelledError:
+                return "cancelled"
+
+    monkeypatch.setattr(allocation, "try_reserve", cancelled)
+    with TestClient(app) as app_client:
+        assert app_client.portal.call(allocate) == "cancelled"
+    monkeypatch.undo()
+    assert allocation_index.index._pending == {}
+    response = client.get("/transfer_waste/quote/?org_id=2&waste_type=bio&quantity=650")
+    assert response.json()["allocated"] is True
+
+
+def test_migrations_move_limits_to_capacity_table(tmp_path):
+    legacy_db = sqlite3.connect(tmp_path / "legacy_db")
+    legacy_db.executescript("""
+        CREATE TABLE warehouse (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL, bio_limit INTEGER NOT NULL,
+                                plastic_limit INTEGER NOT NULL, glass_limit INTEGER NOT NULL);
+        CREATE TABLE warehouseavailability (id INTEGER PRIMARY KEY, org_id INTEGER NOT NULL,
+                                            warehouse_id INTEGER NOT NULL, dist INTEGER NOT NULL);
+        CREATE TABLE reservation (id INTEGER PRIMARY KEY, from_org INTEGER NOT NULL, to_warehouse INTEGER NOT NULL,
+                                  waste_type VARCHAR NOT NULL, quantity INTEGER NOT NULL, accepted BOOLEAN NOT NULL);
+        INSERT INTO warehouse (name, bio_limit, plastic_limit, glass_limit) VALUES ('МНО 1', 0, 100, 300);
+    """)
+    legacy_db.close()
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy_db'}")
+    migrations.migrate(engine)
+    with engine.connect() as connection:
+        columns = [row[1] for row in connection.exec_driver_sql("PRAGMA table_info(warehouse)")]
+        rows = connection.exec_driver_sql("SELECT warehouse_id, waste_type, remaining FROM warehousecapacity").all()
+        plan = " ".join(str(row[-1]) for row in connection.exec_driver_sql(
+            "EXPLAIN QUERY PLAN SELECT warehouse_id FROM warehousecapacity WHERE waste_type = 'glass' AND remaining > 0"
+        ))
+    assert columns == ["id", "name", "lat", "lon", "geo_cell"]
+    assert sorted(rows) == [(1, "bio", 0), (1, "glass", 300), (1, "plastic", 100)]
+    assert "ix_warehousecapacity_free_remaining" in plan
+    engine.dispose()
+
+
+def test_new_waste_type_without_schema_change(monkeypatch):
+    db_reset()
+    monkeypatch.setattr(allocation, "WASTE_TYPES", ("glass", "plastic", "bio", "metal"))
+    response = client.post("/warehouses/", json={"name": "МНО 10", "bio_limit": 5, "plastic_limit": 0,
+                                                 "glass_limit": 0, "limits": {"metal": 70}})
+    assert response.status_code == 201
+    assert response.json() == {"bio_limit": 5, "name": "МНО 10", "glass_limit": 0, "id": 9, "plastic_limit": 0}
+    client.post("/orgs/", json={"name": "ОО 3", "warehouses": {"9": 15}})
+    response = client.post("/transfer_waste/?org_id=3&waste_type=metal&quantity=50")
+    assert response.status_code == 200
+    assert response.json()["transfer_data"] == [
+        {"warehouse_id": 9, "warehouse_name": "МНО 10", "delivered_quantity": 50, "distance": 15}
+    ]
+    assert client.post("/transfer_waste/?org_id=3&waste_type=metal&quantity=21").status_code == 400
+    assert client.get("/warehouses/9").json()["bio_limit"] == 5
+
+    response = client.post("/warehouses/", json={"name": "МНО 11", "bio_limit": 0, "plastic_limit": 0,
+                                                 "glass_limit": 0, "limits": {"paper": 10}})
+    assert response.status_code == 422
+
+
+def test_import_warehouses_orgs_and_distances(monkeypatch):
+    db_reset()
+    monkeypatch.setattr(config, "import_chunk_size", 2)  # несколько транзакций на один файл
+    warehouses_csv = ("id,name,bio_limit,plastic_limit,glass_limit\n"
+                      "20,МНО 20,10,0,5\n"
+                      ",\"МНО, без id\",1,2,3\n"
+                      "1,МНО дубль,1,1,1\n"
+                      "21,МНО 21,много,0,0\n")
+    response = client.post("/import/warehouses/?format=csv", content=warehouses_csv.encode())
+    assert response.status_code == 200
+    assert response.json() == {"imported": 2, "failed": 2, "errors": [
+        {"line": 4, "detail": "Хранилище 1 уже есть в базе данных"},
+        {"line": 5, "detail": "Поле bio_limit: ожидается целое число"},
+    ]}
+    assert client.get("/warehouses/20").json()["glass_limit"] == 5
+    assert client.get("/warehouses/21").json()["warehouse_name"] == "МНО, без id"
+
+    orgs_ndjson = ('{"id": 10, "name": "ОО 10", "warehouses": {"20": 7}}\n'
+                   '{"name": "ОО 11"}\n'
+                   'не json\n'
+                   '{"name": "ОО 12", "warehouses": {"999": 1}}\n')
+    response = client.post("/import/orgs/", content=orgs_ndjson.encode())
+    assert response.json() == {"imported": 2, "failed": 2, "errors": [
+        {"line": 3, "detail": "Строка не является JSON-объектом"},
+        {"line": 4, "detail": "Хранилище 999 не найдено"},
+    ]}
+
+    distances_csv = "org_id,warehouse_id,dist\n11,20,3\n11,20,4\n10,20,1\n404,20,1\n"
+    response = client.post("/import/distances/?format=csv", content=distances_csv.encode())
+    assert response.json()["imported"] == 1
+    assert [error["line"] for error in response.json()["errors"]] == [3, 4, 5]
+
+    response = client.post("/transfer_waste/?org_id=11&waste_type=bio&quantity=10")
+    assert response.json()["transfer_data"] == [
+        {"warehouse_id": 20, "warehouse_name": "МНО 20", "delivered_quantity": 10, "distance": 3}
+    ]
+    assert client.post("/transfer_waste/?org_id=10&waste_type=bio&quantity=1").status_code == 400
+
+
+def test_import_stream_parses_incrementally():
+    async def chunks():
+        # Куски режут строки и даже символы UTF-8 посередине
+        data = 'name,bio_limit\n"МНО\nдвухстрочное",5\nМНО 2,6\n'.encode()
+        for position in range(0, len(data), 3):
+            yield data[position:position + 3]
+
+    async def collect():
+        return [record async for record in bulk_import.parse_records(chunks(), "csv")]
+
+    assert asyncio.run(collect()) == [(2, {"name": "МНО\nдвухстрочное", "bio_limit": "5"}),
+                                      (4, {"name": "МНО 2", "bio_limit": "6"})]
+
+
+def test_expired_reservations_are_released(monkeypatch):
+    db_reset()
+    monkeypatch.setattr(config, "reservation_ttl_s", 72 * 3600)
+    for quantity in (100, 30, 20):
+        assert client.post(f"/transfer_waste/?org_id=2&waste_type=bio&quantity={quantity}").status_code == 200
+    client.patch("/order/2", json={"accepted": True})  # доставка подтверждена
+    with Session(sql.engine) as session:
+        session.exec(update(sql.Reservation).where(sql.Reservation.id.in_([1, 2]))
+                     .values(created_at=sql.utcnow() - timedelta(seconds=config.reservation_ttl_s + 1)))
+        session.commit()
+
+    with TestClient(app) as app_client:
+        released = app_client.portal.call(reservations.sweep, allocation_index.index)
+    assert released == 1
+    with Session(sql.engine) as session:
+        orders = session.exec(select(sql.Reservation.id, sql.Reservation.accepted).order_by(sql.Reservation.id)).all()
+        plan = " ".join(str(row[-1]) for row in session.exec(
+            text(f"EXPLAIN QUERY PLAN {reservations.EXPIRED_RESERVATIONS}"), params={"cutoff": "", "limit": 1000}
+        ))
+    assert orders == [(1, False), (2, True), (3, True)]
+    assert "ix_reservation_pending" in plan
+    assert client.get("/warehouses/3").json()["bio_limit"] == 250 - 150 + 100
+    response = client.post("/transfer_waste/?org_id=2&waste_type=bio&quantity=200")  # место видно и индексу
+    assert response.json()["transfer_data"][0] == {
+        "warehouse_id": 3, "warehouse_name": "МНО 3", "delivered_quantity": 200, "distance": 50
+    }
+
+
+def test_bulk_order_updates_refund_once():
+    db_reset()
+    for quantity in (100, 30, 20):  # заказы 1-3, все в МНО 3
+        assert client.post(f"/transfer_waste/?org_id=2&waste_type=bio&quantity={quantity}").status_code == 200
+    updates = [{"order_id": 1, "accepted": False}, {"order_id": 2, "accepted": False},
+               {"order_id": 3, "accepted": True}, {"order_id": 99, "accepted": False}]
+    response = client.patch("/orders/", json=updates)
+    assert response.status_code == 200
+    assert response.json()["updated"] == 3
+    assert response.json()["refunded"] == [{"warehouse_id": 3, "waste_type": "bio", "quantity": 130}]
+    assert response.json()["results"][3] == {"order_id": 99, "accepted": False, "updated": False,
+                                             "detail": "Заказа с id 99 нет в базе данных"}
+    assert client.get("/warehouses/3").json()["bio_limit"] == 250 - 150 + 130
+
+    # Повторная отмена и подтверждение отмененного заказа ничего не меняют
+    response = client.patch("/orders/", json=updates[:3] + [{"order_id": 2, "accepted": True}])
+    assert response.json()["updated"] == 1  # заказ 3 подтверждается повторно
+    assert response.json()["refunded"] == []
+    assert client.patch("/order/1", json={"accepted": False}).status_code == 200
+    assert client.patch("/order/1", json={"accepted": True}).status_code == 409
+    assert client.get("/warehouses/3").json()["bio_limit"] == 250 - 150 + 130
+    with Session(sql.engine) as session:
+        orders = session.exec(select(sql.Reservation.id, sql.Reservation.accepted,
+                                     sql.Reservation.confirmed_at.is_not(None)).order_by(sql.Reservation.id)).all()
+    assert orders == [(1, False, False), (2, False, False), (3, True, True)]
+
+
+def test_reservation_analytics_from_daily_rollups():
+    db_reset()
+    for quantity in (100, 30):  # заказы 1-2 - ОО 2, МНО 3, расстояние 50
+        assert client.post(f"/transfer_waste/?org_id=2&waste_type=bio&quantity={quantity}").status_code == 200
+    response = client.post("/transfer_waste/batch/", json=[{"org_id": 1, "waste_type": "glass", "quantity": 10}])
+    assert response.status_code == 200
+    distance = response.json()["results"][0]["transfer_data"][0]["distance"]
+    client.patch("/order/1", json={"accepted": False})
+    client.patch("/order/1", json={"accepted": False})  # повторная отмена не учитывается
+
+    today = sql.utcnow().date().isoformat()
+    response = client.get("/analytics/reservations/?group_by=org_id&group_by=waste_type")
+    assert response.status_code == 200
+    assert response.json() == [
+        {"org_id": 1, "waste_type": "glass", "reserved_count": 1, "reserved_quantity": 10, "cancelled_count": 0,
+         "cancelled_quantity": 0, "cancellation_rate": 0.0, "average_distance": distance},
+        {"org_id": 2, "waste_type": "bio", "reserved_count": 2, "reserved_quantity": 130, "cancelled_count": 1,
+         "cancelled_quantity": 100, "cancellation_rate": 0.5, "average_distance": 50.0},
+    ]
+    response = client.get(f"/analytics/reservations/?date_from={today}&warehouse_id=3")
+    assert [(row["day"], row["reserved_quantity"]) for row in response.json()] == [(today, 130)]
+    assert client.get("/analytics/reservations/?date_to=2000-01-01").json() == []
+
+
+def test_export_reservations_streams_and_resumes(monkeypatch):
+    db_reset()
+    for quantity in (10, 20, 30, 40, 50):
+        assert client.post(f"/transfer_waste/?org_id=2&waste_type=bio&quantity={quantity}").status_code == 200
+    client.patch("/order/2", json={"accepted": False})
+    monkeypatch.setattr(config, "export_page_size", 2)  # несколько страниц по курсору
+    monkeypatch.setattr(config, "export_chunk_size", 1)
+
+    response = client.get("/reservations/export/")
+    assert response.headers["content-type"] == "application/x-ndjson"
+    orders = [json.loads(line) for line in response.text.splitlines()]
+    assert [(order["id"], order["quantity"], order["accepted"]) for order in orders] == [
+        (1, 10, True), (2, 20, False), (3, 30, True), (4, 40, True), (5, 50, True)
+    ]
+    assert orders[0]["to_warehouse"] == 3 and orders[0]["confirmed_at"] is None
+
+    # Продолжение с курсора, ограничение по id и числу строк, CSV
+    response = client.get("/reservations/export/?format=csv&after_id=2&until_id=4")
+    assert response.text.splitlines()[0] == ",".join(export.COLUMNS)
+    assert [line.split(",")[:6] for line in response.text.splitlines()[1:]] == [
+        ["3", "2", "3", "bio", "30", "true"], ["4", "2", "3", "bio", "40", "true"]
+    ]
+    response = client.get("/reservations/export/?after_id=1&limit=3")
+    assert [json.loads(line)["id"] for line in response.text.splitlines()] == [2, 3, 4]
+    response = client.get(f"/reservations/export/?created_to={orders[0]['created_at']}")
+    assert response.text == ""
+
+
+def test_read_endpoints_etag_and_invalidation():
+    db_reset()
+    cache = response_cache.cache
+    response = client.get("/warehouses/3/")
+    etag = response.headers["etag"]
+    hits = cache.hits
+    response = client.get("/warehouses/3/", headers={"If-None-Match": etag})
+    assert response.status_code == 304 and response.headers["etag"] == etag
+    assert cache.hits == hits + 1
+
+    # Запись через API и запись в обход приложения (другое соединение) меняют ответ и ETag
+    client.post("/transfer_waste/?org_id=2&waste_type=bio&quantity=50")
+    response = client.get("/warehouses/3/", headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.json()["bio_limit"] == 200
+    etag = response.headers["etag"]
+    with Session(sql.engine) as session:
+        session.exec(update(sql.WarehouseCapacity).where(sql.WarehouseCapacity.warehouse_id == 3,
+                                                         sql.WarehouseCapacity.waste_type == "bio").values(remaining=7))
+        session.commit()
+    response = client.get("/warehouses/3/", headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.json()["bio_limit"] == 7
+    assert client.get("/orgs/99/").status_code == 404
+
+
+def test_fast_json_matches_pydantic(monkeypatch):
+    # Ответы, собранные напрямую через orjson, совпадают до байта с ответами через модели pydantic
+    db_reset()
+    monkeypatch.setattr(response_cache.cache, "max_entries", 0)
+    urls = ["/orgs/", "/orgs/?after_org_id=1", "/orgs/2/", "/warehouses/2/", "/warehouses/?org_id=1&sort=distance"]
+    bodies = {}
+    for fast_json in (True, False):
+        monkeypatch.setattr(config, "fast_json", fast_json)
+        bodies[fast_json] = [(client.get(url).content, client.get(url).headers["etag"]) for url in urls]
+    assert bodies[True] == bodies[False]
+
+
+def test_response_cache_lru():
+    cache = response_cache.ResponseCache(max_entries=2)
+    for key in ("a", "b"):
+        cache.put(key, 0, key, b"{}")
+    assert cache.get("a", 0) == ("a", b"{}")  # "b" теперь самый старый
+    cache.put("c", 0, "c", b"{}")
+    assert len(cache) == 2 and cache.get("b", 0) is None
+    cache.bump()
+    assert cache.get("a", cache.current_version()) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_data_generator_density_and_seed():
+    client.delete("/testing/")
+    report = data_generator.generate(orgs=50, warehouses=20, density=0.25, capacity="pareto", seed=7)
+    assert report["orgs"] == [1, 50] and report["links_per_org"] == 5
+    with Session(sql.engine) as session:
+        links = session.exec(text("SELECT org_id, COUNT(*) FROM warehouseavailability GROUP BY org_id")).all()
+        first = session.exec(text("SELECT warehouse_id, dist FROM warehouseavailability ORDER BY id LIMIT 5")).all()
+        capacity_rows = session.exec(text("SELECT COUNT(*) FROM warehousecapacity")).one()[0]
+    assert len(links) == 50 and {count for _, count in links} == {5}
+    assert capacity_rows == 20 * len(config.waste_types)
+    client.delete("/testing/")
+    data_generator.generate(orgs=50, warehouses=20, density=0.25, capacity="pareto", seed=7)
+    with Session(sql.engine) as session:
+        rows = session.exec(text("SELECT warehouse_id, dist FROM warehouseavailability ORDER BY id LIMIT 5")).all()
+        assert rows == first
+
+
+def test_metrics_endpoint(monkeypatch, caplog):
+    db_reset()
+    metrics.registry.clear()
+    client.get("/warehouses/3/")
+    client.post("/transfer_waste/?org_id=2&waste_type=bio&quantity=50")
+    client.post("/transfer_waste/?org_id=2&waste_type=bio&quantity=100000")
+    monkeypatch.setattr(config, "slow_query_ms", 0.000001)
+    with caplog.at_level("WARNING", logger="metrics"):
+        client.get("/warehouses/4/")
+    assert "Медленный SQL-запрос" in caplog.text
+
+    response = client.get("/metrics")
+    assert response.headers["content-type"].startswith("text/plain")
+    lines = response.text.splitlines()
+    assert 'http_requests_total{method="GET",route="/warehouses/{warehouse_id}/",status="200"} 2.0' in lines
+    assert 'http_requests_total{method="POST",route="/transfer_waste/",status="400"} 1.0' in lines
+    assert 'http_request_duration_seconds_count{method="GET",route="/warehouses/{warehouse_id}/"} 2' in lines
+    assert 'waste_allocated_quantity_total{waste_type="bio"} 50.0' in lines
+    assert 'waste_rejected_quantity_total{waste_type="bio"} 100000.0' in lines
+    sql_line = next(line for line in lines
+                    if line.startswith('http_request_sql_statements_sum{method="GET",route="/warehouses/'))
+    assert float(sql_line.split()[-1]) >= 2  # по одному запросу на каждый GET
+
+
+# Запросы ко всем endpoint'ам (кроме /testing/) в порядке, в котором они выполнимы на свежих данных:
+# брони создаются раньше, чем их подтверждают и выгружают
+QUERY_COUNT_REQUESTS = [
+    ("GET", "/", {}),
+    ("GET", "/orgs/?limit=100", {}),
+    ("GET", "/orgs/1/", {}),
+    ("GET", "/warehouses/1/", {}),
+    ("GET", "/warehouses/?org_id=1&sort=distance&max_distance=500&min_free=glass:1", {}),
+    ("POST", "/warehouses/", {"json": {"name": "МНО", "bio_limit": 10, "plastic_limit": 10, "glass_limit": 10}}),
+    ("POST", "/orgs/", {"json": {"name": "ОО", "warehouses": {"1": 5, "2": 7}}}),
+    ("POST", "/warehouses/", {"json": {"name": "МНО гео", "bio_limit": 10, "plastic_limit": 10, "glass_limit": 10,
+                              "lat": 55.75, "lon": 37.62}}),
+    ("POST", "/orgs/", {"json": {"name": "ОО гео", "lat": 55.76, "lon": 37.6}}),
+    ("GET", "/transfer_waste/quote/?org_id=1&waste_type=glass&quantity=5", {}),
+    ("GET", "/transfer_waste/quote/?org_id=1&waste_type=glass&quantity=5", {}),
+    ("POST", "/transfer_waste/?org_id=1&waste_type=bio&quantity=1", {}),
+    ("POST", "/transfer_waste/?org_id=2&waste_type=glass&quantity=1", {}),
+    ("POST", "/transfer_waste/?org_id=2&waste_type=glass&quantity=1", {"headers": {"Idempotency-Key": "count"}}),
+    ("POST", "/transfer_waste/?org_id=2&waste_type=glass&quantity=1", {"headers": {"Idempotency-Key": "count"}}),
+    ("POST", "/transfer_waste/batch/", {"json": [{"org_id": 3, "waste_type": "bio", "quantity": 1},
+                                                 {"org_id": 4, "waste_type": "plastic", "quantity": 1}]}),
+    ("POST", "/transfer_waste/streams/?org_id=5", {"json": {"bio": 1, "glass": 1, "plastic": 1}}),
+    ("PATCH", "/order/1", {"json": {"accepted": True}}),
+    ("PATCH", "/orders/", {"json": [{"order_id": 2, "accepted": False}, {"order_id": 3, "accepted": True}]}),
+    ("GET", "/analytics/reservations/?group_by=org_id", {}),
+    ("GET", "/reservations/export/?limit=2", {}),
+    ("POST", "/import/warehouses/", {"content": '{"name": "МНО 1", "bio_limit": 1}\n{"name": "МНО 2"}\n'}),
+    ("GET", "/metrics", {}),
+]
+
+
+def endpoint_query_counts(orgs: int, warehouses: int, density: float) -> dict:
+    client.delete("/testing/")
+    data_generator.generate(orgs=orgs, warehouses=warehouses, density=density, seed=3)
+    counts = {}
+    for method, url, kwargs in QUERY_COUNT_REQUESTS:
+        with count_queries() as statements:
+            response = client.request(method, url, **kwargs)
+        assert response.status_code < 400, (method, url, response.text)
+        name = f"{method} {url}"
+        while name in counts:  # повтор того же запроса, например с тем же Idempotency-Key
+            name += " (повтор)"
+        counts[name] = len(statements)
+    return counts
+
+
+def test_query_count_does_not_grow_with_data(monkeypatch):
+    # Число SQL-команд на запрос не должно зависеть от числа организаций и хранилищ (защита от N+1).
+    # В большой БД у каждой организации 100 хранилищ, у каждого хранилища - около 20 организаций
+    monkeypatch.setattr(response_cache.cache, "max_entries", 0)
+    small = endpoint_query_counts(orgs=10, warehouses=10, density=1.0)
+    large = endpoint_query_counts(orgs=200, warehouses=1000, density=0.1)
+    assert {request: (small[request], large[request]) for request in small if small[request] != large[request]} == {}
+    assert small["GET /"] == 0
+
+
+def test_geo_grid_and_haversine():
+    moscow, saint_petersburg = (55.7558, 37.6173), (59.9343, 30.3351)
+    distance = geo.haversine_km(*moscow, np.array([saint_petersburg[0]]), np.array([saint_petersburg[1]]))[0]
+    assert 630 < distance < 636
+    # Круг через антимеридиан и круг у полюса
+    assert geo.cell_of(0.1, -179.9) in geo.cells_within(0.1, 179.9, 100)
+    assert geo.cell_of(89.9, 120) in geo.cells_within(89.8, -60, 50)
+    assert geo.cells_within(0, 0, 20000) is None
+
+
+def test_coordinates_fill_distances(monkeypatch):
+    db_reset()
+    monkeypatch.setattr(config, "geo_radius_km", 50)
+    monkeypatch.setattr(config, "geo_max_links", 2)
+
+    def add_warehouse(name, lat, lon, bio_limit=100):
+        return client.post("/warehouses/", json={"name": name, "bio_limit": bio_limit, "plastic_limit": 0,
+                                                 "glass_limit": 0, "lat": lat, "lon": lon})
+
+    assert add_warehouse("МНО Центр", 55.76, 37.62).json()["linked_orgs"] == 0  # организаций с координатами нет
+    add_warehouse("МНО Север", 55.80, 37.50)
+    add_warehouse("МНО Юго-Восток", 55.55, 37.90)
+    add_warehouse("МНО Петербург", 59.93, 30.34)
+    response = client.post("/orgs/", json={"name": "ОО Москва", "lat": 55.7558, "lon": 37.6173,
+                                           "warehouses": {"1": 1000}})
+    assert response.status_code == 201
+    warehouses = client.get("/orgs/3/").json()["warehouses"]
+    assert sorted((item["warehouse_name"], item["distance"]) for item in warehouses) == [
+        ("МНО 1", 1000), ("МНО Север", 9), ("МНО Центр", 0)  # два ближайших в радиусе и одно указанное вручную
+    ]
+
+    # Новое хранилище рядом с организацией сразу доступно для распределения
+    response = add_warehouse("МНО Рядом", 55.7560, 37.6175, bio_limit=500)
+    assert response.json()["linked_orgs"] == 1
+    response = client.post("/transfer_waste/?org_id=3&waste_type=bio&quantity=550")
+    assert [(item["warehouse_name"], item["delivered_quantity"]) for item in response.json()["transfer_data"]] == [
+        ("МНО Центр", 100), ("МНО Рядом", 450)  # оба в 0 км, при равенстве - по id
+    ]
+
+    assert add_warehouse("МНО", 55.0, None).json() == {"detail": "Укажите обе координаты: lat и lon"}
+    with pytest.raises(ValidationError):  # вне запроса модель - обычная модель pydantic, без HTTP-ошибок
+        sql.CreateOrganization(name="ОО", lat=55.0)
+    response = client.post("/orgs/", json={"name": "ОО без хранилищ"})
+    assert response.status_code == 422
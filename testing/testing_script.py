@@ -1,5 +1,6 @@
 from sqlmodel import Session, select
-from database.sql_models import engine, Organization, Warehouse, WarehouseAvailability
+from database.sql_models import engine, Organization, Warehouse, WarehouseAvailability, WarehouseCapacity
+from database.capacity import LEGACY_WASTE_TYPES
 
 
 def generate_test_data():
@@ -13,17 +14,25 @@ def generate_test_data():
         session.add_all(organizations)
         session.commit()
 
-        warehouses = [
-            Warehouse(name="МНО 1", bio_limit=0, plastic_limit=100, glass_limit=300),
-            Warehouse(name="МНО 2", bio_limit=150, plastic_limit=50, glass_limit=0),
-            Warehouse(name="МНО 3", bio_limit=250, plastic_limit=10, glass_limit=0),
-            Warehouse(name="МНО 5", bio_limit=25, plastic_limit=0, glass_limit=220),
-            Warehouse(name="МНО 6", bio_limit=150, plastic_limit=0, glass_limit=100),
-            Warehouse(name="МНО 7", bio_limit=250, plastic_limit=100, glass_limit=0),
-            Warehouse(name="МНО 8", bio_limit=52, plastic_limit=25, glass_limit=35),
-            Warehouse(name="МНО 9", bio_limit=20, plastic_limit=250, glass_limit=0),
+        # название, лимиты биоотходов, пластика и стекла
+        warehouse_limits = [
+            ("МНО 1", 0, 100, 300),
+            ("МНО 2", 150, 50, 0),
+            ("МНО 3", 250, 10, 0),
+            ("МНО 5", 25, 0, 220),
+            ("МНО 6", 150, 0, 100),
+            ("МНО 7", 250, 100, 0),
+            ("МНО 8", 52, 25, 35),
+            ("МНО 9", 20, 250, 0),
         ]
+        warehouses = [Warehouse(name=name) for name, *_ in warehouse_limits]
         session.add_all(warehouses)
+        session.flush()
+        session.add_all(
+            WarehouseCapacity(warehouse_id=warehouse.id, waste_type=waste_type, remaining=remaining)
+            for warehouse, (_, *limits) in zip(warehouses, warehouse_limits)
+            for waste_type, remaining in zip(LEGACY_WASTE_TYPES, limits)
+        )
         session.commit()
 
         orgs = session.exec(select(Organization)).all()